@@ -0,0 +1,67 @@
+"""
+Microbenchmark of the Gerrit footer extraction: the original path (decode
+every line, join, parse with email.parser and split again) against
+pop3bot.extract_gerrit_data, which works on the raw TOP lines.
+
+Usage: python -m benchmarks.footer [-n ITERATIONS]
+"""
+import argparse
+import email.parser
+import timeit
+from pathlib import Path
+
+import pop3bot
+
+root = Path(__file__).parent.parent  # type: Path
+
+
+def load_fixtures():
+    return {
+        path.name: path.read_bytes().splitlines()
+        for path in sorted((root / 'tests' / 'data').glob('*.mbox'))
+    }
+
+
+def get_gerrit_data_from_contents(contents):
+    for line in contents.split('\n'):
+        if ': ' in line:
+            key, value = line.split(': ', 1)
+            if key.startswith('Gerrit-') or key in ['Bug', 'Task', 'Closes']:
+                yield key, value.rstrip()
+
+
+def old_path(lines):
+    mail = "\n".join([x.decode('utf-8', 'replace') for x in lines])
+    message = email.parser.Parser().parsestr(mail)
+    payload = message.get_payload(decode=True)
+    if not payload:
+        return None
+    gerrit_data = dict((k, v) for (k, v) in message.items() if k.startswith('X-Gerrit'))
+    gerrit_data.update(dict(get_gerrit_data_from_contents(payload.decode('utf-8', 'replace'))))
+    return gerrit_data
+
+
+def new_path(lines):
+    return pop3bot.extract_gerrit_data(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--iterations', type=int, default=2000)
+    args = parser.parse_args()
+
+    fixtures = load_fixtures()
+    print("%-32s %12s %12s %8s" % ("fixture", "old (us)", "new (us)", "speedup"))
+    totals = [0, 0]
+    for name, lines in fixtures.items():
+        assert old_path(lines) == new_path(lines), name
+        old = timeit.timeit(lambda: old_path(lines), number=args.iterations) / args.iterations * 1e6
+        new = timeit.timeit(lambda: new_path(lines), number=args.iterations) / args.iterations * 1e6
+        totals[0] += old
+        totals[1] += new
+        print("%-32s %12.1f %12.1f %7.1fx" % (name, old, new, old / new))
+    print("%-32s %12.1f %12.1f %7.1fx" % ("total", totals[0], totals[1], totals[0] / totals[1]))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,155 @@
+"""
+Offline replay benchmark: synthesizes a large mailbox from the fixtures in
+tests/data and runs it through the ingest and tag stages of forrestbot,
+against in-process fake Gerrit and Phabricator servers.
+
+Usage: python -m benchmarks.replay [-n MAILS] [--tasks TASKS] [--latency SECONDS]
+"""
+import argparse
+import base64
+import random
+import re
+import resource
+import sys
+import tempfile
+import time
+import types
+from pathlib import Path
+
+from tests.fakes import FakeAsyncGerrit, FakeGerrit, FakeMailbox, FakePhabricator
+
+root = Path(__file__).parent.parent  # type: Path
+
+# fixtures that reach the tagging stage, and some that are skipped
+FIXTURES = [
+    'extension_wmf_branch.mbox',
+    'lst_merged_REL.mbox',
+    'lst_merged_master.mbox',
+    'lst_merged_notask.mbox',
+    'mw_core_REL_branch.mbox',
+    'mw_core_master.mbox',
+    'mw_core_wmf_branch.mbox',
+    'nontracked_repo.mbox',
+    'not_jenkins.mbox',
+    'not_merge.mbox',
+    'wmf_deploy.mbox',
+]
+
+WATCHED = [
+    'mediawiki/core',
+    'mediawiki/extensions/LabeledSectionTransclusion',
+    'mediawiki/extensions/CentralNotice',
+    'mediawiki/extensions/DonationInterface',
+    'mediawiki/extensions/Echo',
+]
+
+# a fixed tarball manifest, so the benchmark does not fetch the real one
+BUNDLED = ['mediawiki/extensions/Echo']
+
+BRANCHES = ['master', 'REL1_34', 'wmf/1.35.0-wmf.15', 'wmf/1.35.0-wmf.16']
+
+SLUGS = ['mw1.23', 'mw1.34', 'mw1.35.0-wmf.15', 'mw1.35.0-wmf.16', 'mw1.35.0-wmf.17']
+
+_bug_re = re.compile(r'^(Bug|Task|Closes): T\d+', re.MULTILINE)
+
+
+def with_task(mail, task):
+    """ Returns mail with its Bug/Task/Closes footer pointing to task. """
+    headers, sep, body = mail.partition('\n\n')
+    replacement = r'\1: T%i' % task
+    if re.search(r'^Content-Transfer-Encoding: base64', headers, re.MULTILINE | re.IGNORECASE):
+        text = base64.b64decode(body).decode('utf-8')
+        text = _bug_re.sub(replacement, text)
+        encoded = base64.encodebytes(text.encode('utf-8')).decode('ascii')
+        return headers + sep + encoded
+    return headers + sep + _bug_re.sub(replacement, body)
+
+
+def synthesize(n_mails, n_tasks, seed=0):
+    """ Builds n_mails mails from the fixtures, spread over n_tasks tasks. """
+    rng = random.Random(seed)
+    fixtures = [(root / 'tests' / 'data' / f).read_text(encoding='utf-8') for f in FIXTURES]
+    return [
+        with_task(fixtures[i % len(fixtures)], 100000 + rng.randrange(n_tasks))
+        for i in range(n_mails)
+    ]
+
+
+def fake_config(n_mails, cache_dir, rate):
+    config = types.ModuleType('config')
+    config.PHAB_HOST = 'https://phabricator.invalid'
+    config.PHAB_USER = 'benchmark'
+    config.PHAB_TOKEN = 'api-benchmark'
+    config.CACHE_DIR = cache_dir
+    config.MAX_MAILS = n_mails
+    config.PHAB_UPDATE_RATE = rate
+    return config
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('-n', '--mails', type=int, default=5000)
+    parser.add_argument('--tasks', type=int, default=500, help="number of distinct tasks")
+    parser.add_argument('--latency', type=float, default=0.0, help="latency of every API call, in seconds")
+    parser.add_argument('--rate', type=float, default=1000.0, help="PHAB_UPDATE_RATE to use")
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    mails = synthesize(args.mails, args.tasks, args.seed)
+    rss_before = peak_rss_mb()
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        sys.modules['config'] = fake_config(args.mails, cache_dir, args.rate)
+        import clients
+        import forrestbot
+        import pop3bot
+        from ledger import Ledger
+        from releasetrain import TarballManifest
+        from repositories import RepositoryRegistry
+        from spool import Spool
+
+        gerrit = FakeGerrit({'mediawiki%2Fcore': BRANCHES}, latency=args.latency)
+        phab = FakePhabricator(
+            projects={slug: 'PHID-PROJ-%s' % slug for slug in SLUGS},
+            tasks={100000 + t: {'PHID-PROJ-other'} for t in range(args.tasks)},
+            latency=args.latency,
+        )
+        clients.set_client('gerrit', gerrit)
+        clients.set_client('async_gerrit', FakeAsyncGerrit(gerrit))
+        clients.set_client('phabricator', phab)
+        mailbox = FakeMailbox.from_contents(mails)
+        pop3bot.mkmailbox = lambda: mailbox
+
+        spool = Spool(str(Path(cache_dir) / 'spool.sqlite3'))
+        ledger = Ledger(str(Path(cache_dir) / 'ledger.sqlite3'))
+        repos = RepositoryRegistry(WATCHED)
+        tarball = TarballManifest(BUNDLED)
+
+        start = time.perf_counter()
+        forrestbot.ingest(spool, repos, tarball)
+        ingested = time.perf_counter()
+        forrestbot.tag(spool, ledger)
+        tagged = time.perf_counter()
+
+    ntasks = sum(1 for projects in phab.tasks.values() if projects != {'PHID-PROJ-other'})
+    ingest_time = ingested - start
+    tag_time = tagged - ingested
+
+    print("mails:                %8i" % args.mails)
+    print("tasks tagged:         %8i" % ntasks)
+    print("ingest:               %8.2f s  (%.0f mails/s)" % (ingest_time, args.mails / ingest_time))
+    print("tag:                  %8.2f s" % tag_time)
+    print("total:                %8.2f s  (%.0f mails/s)" % (tagged - start, args.mails / (tagged - start)))
+    print("gerrit calls:         %8i" % len(gerrit.requests))
+    print("phabricator calls:    %8i  (%.2f per task)" % (len(phab.requests), len(phab.requests) / max(ntasks, 1)))
+    print("mails deleted:        %8i" % len(mailbox.deleted))
+    print("peak RSS:             %8.1f MB  (%.1f MB before replay)" % (peak_rss_mb(), rss_before))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Startup benchmark: measures, in fresh interpreters, the time it takes to
+import forrestbot and to read the first mail from a (fake) mailbox.
+
+Usage: python -m benchmarks.startup [--runs RUNS]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+root = Path(__file__).parent.parent  # type: Path
+
+# runs in a fresh interpreter, and prints the timings as JSON
+SCRIPT = """
+import time
+start = time.perf_counter()
+
+import sys
+import tempfile
+import types
+
+config = types.ModuleType('config')
+config.CACHE_DIR = tempfile.mkdtemp()
+sys.modules['config'] = config
+
+import forrestbot
+import pop3bot
+imported = time.perf_counter()
+
+class Mailbox:
+    # like tests.fakes.FakeMailbox, which imports the Gerrit and Phabricator clients
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.lines = f.read().split(b'\\n')
+
+    def stat(self):
+        return 1, 0
+
+    def top(self, i, n):
+        return b'+OK', self.lines, 0
+
+
+mailbox = Mailbox('tests/data/lst_merged_master.mbox')
+mail = next(pop3bot.gerritmail_generator(mailbox))
+forrestbot.wanted_mail(mail, ['mediawiki/extensions/LabeledSectionTransclusion'])
+first_mail = time.perf_counter()
+
+print(json.dumps({'import': imported - start, 'first_mail': first_mail - start}))
+"""
+
+
+def measure():
+    output = subprocess.check_output(
+        [sys.executable, '-c', 'import json\n' + SCRIPT], cwd=str(root)
+    )
+    return json.loads(output)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--runs', type=int, default=10)
+    args = parser.parse_args()
+
+    # the first run warms up the bytecode cache
+    measure()
+    runs = [measure() for _ in range(args.runs)]
+
+    for key in ('import', 'first_mail'):
+        values = [run[key] * 1000 for run in runs]
+        print("%-12s median %7.1f ms  (min %.1f ms, max %.1f ms)" % (
+            key + ':', statistics.median(values), min(values), max(values)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import logging
+
+from cache import JSONCache
+from releasetrain import version_key
+
+logger = logging.getLogger('branches')
+
+# Shorter than the interval between (hourly) runs, so every run reads the
+# branches of core again (a single request) and a new branch cut is noticed
+# by the next run. Entries are also replaced as soon as a merge on a newer
+# wmf branch is seen (see BranchCache.seen).
+DEFAULT_TTL = 30 * 60
+
+# stored for repositories without wmf branches
+NO_BRANCH = ''
+
+
+class BranchCache(object):
+    def __init__(self, path, ttl=DEFAULT_TTL):
+        """ Persistent record of the newest wmf/* branch of each repository,
+            so the full branch list does not have to be requested from
+            Gerrit on every run.
+
+            Branches are stored without the 'wmf/' prefix, e.g.
+            '1.35.0-wmf.16'. Repositories without wmf branches are cached
+            as well, under the same TTL, so they are not requested again
+            for every mail.
+
+            Parameters:
+              * path - JSON file to keep the cache in
+              * ttl - number of seconds after which an entry is re-requested
+        """
+        self._cache = JSONCache(path)
+        self._ttl = ttl
+
+    def known(self, repository):
+        """ Returns whether repository is in the cache and has not expired,
+            including repositories without wmf branches. """
+        return not self._cache.expired(repository)
+
+    def newest(self, repository):
+        """ Returns the cached newest wmf branch of repository, or None if it
+            is unknown, has expired or has no wmf branches. """
+        return self._cache.get(repository) or None
+
+    def set(self, repository, branch):
+        """ Stores the newest wmf branch of repository; None records that it
+            has no wmf branches. """
+        self._cache.set(repository, branch or NO_BRANCH, ttl=self._ttl)
+
+    def seen(self, repository, branch):
+        """ Records that a wmf branch exists for repository, e.g. because a
+            change was merged into it. If it is newer than the cached newest
+            branch, the cached entry is replaced. Unknown repositories are
+            left alone, as a single branch says nothing about which one is
+            the newest. Returns whether the entry was replaced. """
+        branch = branch[len('wmf/'):] if branch.startswith('wmf/') else branch
+        key = version_key(branch)
+        if key is None:
+            return False
+        cached = self._cache.get(repository, stale_ok=True)
+        if cached is None or key <= (version_key(cached) or ()):
+            return False
+        logger.info("New wmf branch %s seen for %s (was %s)", branch, repository, cached or None)
+        self.set(repository, branch)
+        return True
+
+    def save(self):
+        self._cache.save()
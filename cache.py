@@ -0,0 +1,76 @@
+import json
+import logging
+import os
+import time
+
+from wblogging import private_open
+
+logger = logging.getLogger('cache')
+
+
+class JSONCache(object):
+    def __init__(self, path):
+        """ Small on-disk key/value store with per-entry expiry, used to
+            keep state between the hourly cron runs. Values must be
+            JSON-serializable. Changes are only written to disk by save().
+
+            Parameters:
+              * path - the JSON file to use; it is created on save() if it
+                does not exist yet.
+        """
+        self._path = path
+        self._entries = {}
+        self._dirty = False
+        try:
+            with open(path, encoding='utf-8') as f:
+                self._entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            logger.warning("Ignoring corrupt cache file %s (%r)", path, e)
+
+    def get(self, key, default=None, stale_ok=False):
+        """ Returns the value stored for key, or default if it is missing
+            or expired. Expired entries are still returned if stale_ok is
+            set. """
+        entry = self._entries.get(key)
+        if entry is None:
+            return default
+        if not stale_ok and self.expired(key):
+            return default
+        return entry['value']
+
+    def expired(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return True
+        return entry['expires'] is not None and entry['expires'] < time.time()
+
+    def set(self, key, value, ttl=None):
+        """ Stores value under key. If ttl (in seconds) is given, the entry
+            expires after that time; otherwise it is kept forever. """
+        self._entries[key] = {
+            'value': value,
+            'expires': time.time() + ttl if ttl is not None else None,
+        }
+        self._dirty = True
+
+    def delete(self, key):
+        if self._entries.pop(key, None) is not None:
+            self._dirty = True
+
+    def keys(self):
+        return list(self._entries.keys())
+
+    def save(self):
+        """ Atomically writes the cache back to disk, if it was changed. """
+        if not self._dirty:
+            return
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8', opener=private_open) as f:
+            json.dump(self._entries, f)
+        os.replace(tmp, self._path)
+        self._dirty = False
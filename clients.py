@@ -0,0 +1,125 @@
+"""
+Shared connections to Phabricator and Gerrit, and the configuration, created
+on first use. Importing forrestbot or pop3bot does not need a config.py or
+open any connections; tests and benchmarks can swap in their own clients
+with set_client(). The client libraries themselves are also only imported
+when needed, as importing requests takes a good part of the startup time.
+"""
+import importlib
+import os
+import threading
+
+GERRIT_URL = 'https://gerrit.wikimedia.org/r'
+
+
+class LazyConfig(object):
+    """ Stands in for the config module, which is only imported when one of
+        its settings is first read, so getattr(config, 'X', default) works as
+        with the module itself. """
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return getattr(importlib.import_module('config'), name)
+
+
+config = LazyConfig()
+
+_factories = {}
+_clients = {}
+_lock = threading.RLock()
+
+
+def factory(name):
+    """ Registers the decorated function as the factory for client name. """
+    def decorator(f):
+        _factories[name] = f
+        return f
+    return decorator
+
+
+def get_client(name):
+    """ Returns the shared client name, creating it on first use. """
+    with _lock:
+        if name not in _clients:
+            _clients[name] = _factories[name]()
+        return _clients[name]
+
+
+def set_client(name, client):
+    """ Replaces the shared client name, e.g. with a fake in tests. """
+    with _lock:
+        _clients[name] = client
+
+
+def reset():
+    """ Forgets all clients; they are created again on next use. """
+    with _lock:
+        _clients.clear()
+
+
+def save_gerrit_cache():
+    """ Saves the Gerrit response cache, if it has been used. """
+    with _lock:
+        cache = _clients.get('gerrit_cache')
+    if cache is not None:
+        cache.save()
+
+
+def cache_dir():
+    return getattr(config, 'CACHE_DIR', os.path.expanduser('~/.cache/forrestbot'))
+
+
+@factory('phabricator')
+def _phabricator():
+    import phabricator as legophab
+    from instrumentation import instrument_phabricator
+
+    return instrument_phabricator(legophab.Phabricator(
+        config.PHAB_HOST,
+        config.PHAB_USER,
+        token=config.PHAB_TOKEN
+    ))
+
+
+@factory('gerrit_cache')
+def _gerrit_cache():
+    import gerrit_rest
+
+    return gerrit_rest.ResponseCache(
+        path=os.path.join(cache_dir(), 'gerrit.json'),
+        ttls=getattr(config, 'GERRIT_CACHE_TTLS', {})
+    )
+
+
+@factory('gerrit')
+def _gerrit():
+    import gerrit_rest
+
+    return gerrit_rest.GerritREST(GERRIT_URL, cache=gerrit_cache())
+
+
+@factory('async_gerrit')
+def _async_gerrit():
+    import gerrit_rest
+
+    return gerrit_rest.AsyncGerritREST(
+        GERRIT_URL,
+        concurrency=getattr(config, 'GERRIT_CONCURRENCY', gerrit_rest.DEFAULT_CONCURRENCY),
+        cache=gerrit_cache()
+    )
+
+
+def phabricator():
+    return get_client('phabricator')
+
+
+def gerrit_cache():
+    return get_client('gerrit_cache')
+
+
+def gerrit():
+    return get_client('gerrit')
+
+
+def async_gerrit():
+    return get_client('async_gerrit')
@@ -1,44 +1,90 @@
 import bz2
+import os
 import smtplib
 from email.message import EmailMessage
 
-errlog = open('forrestbot.log').readlines()
+from wblogging import read_run_start
 
-errorlines = []
-for line in errlog:
-    if "ERROR SUMMARY" in line:
-        errorlines = [line]
-    else:
-        errorlines.append(line)
+LOGFILE = 'forrestbot.log'
+# number of lines of the log included in the mail
+MAX_LINES = 100
+BLOCK_SIZE = 64 * 1024
 
-errortext = "".join(errorlines[-100:])
 
-message = f"""Dear friends of ReleaseTaggerBot,
+def tail(f, marker, max_lines=MAX_LINES, start=0, block_size=BLOCK_SIZE):
+    """ Returns the lines of the binary file f from the last line that
+        contains marker, or the last max_lines lines if that is fewer. The
+        file is read backwards, one block at a time, so only the end of the
+        file is read. Lines before offset start are ignored. """
+    f.seek(0, os.SEEK_END)
+    position = f.tell()
+    data = b''
+    lines = []
+    while position > start:
+        size = min(block_size, position - start)
+        position -= size
+        f.seek(position)
+        data = f.read(size) + data
+        lines = data.splitlines(keepends=True)
+        if position > start:
+            # the first line may have started in the previous block
+            lines = lines[1:]
+        for i in range(len(lines) - 1, -1, -1):
+            if marker in lines[i]:
+                return lines[i:][-max_lines:]
+        if len(lines) >= max_lines:
+            break
+    return lines[-max_lines:]
+
+
+def compress(f, start=0, block_size=BLOCK_SIZE):
+    """ Returns the bz2-compressed contents of the binary file f from offset
+        start, compressing one block at a time. """
+    compressor = bz2.BZ2Compressor()
+    f.seek(start)
+    chunks = []
+    for block in iter(lambda: f.read(block_size), b''):
+        chunks.append(compressor.compress(block))
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def main(logfile=LOGFILE):
+    start = read_run_start(logfile)
+    with open(logfile, 'rb') as f:
+        errortext = b''.join(tail(f, b'ERROR SUMMARY', start=start)).decode('utf-8', 'replace')
+        attachment = compress(f, start)
+
+    message = f"""Dear friends of ReleaseTaggerBot,
 
 I'm sorry to inform you that ReleaseTaggerBot has run into a snag.
 Please see the error below:
 
 {errortext}
 
-The full error log has been attached for your convenience.
+The error log of this run has been attached for your convenience.
 
 With kind regards,
 valhallasw in the past
 """
 
-msg = EmailMessage()
-msg.set_content(message)
-msg['Subject'] = "ReleaseTaggerBot broken"
-msg['From'] = "tools.forrestbot <tools.forrestbot@tools.wmflabs.org>"
-msg['To'] = "ReleaseTaggerBot maintainers <tools.forrestbot@tools.wmflabs.org>"
-msg.add_attachment(
-    bz2.compress(open('forrestbot.log', 'rb').read()),
-    filename='error.log.bz2',
-    maintype='application',
-    subtype='octet-stream')
-
-s = smtplib.SMTP('mail.tools.wmflabs.org')
-s.send_message(msg)
-s.quit()
-
-print("Sent error email")
+    msg = EmailMessage()
+    msg.set_content(message)
+    msg['Subject'] = "ReleaseTaggerBot broken"
+    msg['From'] = "tools.forrestbot <tools.forrestbot@tools.wmflabs.org>"
+    msg['To'] = "ReleaseTaggerBot maintainers <tools.forrestbot@tools.wmflabs.org>"
+    msg.add_attachment(
+        attachment,
+        filename='error.log.bz2',
+        maintype='application',
+        subtype='octet-stream')
+
+    s = smtplib.SMTP('mail.tools.wmflabs.org')
+    s.send_message(msg)
+    s.quit()
+
+    print("Sent error email")
+
+
+if __name__ == "__main__":
+    main()
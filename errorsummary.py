@@ -0,0 +1,101 @@
+import collections
+import logging
+import re
+
+# number of formatted records kept for the summary
+DEFAULT_CAPACITY = 20
+# number of distinct errors counted separately; others are counted together
+DEFAULT_FINGERPRINTS = 100
+# number of task IDs listed per distinct error
+DEFAULT_SAMPLES = 5
+
+# parts of a message that differ between otherwise identical errors
+_variable_re = re.compile(r'PHID-[A-Z]+-\w+|\d+')
+_task_re = re.compile(r'\bT(\d+)\b')
+
+OTHER = 'other errors'
+
+
+def fingerprint(record):
+    """ Returns a key that is the same for records that only differ in the
+        numbers (task IDs, ...) and PHIDs in their message.
+
+        >>> fingerprint(logging.makeLogRecord({'name': 'updater', 'msg': 'Unable to update T%i', 'args': (1, )}))
+        ('updater', 'Unable to update T%i', None)
+        >>> fingerprint(logging.makeLogRecord({'name': 'forrestbot', 'msg': 'T12: adding PHID-PROJ-abc12'}))
+        ('forrestbot', 'T#: adding #', None)
+    """
+    exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+    return record.name, _variable_re.sub('#', str(record.msg)), exc_type
+
+
+class ErrorAggregator(logging.Handler):
+    def __init__(self, level=logging.ERROR, capacity=DEFAULT_CAPACITY,
+                 max_fingerprints=DEFAULT_FINGERPRINTS, samples=DEFAULT_SAMPLES):
+        """ Logging handler that collects the errors of a run for the summary
+            at the end, in bounded memory: repeats of the same error (see
+            fingerprint()) are counted, with a few sample task IDs, and only
+            the last capacity records are kept in full.
+
+            Parameters:
+              * level - the lowest level to collect
+              * capacity - the number of most recent records to keep
+              * max_fingerprints - the number of distinct errors to count
+                separately; further ones are counted as OTHER
+              * samples - the number of task IDs to keep per distinct error
+        """
+        super(ErrorAggregator, self).__init__(level)
+        self._recent = collections.deque(maxlen=capacity)
+        self._errors = collections.OrderedDict()
+        self._max_fingerprints = max_fingerprints
+        self._samples = samples
+        self.total = 0
+
+    def emit(self, record):
+        try:
+            message = record.getMessage()
+            self._recent.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+            return
+
+        key = fingerprint(record)
+        if key not in self._errors and len(self._errors) >= self._max_fingerprints:
+            key = OTHER
+        if key not in self._errors:
+            self._errors[key] = {'message': message if key != OTHER else OTHER, 'count': 0, 'tasks': []}
+        entry = self._errors[key]
+        entry['count'] += 1
+        self.total += 1
+        for task in _task_re.findall(message):
+            if len(entry['tasks']) >= self._samples:
+                break
+            if 'T' + task not in entry['tasks']:
+                entry['tasks'].append('T' + task)
+
+    def counts(self):
+        """ Returns a list of (count, message, sample tasks) tuples, one for
+            each distinct error, most frequent first. message is that of the
+            first occurrence. """
+        with self.lock:
+            entries = [(e['count'], e['message'], list(e['tasks'])) for e in self._errors.values()]
+        return sorted(entries, key=lambda entry: -entry[0])
+
+    def recent(self):
+        """ Returns the most recent records, formatted. """
+        with self.lock:
+            return list(self._recent)
+
+    def summary(self):
+        """ Returns the lines of the summary: the counts of the distinct
+            errors, followed by the most recent records. """
+        lines = []
+        for count, message, tasks in self.counts():
+            line = "%5ix %s" % (count, message)
+            if count > 1 and tasks:
+                line += " (e.g. %s)" % ', '.join(tasks)
+            lines.append(line)
+        if self.total > 1:
+            lines.append("Last %i of %i errors:" % (len(self._recent), self.total))
+            lines.extend(self.recent())
+        return lines
@@ -0,0 +1,151 @@
+"""
+Sources of Gerrit events for the long-running daemon mode: the SSH
+stream-events feed, and an HTTP endpoint for the webhooks plugin. Both put
+the events, as dicts, on a queue.Queue, from which batches() collects
+micro-batches.
+"""
+import hmac
+import http.server
+import json
+import logging
+import queue
+import subprocess
+import threading
+import time
+
+logger = logging.getLogger('eventstream')
+
+GERRIT_SSH_PORT = 29418
+# reconnect delays, in seconds; doubled after each failed attempt
+INITIAL_BACKOFF = 1
+MAX_BACKOFF = 5 * 60
+# only reachable through a local proxy unless configured otherwise
+DEFAULT_WEBHOOK_ADDRESS = ('127.0.0.1', 8000)
+
+
+def ssh_command(host, user=None, port=GERRIT_SSH_PORT, events=('change-merged', )):
+    """ Returns the ssh command line that streams the given events. """
+    destination = '%s@%s' % (user, host) if user else host
+    command = [
+        'ssh', '-p', str(port),
+        '-o', 'BatchMode=yes',
+        '-o', 'ServerAliveInterval=30',
+        destination,
+        'gerrit', 'stream-events',
+    ]
+    for event in events:
+        command += ['-s', event]
+    return command
+
+
+def stream_events(command):
+    """ Runs command, and yields the JSON events it writes to stdout, one per
+        line, until it exits. """
+    with subprocess.Popen(command, stdout=subprocess.PIPE, stdin=subprocess.DEVNULL) as process:
+        try:
+            for line in process.stdout:
+                try:
+                    yield json.loads(line)
+                except ValueError:
+                    logger.warning("Ignoring malformed event %r", line[:200])
+        except GeneratorExit:
+            process.kill()
+            raise
+    if process.returncode:
+        raise OSError("%s exited with status %i" % (command[0], process.returncode))
+
+
+def reconnecting(connect, stop, initial=INITIAL_BACKOFF, maximum=MAX_BACKOFF):
+    """ Yields the events from connect(), calling it again when its events
+        run out or it fails, with exponential backoff, until stop is set. The
+        backoff is reset once events arrive again. """
+    delay = initial
+    while not stop.is_set():
+        try:
+            for event in connect():
+                delay = initial
+                yield event
+            logger.warning("Event stream closed, reconnecting in %i seconds", delay)
+        except OSError as e:
+            logger.warning("Event stream failed (%r), reconnecting in %i seconds", e, delay)
+        stop.wait(delay)
+        delay = min(delay * 2, maximum)
+
+
+def start_ssh_reader(events, command, stop):
+    """ Starts a thread that puts the events streamed by command on the
+        events queue, reconnecting when needed. """
+    def read():
+        for event in reconnecting(lambda: stream_events(command), stop):
+            events.put(event)
+
+    thread = threading.Thread(target=read, name='stream-events', daemon=True)
+    thread.start()
+    return thread
+
+
+class _WebhookHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def do_POST(self):
+        secret = self.server.secret
+        if secret is not None:
+            expected = ('Bearer ' + secret).encode('utf-8')
+            if not hmac.compare_digest(self.headers.get('Authorization', '').encode('utf-8'), expected):
+                self.send_error(403, "Invalid or missing secret")
+                return
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        try:
+            event = json.loads(body)
+        except ValueError:
+            self.send_error(400, "Invalid JSON")
+            return
+        self.server.events.put(event)
+        self.send_response(202)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, events, secret=None):
+        """ HTTP server that puts the JSON events POSTed to it by the Gerrit
+            webhooks plugin on the events queue. Anyone who can reach it can
+            POST events, so they are only hints: the changes are read from
+            Gerrit again before they are used (see
+            gerritsource.verified_mails).
+
+            Parameters:
+              * address - the (host, port) to listen on
+              * events - the queue.Queue to put events on
+              * secret - if given, requests must have an
+                'Authorization: Bearer <secret>' header
+        """
+        super().__init__(address, _WebhookHandler)
+        self.events = events
+        self.secret = secret
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever, name='webhook', daemon=True)
+        thread.start()
+        return thread
+
+
+def batches(events, max_size=100, max_delay=5.0, clock=time.monotonic):
+    """ Collects the events on the events queue into lists. A batch is
+        started by the first event to arrive, and is yielded once it has
+        max_size events or max_delay seconds after it was started. """
+    while True:
+        batch = [events.get()]
+        deadline = clock() + max_delay
+        while len(batch) < max_size:
+            remaining = deadline - clock()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(events.get(timeout=remaining))
+            except queue.Empty:
+                break
+        yield batch
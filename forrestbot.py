@@ -4,100 +4,213 @@ https://etherpad.wikimedia.org/p/T280 & https://phabricator.wikimedia.org/T280
 __author__ = 'Merlijn van Deen'  # noqa
 
 import functools
+import os
+import signal
 import sys
+import threading
+import time
 
 import itertools
 import queue
 
 import logging
-import logging.handlers
-from wblogging import LoggingSetupParser
-
-import gerrit_rest
-import phabricator as legophab
-import wikimediaci_utils
-import config
-from utils import wmf_number, parse_task_number, slugify
+from wblogging import LoggingSetupParser, write_run_start
+
+import clients
+from clients import config
+from errorsummary import ErrorAggregator
+from instrumentation import metrics
+import branches
+from branches import BranchCache
+import gerritsource
+from gerritsource import Checkpoint
+import releasetrain
+from releasetrain import ReleaseTrain, TarballManifest
+from ledger import Ledger, DEFAULT_TRAINS as DEFAULT_LEDGER_TRAINS, DEFAULT_RETENTION as DEFAULT_LEDGER_RETENTION
+from phids import SlugPHIDMap, UnknownSlugException, UNKNOWN_SLUG_MAX_AGE
+import repositories
+from repositories import RepositoryRegistry
+from spool import Spool, DEFAULT_RETENTION as DEFAULT_SPOOL_RETENTION
+import tasks
+from tasks import TaskAggregator, get_task_projects, update_job
+from utils import parse_task_number
 
 if __name__ == "__main__":
     parser = LoggingSetupParser(
         description="Process changesets and add release tags as required",
     )
-    parser.parse_args()
+    parser.add_argument(
+        "--refresh-repos", dest='refresh_repos', action='store_true',
+        help="Re-fetch the list of watched repositories even if the cached "
+             "copy has not expired yet",
+    )
+    parser.add_argument(
+        "--stage", dest='stage', choices=('all', 'ingest', 'tag'), default='all',
+        help="Only read mails into the spool ('ingest'), only tag the tasks "
+             "in the spool ('tag'), or both ('all', the default)",
+    )
+    parser.add_argument(
+        "--source", dest='source', choices=('mail', 'gerrit'), default=None,
+        help="Read merged changes from the notification mails ('mail') or "
+             "query Gerrit for them ('gerrit'); defaults to INGEST_SOURCE "
+             "from the config, or 'mail'",
+    )
+    parser.add_argument(
+        "--daemon", dest='daemon', choices=('ssh', 'webhook'), default=None,
+        help="Keep running, and tag tasks as soon as changes are merged, "
+             "using the events from 'gerrit stream-events' over SSH ('ssh') "
+             "or those POSTed by the webhooks plugin ('webhook')",
+    )
+    parser.add_argument(
+        "--prometheus-textfile", dest='prometheus_textfile', default=None,
+        help="Also write the run metrics to this file in the Prometheus "
+             "text format",
+    )
+    args = parser.parse_args()
 
 
-errorQueue = queue.Queue()
-queueHandler = logging.handlers.QueueHandler(errorQueue)
-queueHandler.setLevel(logging.ERROR)
-queueHandler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
-logging.getLogger().addHandler(queueHandler)
-logging.getLogger('requests').setLevel(logging.INFO)
+errorAggregator = ErrorAggregator()
+errorAggregator.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
 logger = logging.getLogger('forrestbot')
 
 
-phab = legophab.Phabricator(
-    config.PHAB_HOST,
-    config.PHAB_USER,
-    token=config.PHAB_TOKEN
-)
-gerrit = gerrit_rest.GerritREST("https://gerrit.wikimedia.org/r")
+# All Wikimedia-deployed repositories are branched together with core, so the
+# newest wmf branch of core is used for every repository, unless
+# SHARED_BRANCHES is disabled in the config.
+SHARED_BRANCH_REPOSITORY = 'mediawiki/core'
 
 
 @functools.lru_cache()
-def get_master_branches(repository):
-    logging.debug("Requesting 'master' branches for %s" % repository)
-    silly_encoded_name = repository.replace('/', '%2F')  # wtf gerrit
-    projbranches = gerrit.branches(silly_encoded_name)
+def get_branch_cache():
+    return BranchCache(
+        os.path.join(clients.cache_dir(), 'branches.json'),
+        ttl=getattr(config, 'BRANCH_CACHE_TTL', branches.DEFAULT_TTL)
+    )
 
-    projbranches = [b['ref'] for b in projbranches]
 
+def newest_wmf_branch(refs):
+    """ Returns the newest wmf branch (without the 'wmf/' prefix) in refs, a
+        list of full ref names, or None if there are no wmf branches. """
     marker = 'refs/heads/wmf/'
-    wmf_branches = sorted([b.split(marker)[1] for b in projbranches
-                           if (marker in b and wmf_number(b.split(marker)[1]))],
-                          key=wmf_number)
-    if wmf_branches == []:
+    return ReleaseTrain(b[len(marker):] for b in refs if b.startswith(marker)).newest()
+
+
+def get_newest_wmf_branch(repository):
+    branch_cache = get_branch_cache()
+    if branch_cache.known(repository):
+        return branch_cache.newest(repository)
+
+    logging.debug("Requesting wmf branches for %s" % repository)
+    silly_encoded_name = repository.replace('/', '%2F')  # wtf gerrit
+    projbranches = [b['ref'] for b in clients.gerrit().iter_branches(silly_encoded_name, r='wmf/.*')]
+
+    newest_wmf = newest_wmf_branch(projbranches)
+    branch_cache.set(repository, newest_wmf)
+    return newest_wmf
+
+
+async def _fetch_newest_wmf_branches(repositories):
+    import asyncio
+
+    async def fetch(repository):
+        silly_encoded_name = repository.replace('/', '%2F')  # wtf gerrit
+        refs = [b['ref'] async for b in clients.async_gerrit().iter_branches(silly_encoded_name, r='wmf/.*')]
+        return repository, newest_wmf_branch(refs)
+
+    return await asyncio.gather(*[fetch(repository) for repository in repositories])
+
+
+def prefetch_wmf_branches(repositories):
+    """ Requests the newest wmf branch of all repositories that are not in
+        the branch cache yet concurrently, so that get_master_branches() does
+        not have to request them one at a time. """
+    branch_cache = get_branch_cache()
+    missing = sorted(r for r in set(repositories) if not branch_cache.known(r))
+    if not missing:
+        return
+
+    logging.debug("Requesting wmf branches for %i repositories" % len(missing))
+    import asyncio
+    for repository, newest_wmf in asyncio.run(_fetch_newest_wmf_branches(missing)):
+        branch_cache.set(repository, newest_wmf)
+
+
+def get_branch_repository(repository, shared=None):
+    """ Returns the repository whose wmf branches are used for repository.
+        shared defaults to SHARED_BRANCHES from the config. """
+    if shared is None:
+        shared = getattr(config, 'SHARED_BRANCHES', True)
+    if shared:
+        return SHARED_BRANCH_REPOSITORY
+    return repository
+
+
+def get_master_branches(repository, shared=None):
+    repository = get_branch_repository(repository, shared)
+
+    newest_wmf = get_newest_wmf_branch(repository)
+    if newest_wmf is None:
         return []
 
-    newest_wmf = wmf_branches[-1]
-    wmf_parts = newest_wmf.split("-wmf.")
-    wmf_parts[1] = wmf_parts[1].replace('.', '')
-    next_wmf = "wmf/" + wmf_parts[0] + "-wmf." + str(int(wmf_parts[1]) + 1)
+    return ["wmf/" + releasetrain.next_branch(newest_wmf)]
 
-    return [next_wmf]
 
+@functools.lru_cache()
+def get_repos_to_watch(refresh=False):
+    return RepositoryRegistry.load(
+        os.path.join(clients.cache_dir(), 'repositories.json'),
+        refresh=refresh
+    )
 
-def get_repos_to_watch():
-    repos = ['mediawiki/core']
-    repos.extend(wikimediaci_utils.get_wikimedia_deployed_list())
-    return repos
+
+@functools.lru_cache()
+def get_tarball_manifest(refresh=False):
+    """ Returns the TarballManifest, or an empty one if it cannot be loaded,
+        in which case no REL branches of extensions are tagged. """
+    try:
+        return TarballManifest.load(os.path.join(clients.cache_dir(), 'tarball.json'), refresh=refresh)
+    except Exception:
+        logger.warning("Unable to load the tarball manifest", exc_info=True)
+        return TarballManifest([])
 
 
 @functools.lru_cache()
+def get_slug_PHID_map():
+    return SlugPHIDMap(os.path.join(clients.cache_dir(), 'phids.json'))
+
+
 def get_slug_PHID(slug):
-    try:
-        rq = list(
-            phab.request('project.query', {'slugs': [slug]})['slugMap']
-                .values()
-        )
-    except AttributeError:
-        # If slugMap is empty, an empty list rather than an empty dict is
-        # returned by Phabricator.
-        raise Exception("No PHID found for slug #%s!" % slug)
-    if rq:
-        logging.debug(
-            "Slug {slug} = PHID {phid}".format(slug=slug, phid=rq[0])
-        )
-        return rq[0]
-    raise Exception("No PHID found for slug #%s!" % slug)
+    return get_slug_PHID_map().get(clients.phabricator(), slug)
 
 
 class SkipMailException(Exception):
     pass
 
 
-def process_mail(mail):
+def wanted_mail(headers, repos):
+    """ Decides, based on the mail headers only, whether a mail could lead to
+        an action. Mails rejected here would be skipped by process_mail()
+        anyway, so their body does not need to be parsed. """
+    if headers.get('X-Gerrit-MessageType', '') != 'merged':
+        return False
+    # Older Gerrit versions only mention the project in the footer
+    proj = headers.get('X-Gerrit-Project')
+    if proj is not None and proj not in repos:
+        return False
+    return True
+
+
+def process_mail(mail, repos=None, tarball=None):
+    """ Turns a parsed Gerrit mail into an action dict. repos is the
+        RepositoryRegistry to check the project against; it is loaded (once)
+        if not given. tarball is the TarballManifest of the repositories
+        whose REL branches are tagged; if not given, only those of core are.
+        """
+    if repos is None:
+        repos = get_repos_to_watch()
+
     proj = mail.get('Gerrit-Project', '')
-    if proj not in get_repos_to_watch():
+    if proj not in repos:
         raise SkipMailException("Project %s is not being watched" % proj)
     if mail.get('X-Gerrit-MessageType', '') != 'merged':
         raise SkipMailException('Not a merge email')
@@ -117,17 +230,19 @@ def process_mail(mail):
         raise SkipMailException(e)
 
     logger.info("Processing " + mail['X-Gerrit-ChangeURL'][1:-1])
+    if taskbranches[0].startswith('wmf/'):
+        # a merge on a newer wmf branch invalidates the cached newest branch
+        get_branch_cache().seen(get_branch_repository(proj), taskbranches[0])
     if taskbranches == ['master']:
         taskbranches = get_master_branches(proj)
 
-    if proj != 'mediawiki/core':
-        # Remove any REL1_XX branches for now since we don't know if this
-        # extension is included in the tarball.
-        for taskbranch in taskbranches[:]:
-            if taskbranch.startswith('REL'):
-                taskbranches.remove(taskbranch)
+    if proj != 'mediawiki/core' and any(b.startswith('REL') for b in taskbranches):
+        # REL1_XX branches of extensions are only tagged if the extension is
+        # included in the tarball.
+        if tarball is None or proj not in tarball:
+            taskbranches = [b for b in taskbranches if not b.startswith('REL')]
 
-    slugs = slugify(taskbranches)
+    slugs = releasetrain.slugify(taskbranches)
 
     return {
         'url': mail['X-Gerrit-ChangeURL'][1:-1],
@@ -137,103 +252,384 @@ def process_mail(mail):
     }
 
 
-def main():
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s: %(levelname)-8s - %(message)s'
-    )
-
-    # logger.info("Current master branches are: %r" % (get_master_branches(),))
+def process_mails(mails, repos, tarball=None):
+    """ Turns a batch of parsed Gerrit mails into a list of action dicts,
+        skipping the mails that do not need one. """
+    # look up the branches of all repositories with merges on master at once
+    with metrics.phase('resolve_branches'):
+        prefetch_wmf_branches(
+            get_branch_repository(mail['Gerrit-Project'])
+            for mail in mails
+            if mail.get('Gerrit-Branch') == 'master' and mail.get('Gerrit-Project', '') in repos
+        )
 
+    actions = []
+    with metrics.phase('process_mails'):
+        for mail in mails:
+            try:
+                action = process_mail(mail, repos, tarball)
+                actions.append(action)
+                logger.info(
+                    ("{url}: merged in branch {branch}, Task {task}," +
+                     " needs slugs {slugs}").format(**action)
+                )
+            except SkipMailException as e:
+                logger.debug("%s: skipping (%r)" % (mail['X-Gerrit-ChangeURL'], e))
+                pass
+    return actions
+
+
+def ingest(spool, repos, tarball=None):
+    """ Reads Gerrit mails from the mailbox and adds the resulting actions to
+        the spool. Mails are only deleted once their actions are spooled. """
     import pop3bot
-    mailbox = pop3bot.mkmailbox()
+    with metrics.phase('connect_mailbox'):
+        if getattr(config, 'MAIL_PROTOCOL', 'pop3') == 'imap':
+            import imapbot
+            mailbox = imapbot.mkmailbox()
+        else:
+            mailbox = pop3bot.mkmailbox()
 
     nmails, octets = mailbox.stat()
 
     logger.info("%i e-mails to process (%i kB)" % (nmails, octets/1024))
 
-    actions = []
-
-    for i, mail in enumerate(pop3bot.gerritmail_generator(mailbox)):
-        try:
-            action = process_mail(mail)
-            actions.append(action)
-            logger.info(
-                ("{url}: merged in branch {branch}, Task {task}," +
-                 " needs slugs {slugs}").format(**action)
-            )
-        except SkipMailException as e:
-            logger.debug("%s: skipping (%r)" % (mail['X-Gerrit-ChangeURL'], e))
-            pass
-
-        if i > 500:
-            break
-
-    # after parsing all entries, make sure we only do a single edit per Task.
-    def key(x):
-        return x['task']
-
-    for task, acts in itertools.groupby(sorted(actions, key=key), key=key):
-        acts = sorted(acts, key=lambda x: x['slugs'])
-
-        add_PHIDs = set()
-        add_slugs = set()
+    mails = []
+    fetched = []
+
+    max_mails = getattr(config, 'MAX_MAILS', 500)
+    accept = functools.partial(wanted_mail, repos=repos)
+    with metrics.phase('read_mails'):
+        for i, mail in enumerate(pop3bot.gerritmail_generator(mailbox, fetched, accept)):
+            mails.append(mail)
+            if i > max_mails:
+                break
+
+    actions = process_mails(mails, repos, tarball)
+    get_branch_cache().save()
+
+    with metrics.phase('spool'):
+        added = spool.put(actions)
+    logger.info("Spooled %i new actions from %i e-mails" % (added, len(fetched)))
+
+    with metrics.phase('delete_mails'):
+        pop3bot.delete_mails(mailbox, fetched)
+        mailbox.quit()
+
+
+def ingest_gerrit(spool, repos, tarball=None):
+    """ Queries Gerrit for the changes merged since the last run, instead of
+        reading notification mails, and adds the resulting actions to the
+        spool. The checkpoint is only moved forward once they are spooled. """
+    checkpoint = Checkpoint(os.path.join(clients.cache_dir(), 'gerrit_checkpoint.json'))
+    since = checkpoint.since
+    if since is None:
+        since = time.time() - getattr(config, 'GERRIT_INITIAL_LOOKBACK', gerritsource.DEFAULT_LOOKBACK)
+    logger.info("Requesting changes merged since %s" % gerritsource.format_timestamp(since))
+
+    mails = []
+    newest = since
+    nchanges = 0
+    with metrics.phase('read_changes'):
+        for mail, submitted in gerritsource.merged_changes(clients.gerrit(), since):
+            nchanges += 1
+            newest = max(newest, submitted)
+            if wanted_mail(mail, repos):
+                mails.append(mail)
+
+    actions = process_mails(mails, repos, tarball)
+
+    get_branch_cache().save()
+
+    with metrics.phase('spool'):
+        added = spool.put(actions)
+    logger.info("Spooled %i new actions from %i changes" % (added, nchanges))
+
+    checkpoint.advance(newest)
+    checkpoint.save()
+
+
+def handle_events(spool, ledger, events, verify=False):
+    """ Spools the actions for the change-merged events in events, and tags
+        the tasks right away. With verify, the events are only used to find
+        the changes, which are then read from Gerrit. """
+    repos = get_repos_to_watch()
+    tarball = get_tarball_manifest()
+    if verify:
+        mails = gerritsource.verified_mails(clients.gerrit(), events)
+    else:
+        mails = [
+            gerritsource.event_to_mail(event) for event in events
+            if event.get('type') == 'change-merged'
+        ]
+    mails = [mail for mail in mails if wanted_mail(mail, repos)]
+    actions = process_mails(mails, repos, tarball)
+    get_branch_cache().save()
+
+    added = spool.put(actions)
+    logger.info("Spooled %i new actions from %i events" % (added, len(events)))
+    # this also retries actions left pending by an earlier batch
+    tag(spool, ledger)
+
+
+def run_daemon(spool, ledger, source):
+    """ Processes change-merged events from the SSH stream-events feed
+        (source 'ssh') or the webhooks plugin (source 'webhook') as they
+        arrive, until interrupted. Events are handled in small batches, so a
+        task with several merges in quick succession is only edited once. """
+    import eventstream
+
+    events = queue.Queue()
+    stop = threading.Event()
+    if source == 'ssh':
+        eventstream.start_ssh_reader(events, eventstream.ssh_command(
+            getattr(config, 'GERRIT_SSH_HOST', 'gerrit.wikimedia.org'),
+            user=getattr(config, 'GERRIT_SSH_USER', None),
+            port=getattr(config, 'GERRIT_SSH_PORT', eventstream.GERRIT_SSH_PORT),
+        ), stop)
+    else:
+        server = eventstream.WebhookServer(
+            getattr(config, 'WEBHOOK_ADDRESS', eventstream.DEFAULT_WEBHOOK_ADDRESS),
+            events,
+            secret=getattr(config, 'WEBHOOK_SECRET', None),
+        )
+        server.start()
+        logger.info("Listening for webhook events on %s:%i" % server.server_address[:2])
 
-        # build changes
-        for act in acts:
-            for slug in act['slugs']:
-                add_slugs.add(slug)
-                add_PHIDs.add(get_slug_PHID(slug))
+    repos_loaded = time.monotonic()
+    try:
+        for batch in eventstream.batches(
+            events,
+            max_size=getattr(config, 'DAEMON_BATCH_SIZE', 100),
+            max_delay=getattr(config, 'DAEMON_BATCH_DELAY', 5.0),
+        ):
+            # pick up changes to the list of watched repositories
+            if time.monotonic() - repos_loaded > repositories.DEFAULT_TTL:
+                get_repos_to_watch.cache_clear()
+                get_tarball_manifest.cache_clear()
+                repos_loaded = time.monotonic()
+            try:
+                with metrics.phase('handle_events'):
+                    # webhook events are not authenticated by Gerrit
+                    handle_events(spool, ledger, batch, verify=(source == 'webhook'))
+            except Exception:
+                # the actions stay in the spool, and are retried with the
+                # next batch
+                logger.exception("Failed to handle %i events" % len(batch))
+            clients.save_gerrit_cache()
+    finally:
+        stop.set()
+
+
+def tag_tasks(task_slugs, spool, ledger, executor, update_mode):
+    """ Adds the release tags for one batch of tasks, task_slugs mapping task
+        IDs to the slugs they need, except those the ledger knows to be
+        applied already. """
+    applied = ledger.applied(task_slugs)
+    todo = {task: slugs - applied.get(task, set()) for (task, slugs) in task_slugs.items()}
+    todo = {task: slugs for (task, slugs) in todo.items() if slugs}
+    if len(todo) < len(task_slugs):
+        logger.info("Skipping %i tasks that were tagged before" % (len(task_slugs) - len(todo)))
+
+    # resolve the PHIDs of all slugs we need in one go
+    with metrics.phase('resolve_slugs'):
+        get_slug_PHID_map().resolve(clients.phabricator(), itertools.chain.from_iterable(todo.values()))
+
+    # the aggregator already made sure we only do a single edit per Task.
+    updates = []
+    unknown = {}
+    for task, slugs in sorted(todo.items()):
+        slug_PHIDs = {}
+        for slug in sorted(slugs):
+            try:
+                slug_PHIDs[slug] = get_slug_PHID(slug)
+            except UnknownSlugException:
+                # the tag for a new train may not have been created yet
+                unknown.setdefault(slug, set()).add(task)
+        if not slug_PHIDs:
+            continue
 
+        add_PHIDs = set(slug_PHIDs.values())
         description = "https://phabricator.wikimedia.org/T{task}: adding tags {slugs} -> PHIDs {PHIDs}".format(
-            slugs=add_slugs, PHIDs=add_PHIDs, task=task
+            slugs=set(slug_PHIDs), PHIDs=add_PHIDs, task=task
         )
+        updates.append((task, slug_PHIDs, description))
+
+    # now we get the tasks to know what the existing tags are
+    if update_mode != 'blind':
+        with metrics.phase('prefetch_tasks'):
+            task_projects = get_task_projects(clients.phabricator(), [task for (task, _, _) in updates])
+
+    jobs = []
+    complete = set()
+    for task, slug_PHIDs, description in updates:
         logger.info(description)
+        add_PHIDs = set(slug_PHIDs.values())
 
-        # now we get the task to know what the existing tags are
-        try:
-            task_info = phab.request('maniphest.info', {'task_id': str(task)})
-        except legophab.PhabricatorException as e:
+        if update_mode == 'blind':
+            old_projs = None
+        elif task not in task_projects:
             # Security bug? T101133
             logger.error(description)
-            logger.error('Unable to get information about T%i, maybe it is private?', task, exc_info=e)
+            logger.error('Unable to get information about T%i, maybe it is private?', task)
             continue
+        else:
+            old_projs = task_projects[task]
+            logger.debug("Existing PHIDs: {old_projs}".format(old_projs=old_projs))
 
-        old_projs = set(task_info['projectPHIDs'])
-        logger.debug("Existing PHIDs: {old_projs}".format(old_projs=old_projs))
-        new_projs = set(task_info['projectPHIDs']) | add_PHIDs
-        if old_projs != new_projs:
-            try:
-                phab.request('maniphest.update', {
-                    'id': str(task),
-                    'projectPHIDs': list(new_projs),
-                })
-            except legophab.PhabricatorException as e:
-                logger.error(description)
-                logger.error('Unable to update T%i, maybe it is read-only?', task, exc_info=e)
-                continue
+        job = update_job(task, add_PHIDs, description, old_projs, mode=update_mode)
+        if job:
+            jobs.append(job)
         else:
+            complete.add(task)
             logging.info(
                 "Skipping T{task}; no new projects to add".format(task=task)
             )
 
-    mailbox.quit()
+    with metrics.phase('update_tasks'):
+        updated = executor.run(jobs)
+    logger.info("Updated %i of %i tasks" % (len(updated), len(jobs)))
+
+    for task, slug_PHIDs, _ in updates:
+        if task in updated or task in complete:
+            ledger.record(task, slug_PHIDs)
+
+    # Failed updates have been logged as errors; retrying them in the next
+    # run would not help, as the task is private or read-only. Slugs without
+    # a project are left pending, and tried again in the next run, until
+    # they have been pending for UNKNOWN_SLUG_MAX_AGE seconds.
+    max_age = getattr(config, 'UNKNOWN_SLUG_MAX_AGE', UNKNOWN_SLUG_MAX_AGE)
+    created = spool.created((task, slug) for (slug, slug_tasks) in unknown.items() for task in slug_tasks)
+    now = time.time()
+    pending = {}
+    for slug, slug_tasks in sorted(unknown.items()):
+        expired = {task for task in slug_tasks if now - created.get((task, slug), now) > max_age}
+        if expired:
+            logger.error("No project for slug #%s after %i days, not adding it to %i tasks (e.g. T%i)",
+                         slug, max_age // (24 * 60 * 60), len(expired), min(expired))
+        if slug_tasks - expired:
+            pending[slug] = slug_tasks - expired
+            logger.warning("No project for slug #%s yet, leaving it pending for %i tasks (e.g. T%i)",
+                           slug, len(pending[slug]), min(pending[slug]))
+    spool.complete([
+        {'task': task, 'slugs': sorted(slug for slug in slugs if task not in pending.get(slug, ()))}
+        for (task, slugs) in task_slugs.items()
+    ])
+
+
+def tag(spool, ledger):
+    """ Adds the release tags for all pending actions in the spool. Actions
+        are grouped per task as they are read, and tagged in batches of
+        TAG_BATCH_TASKS tasks. """
+    import updater
+    executor = updater.UpdateExecutor(
+        clients.phabricator(),
+        max_workers=getattr(config, 'PHAB_UPDATE_WORKERS', updater.DEFAULT_WORKERS),
+        rate=getattr(config, 'PHAB_UPDATE_RATE', updater.DEFAULT_RATE),
+    )
+    aggregator = TaskAggregator(
+        functools.partial(
+            tag_tasks, spool=spool, ledger=ledger, executor=executor,
+            update_mode=getattr(config, 'PHAB_UPDATE_MODE', tasks.DEFAULT_UPDATE_MODE),
+        ),
+        max_tasks=getattr(config, 'TAG_BATCH_TASKS', tasks.DEFAULT_BATCH_TASKS),
+        max_age=getattr(config, 'TAG_BATCH_SECONDS', tasks.DEFAULT_BATCH_SECONDS),
+    )
+
+    npending = 0
+    for action in spool.iter_pending():
+        npending += 1
+        aggregator.add(action)
+    aggregator.flush()
+    logger.info("Processed %i pending actions from the spool" % npending)
+
+    spool.prune(getattr(config, 'SPOOL_RETENTION', DEFAULT_SPOOL_RETENTION))
+    ledger.prune(
+        trains=getattr(config, 'LEDGER_TRAINS', DEFAULT_LEDGER_TRAINS),
+        retention=getattr(config, 'LEDGER_RETENTION', DEFAULT_LEDGER_RETENTION),
+    )
+
+
+def main(refresh_repos=False, stage='all', source=None, daemon=None, logfile=None):
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s: %(levelname)-8s - %(message)s'
+    )
+    if logfile:
+        # error_email_k8s only attaches the log from here on
+        write_run_start(logfile)
+
+    # logger.info("Current master branches are: %r" % (get_master_branches(),))
+
+    spool = Spool(getattr(config, 'SPOOL_PATH', os.path.join(clients.cache_dir(), 'spool.sqlite3')))
+    ledger = Ledger(getattr(config, 'LEDGER_PATH', os.path.join(clients.cache_dir(), 'ledger.sqlite3')))
+
+    if daemon:
+        try:
+            run_daemon(spool, ledger, daemon)
+        finally:
+            spool.close()
+            ledger.close()
+            clients.save_gerrit_cache()
+        return
+
+    if stage in ('all', 'ingest'):
+        with metrics.phase('load_repositories'):
+            repos = get_repos_to_watch(refresh=refresh_repos)
+            tarball = get_tarball_manifest(refresh=refresh_repos)
+        logger.info("Watching %i repositories, %i of which are in the tarball" % (
+            len(repos), sum(1 for repo in repos if repo in tarball)))
+        if source is None:
+            source = getattr(config, 'INGEST_SOURCE', 'mail')
+        with metrics.phase('ingest'):
+            if source == 'gerrit':
+                ingest_gerrit(spool, repos, tarball)
+            else:
+                ingest(spool, repos, tarball)
+
+    if stage in ('all', 'tag'):
+        with metrics.phase('tag'):
+            tag(spool, ledger)
+
+    spool.close()
+    ledger.close()
+    clients.save_gerrit_cache()
+
+
+def write_run_summary(logfile, prometheus_textfile=None):
+    """ Writes the metrics of this run as JSON next to the log file, and
+        optionally as a Prometheus textfile. """
+    try:
+        if logfile:
+            path = os.path.join(os.path.dirname(os.path.abspath(logfile)), 'forrestbot-run.json')
+            metrics.write_json(path)
+            logger.info("Wrote run summary to %s" % path)
+        if prometheus_textfile:
+            metrics.write_prometheus(prometheus_textfile)
+    except OSError:
+        logger.warning("Unable to write run summary", exc_info=True)
 
 
 if __name__ == "__main__":
+    logging.getLogger().addHandler(errorAggregator)
+    logging.getLogger('requests').setLevel(logging.INFO)
+
+    # make sure the run summary is written when timeout(1) stops us
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit("Terminated by SIGTERM"))
+
     try:
-        main()
+        main(refresh_repos=args.refresh_repos, stage=args.stage, source=args.source, daemon=args.daemon,
+             logfile=args.logfile)
     except Exception:
         logger.exception("Releasetaggerbot crashed while processing messages")
         raise
     finally:
-        if not errorQueue.empty():
-            errorQueue.put(None)
+        write_run_summary(args.logfile, args.prometheus_textfile)
+        if errorAggregator.total:
             errlogger = logging.getLogger('errorsummary')
             errlogger.info("[ ERROR SUMMARY ]".center(80, "-"))
-            errlogger.info("Releasetaggerbot reported the following errors during execution:")
-            error_dumper = logging.StreamHandler(sys.stdout)
-            for error in iter(errorQueue.get, None):
-                errlogger.info(error.getMessage())
+            errlogger.info("Releasetaggerbot reported %i errors during execution:" % errorAggregator.total)
+            for line in errorAggregator.summary():
+                errlogger.info(line)
             errlogger.info("-"*80)
             raise Exception("Forrestbot finished with Errors logged.")
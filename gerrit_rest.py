@@ -1,22 +1,148 @@
+import asyncio
+import collections
 import json
+import logging
+import os
+import re
+import threading
+import time
 import requests
+import requests.adapters
+from urllib3.util.retry import Retry
 
-requests.adapters.DEFAULT_RETRIES = 5
+from instrumentation import metrics
+from wblogging import private_open
+
+logger = logging.getLogger('gerrit_rest')
+
+# (connect, read) timeout in seconds
+DEFAULT_TIMEOUT = (10, 60)
+DEFAULT_RETRIES = 5
+DEFAULT_POOL_SIZE = 10
+# number of requests AsyncGerritREST has in flight at the same time
+DEFAULT_CONCURRENCY = 8
+
+# Gerrit prefixes all JSON responses with this to prevent XSSI
+XSSI_PREFIX = ")]}'"
+# number of results per request for iter_changes() and iter_branches()
+DEFAULT_PAGE_SIZE = 100
+
+
+class GerritRESTError(Exception):
+    def __init__(self, message, status_code=None, url=None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.url = url
+
+
+def _endpoint_name(name):
+    """ Strips the project name from an endpoint, so the metrics of e.g.
+        all /projects/{project}/branches/ calls are combined. """
+    return re.sub(r'^projects/[^/]+', 'projects/{project}', name)
+
+
+class ResponseCache(object):
+    def __init__(self, maxsize=256, ttls=None, path=None):
+        """ LRU cache of Gerrit responses for GerritREST. Responses with an
+            ETag or Last-Modified header are revalidated with a conditional
+            request; a 304 response is then served from the cache.
+
+            Parameters:
+              * maxsize - maximum number of responses to keep
+              * ttls - dict mapping endpoint names (as used in the metrics,
+                e.g. 'projects/{project}/branches') to the number of seconds
+                a response may be used without asking Gerrit at all. This
+                is mostly useful for endpoints without validators.
+              * path - if given, the cache is loaded from and save()d to this
+                JSON file
+        """
+        self._maxsize = maxsize
+        self._ttls = dict(ttls or {})
+        self._path = path
+        self._entries = collections.OrderedDict()
+        self._dirty = False
+        self._lock = threading.Lock()
+        if path:
+            try:
+                with open(path, encoding='utf-8') as f:
+                    self._entries.update(json.load(f))
+            except FileNotFoundError:
+                pass
+            except ValueError as e:
+                logger.warning("Ignoring corrupt cache file %s (%r)", path, e)
+
+    def ttl(self, endpoint):
+        return self._ttls.get(endpoint, 0)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._maxsize:
+                self._entries.popitem(last=False)
+            self._dirty = True
+
+    def save(self):
+        """ Atomically writes the cache to path, if it was changed. """
+        if not self._path or not self._dirty:
+            return
+        directory = os.path.dirname(self._path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp = self._path + '.tmp'
+        with self._lock:
+            with open(tmp, 'w', encoding='utf-8', opener=private_open) as f:
+                json.dump(self._entries, f)
+            self._dirty = False
+        os.replace(tmp, self._path)
 
 
 class GerritREST(object):
-    def __init__(self, url):
+    def __init__(self, url, timeout=DEFAULT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 pool_maxsize=DEFAULT_POOL_SIZE, cache=None):
         """ Basic wrapper around the Gerrit REST API. Takes care of
             connections and JSON-decoding. Currently only GET requests
             are supported.
 
             Parameters:
               * URL - The base URL, e.g. https://gerrit.wikimedia.org/r
+              * timeout - (connect, read) timeout in seconds
+              * retries - number of times to retry a request after a
+                connection error or a 429/5xx response, with exponential
+                backoff
+              * pool_maxsize - number of connections to keep open, for use
+                from multiple threads
+              * cache - an optional ResponseCache
         """
         self._url = url.rstrip('/')
+        self._timeout = timeout
+        self._cache = cache
         self._session = requests.Session()
         self._session.headers.update({'Accept': 'application/json'})
 
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_maxsize,
+            max_retries=Retry(
+                total=retries,
+                backoff_factor=0.5,
+                status_forcelist=(429, 500, 502, 503, 504),
+                allowed_methods=frozenset(['GET', 'HEAD']),
+                # return the last response instead of raising, so it ends
+                # up in a GerritRESTError
+                raise_on_status=False,
+            ),
+        )
+        self._session.mount('https://', adapter)
+        self._session.mount('http://', adapter)
+
     def _request(self, name, **kwargs):
         """ Make a request.
 
@@ -26,9 +152,69 @@ class GerritREST(object):
             * any parameters taken by the REST endpoint (via kwargs)
         """
         kwargs = {k: v for (k, v) in kwargs.items() if v is not None}
-        r = self._session.get(self._url + '/%s/' % name, params=kwargs)
-        realjson = r.text[5:]  # strips anti-XSS prefix
-        return json.loads(realjson)
+        endpoint = _endpoint_name(name)
+        url = self._url + '/%s/' % name
+
+        headers = {}
+        entry = None
+        if self._cache is not None:
+            key = requests.Request('GET', url, params=kwargs).prepare().url
+            entry = self._cache.get(key)
+            if entry is not None:
+                if entry['expires'] > time.time():
+                    metrics.observe('gerrit-cache', endpoint, 0)
+                    return self._loads(entry['text'], key)
+                if entry['etag']:
+                    headers['If-None-Match'] = entry['etag']
+                if entry['last_modified']:
+                    headers['If-Modified-Since'] = entry['last_modified']
+
+        with metrics.timed('gerrit', endpoint):
+            r = self._session.get(url, params=kwargs, headers=headers, timeout=self._timeout)
+        metrics.add_bytes('gerrit', endpoint, len(r.content))
+
+        if r.status_code == 304 and entry is not None:
+            text = entry['text']
+        else:
+            text = self._check(r)
+
+        if self._cache is not None:
+            etag = r.headers.get('ETag', entry and entry['etag'])
+            last_modified = r.headers.get('Last-Modified', entry and entry['last_modified'])
+            ttl = self._cache.ttl(endpoint)
+            if etag or last_modified or ttl:
+                self._cache.put(key, {
+                    'text': text,
+                    'etag': etag,
+                    'last_modified': last_modified,
+                    'expires': time.time() + ttl,
+                })
+        return self._loads(text, r.url)
+
+    @staticmethod
+    def _check(r):
+        """ Returns the text of r. Raises GerritRESTError for error responses
+            and non-JSON bodies. """
+        if r.status_code >= 400:
+            raise GerritRESTError(
+                "Gerrit returned HTTP %i for %s: %s" % (r.status_code, r.url, r.text[:200]),
+                status_code=r.status_code, url=r.url
+            )
+        if not r.text.startswith(XSSI_PREFIX):
+            raise GerritRESTError(
+                "Gerrit returned a non-JSON response for %s: %s" % (r.url, r.text[:200]),
+                status_code=r.status_code, url=r.url
+            )
+        return r.text
+
+    @staticmethod
+    def _loads(text, url):
+        """ Strips the anti-XSS prefix and decodes the JSON in text. """
+        realjson = text[5:]  # strips anti-XSS prefix
+        try:
+            return json.loads(realjson)
+        except ValueError as e:
+            raise GerritRESTError("Unable to decode JSON response for %s: %r" % (url, e), url=url)
 
     def __getattr__(self, name):
         """ Provides access to any APIs not yet implemented """
@@ -74,4 +260,124 @@ class GerritREST(object):
             r=r
         )
 
+    def iter_changes(self, q="", o=[], page_size=DEFAULT_PAGE_SIZE):
+        """ Iterates over all changes matching q, requesting page_size
+            changes at a time and following Gerrit's _more_changes flag with
+            the S (skip) parameter. Pages are only requested when the
+            previous one has been consumed, so callers can stop early.
+
+            Parameters:
+            * q - the query string,
+            * o - the list of options to pass,
+            * page_size - the number of changes to request at a time. """
+        start = 0
+        while True:
+            page = self._request('changes', q=q, n=page_size, o=o, S=start or None)
+            yield from page
+            if not page or not page[-1].get('_more_changes'):
+                return
+            start += len(page)
+
+    def iter_branches(self, project, m=None, r=None, page_size=DEFAULT_PAGE_SIZE):
+        """ Iterates over the branches of project, requesting page_size
+            branches at a time with the s (skip) and n parameters.
+
+            Parameters:
+            * project - the URL-encoded project name,
+            * m - only return branches containing this substring,
+            * r - only return branches matching this regex, e.g. 'wmf/.*'.
+              The regex is matched against the branch name without the
+              'refs/heads/' prefix,
+            * page_size - the number of branches to request at a time. """
+        start = 0
+        while True:
+            page = self.branches(project, n=page_size, s=start or None, m=m, r=r)
+            yield from page
+            if len(page) < page_size:
+                return
+            start += len(page)
+
     # def accounts, def groups, def projects, etc.
+
+
+class AsyncGerritREST(object):
+    def __init__(self, url, concurrency=DEFAULT_CONCURRENCY, **kwargs):
+        """ asyncio variant of GerritREST, with the same API, but with
+            coroutines. At most concurrency requests are in flight at the same
+            time.
+
+            Requests are made by a GerritREST instance on worker threads, so
+            connection pooling, retries, caching and the anti-XSS prefix
+            handling are shared with the synchronous client.
+
+            Parameters:
+              * url - the base URL of the Gerrit instance
+              * concurrency - maximum number of concurrent requests
+              * any other arguments are passed to GerritREST
+        """
+        kwargs.setdefault('pool_maxsize', max(concurrency, DEFAULT_POOL_SIZE))
+        self._gerrit = GerritREST(url, **kwargs)
+        self._concurrency = concurrency
+        self._semaphores = {}
+
+    def _semaphore(self):
+        # a semaphore is bound to the event loop it is first used in
+        loop = asyncio.get_running_loop()
+        if loop not in self._semaphores:
+            self._semaphores[loop] = asyncio.BoundedSemaphore(self._concurrency)
+        return self._semaphores[loop]
+
+    async def _request(self, name, **kwargs):
+        """ Make a request; see GerritREST._request. """
+        async with self._semaphore():
+            return await asyncio.to_thread(self._gerrit._request, name, **kwargs)
+
+    def __getattr__(self, name):
+        """ Provides access to any APIs not yet implemented """
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        async def wrapper(**kwargs):
+            return await self._request(name, **kwargs)
+        wrapper.__name__ = name
+        return wrapper
+
+    async def changes(self, q="", n=25, o=[]):
+        """ Submits a request to the /changes/ REST API; see
+            GerritREST.changes. """
+        return await self._request('changes', q=q, n=n, o=o)
+
+    async def branches(self, project, n=None, s=None, m=None, r=None):
+        """ Submits a request to the /project/{name}/branches/ REST API; see
+            GerritREST.branches. """
+        return await self._request(
+            'projects/{project}/branches'.format(project=project),
+            n=n,
+            s=s,
+            m=m,
+            r=r
+        )
+
+    async def iter_changes(self, q="", o=[], page_size=DEFAULT_PAGE_SIZE):
+        """ Asynchronously iterates over all changes matching q; see
+            GerritREST.iter_changes. """
+        start = 0
+        while True:
+            page = await self._request('changes', q=q, n=page_size, o=o, S=start or None)
+            for change in page:
+                yield change
+            if not page or not page[-1].get('_more_changes'):
+                return
+            start += len(page)
+
+    async def iter_branches(self, project, m=None, r=None, page_size=DEFAULT_PAGE_SIZE):
+        """ Asynchronously iterates over the branches of project; see
+            GerritREST.iter_branches. """
+        start = 0
+        while True:
+            page = await self.branches(project, n=page_size, s=start or None, m=m, r=r)
+            for branch in page:
+                yield branch
+            if len(page) < page_size:
+                return
+            start += len(page)
@@ -0,0 +1,156 @@
+import calendar
+import logging
+import time
+
+from cache import JSONCache
+
+logger = logging.getLogger('gerritsource')
+
+GERRIT_URL = 'https://gerrit.wikimedia.org/r'
+# CURRENT_COMMIT includes the commit message, for the Bug: footers
+CHANGE_OPTIONS = ['CURRENT_REVISION', 'CURRENT_COMMIT']
+# how far to look back on the first run, in seconds
+DEFAULT_LOOKBACK = 24 * 60 * 60
+
+_FOOTER_PREFIXES = ('Bug: ', 'Task: ', 'Closes: ')
+
+
+def format_timestamp(timestamp):
+    """ Formats a unix timestamp for use in a Gerrit query.
+
+        >>> format_timestamp(1580000000)
+        '2020-01-26 00:53:20'
+    """
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(timestamp))
+
+
+def parse_timestamp(timestamp):
+    """ Parses a Gerrit timestamp (UTC, with nanoseconds) into a unix
+        timestamp.
+
+        >>> parse_timestamp('2020-01-26 00:53:20.000000000')
+        1580000000
+    """
+    return calendar.timegm(time.strptime(timestamp[:19], '%Y-%m-%d %H:%M:%S'))
+
+
+def parse_footers(message):
+    """ Returns the Bug, Task and Closes footers of a commit message as a
+        dict. As for mails, the last one wins if a footer is repeated.
+
+        >>> parse_footers('Fix it\\n\\nBug: T1\\nBug: T2\\nChange-Id: I00\\n')
+        {'Bug': 'T2'}
+    """
+    footers = {}
+    for line in message.split('\n'):
+        if line.startswith(_FOOTER_PREFIXES):
+            key, value = line.split(': ', 1)
+            footers[key] = value.rstrip()
+    return footers
+
+
+def change_to_mail(change, gerrit_url=GERRIT_URL):
+    """ Turns a change from the /changes/ API, requested with CHANGE_OPTIONS,
+        into the dict that extract_gerrit_data() would have returned for its
+        'merged' notification mail, so it can be passed to process_mail(). """
+    mail = {
+        'X-Gerrit-MessageType': 'merged',
+        'X-Gerrit-Change-Id': change['change_id'],
+        'X-Gerrit-Change-Number': str(change['_number']),
+        'X-Gerrit-ChangeURL': '<%s/%i>' % (gerrit_url, change['_number']),
+        'X-Gerrit-Project': change['project'],
+        'Gerrit-Project': change['project'],
+        'Gerrit-Branch': change['branch'],
+        'Gerrit-MessageType': 'merged',
+    }
+    revision = change.get('revisions', {}).get(change.get('current_revision'), {})
+    mail.update(parse_footers(revision.get('commit', {}).get('message', '')))
+    return mail
+
+
+def event_to_mail(event):
+    """ Turns a change-merged event, as sent by stream-events or the webhooks
+        plugin, into the dict that extract_gerrit_data() would have returned
+        for its notification mail. """
+    change = event['change']
+    mail = {
+        'X-Gerrit-MessageType': 'merged',
+        'X-Gerrit-Change-Id': change['id'],
+        'X-Gerrit-Change-Number': str(change['number']),
+        'X-Gerrit-ChangeURL': '<%s>' % change['url'],
+        'X-Gerrit-Project': change['project'],
+        'Gerrit-Project': change['project'],
+        'Gerrit-Branch': change['branch'],
+        'Gerrit-MessageType': 'merged',
+    }
+    mail.update(parse_footers(change.get('commitMessage', '')))
+    return mail
+
+
+def verified_mails(gerrit, events):
+    """ Returns the mails for the change-merged events in events, like
+        event_to_mail(), but built from the changes as Gerrit's REST API
+        returns them, rather than from the events themselves. Changes that
+        are not merged are left out. Used for events from untrusted sources,
+        such as webhooks. """
+    numbers = set()
+    for event in events:
+        if event.get('type') != 'change-merged':
+            continue
+        try:
+            numbers.add(int(event['change']['number']))
+        except (KeyError, TypeError, ValueError):
+            logger.warning("Ignoring malformed change-merged event %r", event)
+    if not numbers:
+        return []
+    query = 'status:merged (%s)' % ' OR '.join('change:%i' % n for n in sorted(numbers))
+    mails = [change_to_mail(change) for change in gerrit.iter_changes(query, o=CHANGE_OPTIONS)]
+    if len(mails) < len(numbers):
+        logger.warning("Ignoring events for %i changes that are not merged", len(numbers) - len(mails))
+    return mails
+
+
+class Checkpoint(object):
+    def __init__(self, path):
+        """ Persisted high-water mark of the Gerrit changes that have been
+            ingested, as a unix timestamp of the last merge seen.
+
+            Parameters:
+              * path - the JSON file to keep the checkpoint in
+        """
+        self._cache = JSONCache(path)
+
+    @property
+    def since(self):
+        return self._cache.get('since')
+
+    def advance(self, timestamp):
+        """ Moves the checkpoint forward to timestamp; never backwards. """
+        if self.since is None or timestamp > self.since:
+            self._cache.set('since', timestamp)
+
+    def save(self):
+        self._cache.save()
+
+
+def merged_changes(gerrit, since, page_size=100):
+    """ Iterates over the changes merged since the unix timestamp since, as
+        (mail, submitted) tuples, where mail is the dict built by
+        change_to_mail() and submitted the unix timestamp of the merge.
+
+        The query uses mergedafter:, which matches on the time of the merge,
+        unlike since:, which also matches old changes that were commented
+        on or reindexed. Those would be tagged with the train that is next
+        now instead of the one they shipped in. Changes submitted before
+        since are skipped as well, in case the server disagrees. As the
+        operator is inclusive, the same change can be returned again in a
+        later run. """
+    query = 'status:merged mergedafter:"%s"' % format_timestamp(since)
+    logger.debug("Requesting changes matching %s", query)
+    for change in gerrit.iter_changes(query, o=CHANGE_OPTIONS, page_size=page_size):
+        submitted = parse_timestamp(change.get('submitted') or change['updated'])
+        if submitted < since:
+            logger.debug("Skipping change %i, which was merged before %s", change['_number'],
+                         format_timestamp(since))
+            continue
+        yield change_to_mail(change), submitted
@@ -0,0 +1,177 @@
+"""
+IMAP alternative to the POP3 mailbox of pop3bot. The server only returns the
+'merged' notifications, and IMAPMailbox makes them look like a POP3 mailbox
+that only contains those, so they can be read with
+pop3bot.gerritmail_generator() and deleted with pop3bot.delete_mails().
+"""
+import imaplib
+import logging
+import os
+import re
+
+import clients
+from cache import JSONCache
+from instrumentation import metrics
+
+logger = logging.getLogger('imapbot')
+
+# number of messages to request per UID FETCH
+DEFAULT_FETCH_SIZE = 100
+
+_FETCH_PARTS = '(UID BODY.PEEK[HEADER] BODY.PEEK[TEXT])'
+
+_message_re = re.compile(rb'^\d+ \(')
+_uid_re = re.compile(rb'UID (\d+)')
+_section_re = re.compile(rb'BODY\[(HEADER|TEXT)\] \{\d+\}$')
+
+
+def mkimapbox(debug=0):
+    config = clients.config
+    with metrics.timed('imap', 'connect'):
+        imap = imaplib.IMAP4_SSL(getattr(config, 'imaphost', 'imap.gmail.com'))
+        imap.debug = debug
+        imap.login(config.username, config.password)
+    return imap
+
+
+def uid_set(uids):
+    """ Formats a list of UIDs as an IMAP sequence set, with ranges.
+
+        >>> uid_set([1, 2, 3, 5, 7, 8])
+        '1:3,5,7:8'
+    """
+    ranges = []
+    for uid in sorted(uids):
+        if ranges and ranges[-1][1] == uid - 1:
+            ranges[-1][1] = uid
+        else:
+            ranges.append([uid, uid])
+    return ','.join(str(a) if a == b else '%i:%i' % (a, b) for (a, b) in ranges)
+
+
+def _check(typ, data):
+    if typ != 'OK':
+        raise imaplib.IMAP4.error("%s %r" % (typ, data))
+    return data
+
+
+def search_merged(imap, after=0):
+    """ Returns the sorted UIDs of the 'merged' notifications with a UID
+        larger than after. """
+    with metrics.timed('imap', 'SEARCH'):
+        data = _check(*imap.uid('SEARCH', 'HEADER', 'X-Gerrit-MessageType', 'merged', 'UID', '%i:*' % (after + 1)))
+    # n:* always matches the message with the highest UID, even if it is < n
+    return sorted(uid for uid in map(int, b' '.join(data).split()) if uid > after)
+
+
+def parse_fetch(data):
+    """ Parses the response to a UID FETCH of _FETCH_PARTS into a dict
+        mapping UIDs to dicts with the 'HEADER' and 'TEXT' sections. """
+    messages = {}
+    current = None
+    for item in data:
+        prefix, literal = item if isinstance(item, tuple) else (item, None)
+        if _message_re.match(prefix):
+            current = {}
+        if current is None:
+            continue
+        uid = _uid_re.search(prefix)
+        if uid:
+            messages[int(uid.group(1))] = current
+        section = _section_re.search(prefix)
+        if section and literal is not None:
+            current[section.group(1).decode('ascii')] = literal
+    return messages
+
+
+def fetch_many(imap, uids):
+    """ Returns a dict mapping each of uids to the mail as a list of byte
+        lines, like the ones returned by POP3 TOP, using a single UID FETCH.
+        """
+    with metrics.timed('imap', 'FETCH'):
+        data = _check(*imap.uid('FETCH', uid_set(uids), _FETCH_PARTS))
+    mails = {}
+    for uid, sections in parse_fetch(data).items():
+        raw = sections.get('HEADER', b'') + sections.get('TEXT', b'')
+        metrics.add_bytes('imap', 'FETCH', len(raw))
+        mails[uid] = raw.splitlines()
+    return mails
+
+
+class IMAPMailbox(object):
+    def __init__(self, imap, state_path, folder='INBOX', fetch_size=DEFAULT_FETCH_SIZE, expunge=False):
+        """ Presents the 'merged' notifications in an IMAP folder that have
+            not been processed yet as a POP3 mailbox (stat, top, dele, quit).
+            Mails are fetched in bulk, fetch_size at a time.
+
+            The highest UID that was dele()ted is remembered in state_path,
+            together with the UIDVALIDITY of the folder, and the next session
+            only looks at newer mails. Like with POP3, this only happens on
+            quit(). With expunge, the mails are also deleted from the folder.
+
+            Parameters:
+              * imap - a logged in imaplib.IMAP4 connection
+              * state_path - JSON file to keep the last processed UID in
+              * folder - the folder to read
+              * fetch_size - the number of mails to request at a time
+              * expunge - whether to delete processed mails
+        """
+        self._imap = imap
+        self._state = JSONCache(state_path)
+        self._fetch_size = fetch_size
+        self._expunge = expunge
+        self._buffer = {}
+        self._deleted = []
+
+        _check(*imap.select(folder))
+        self._uidvalidity = int(imap.response('UIDVALIDITY')[1][-1])
+        after = 0
+        if self._state.get('uidvalidity') == self._uidvalidity:
+            after = self._state.get('last_uid', 0)
+        else:
+            logger.info("Reading all of %s (UIDVALIDITY %i)", folder, self._uidvalidity)
+        self._uids = search_merged(imap, after)
+
+    def stat(self):
+        """ Returns the number of mails, and 0 as their size is not known
+            without fetching them. """
+        return len(self._uids), 0
+
+    def top(self, which, howmuch):
+        """ Returns the mail with number which (counting from 1), like
+            poplib.POP3.top. Requests the next fetch_size mails if it has
+            not been fetched yet. The whole mail is returned. """
+        uid = self._uids[which - 1]
+        if uid not in self._buffer:
+            self._buffer = fetch_many(self._imap, self._uids[which - 1:which - 1 + self._fetch_size])
+        lines = self._buffer.pop(uid, [])
+        return b'+OK', lines, sum(len(line) for line in lines)
+
+    def dele(self, which):
+        self._deleted.append(self._uids[which - 1])
+
+    def quit(self):
+        """ Records the processed mails, deletes them if expunge is set, and
+            logs out. """
+        if self._deleted:
+            if self._expunge:
+                with metrics.timed('imap', 'STORE'):
+                    _check(*self._imap.uid('STORE', uid_set(self._deleted), '+FLAGS', r'(\Deleted)'))
+                _check(*self._imap.expunge())
+            self._state.set('uidvalidity', self._uidvalidity)
+            self._state.set('last_uid', max(self._deleted))
+            self._state.save()
+        self._imap.logout()
+
+
+def mkmailbox(debug=0):
+    """ Connects to the IMAP server configured with imaphost, and returns an
+        IMAPMailbox with the unprocessed 'merged' notifications in
+        IMAP_FOLDER. """
+    config = clients.config
+    return IMAPMailbox(
+        mkimapbox(debug),
+        os.path.join(clients.cache_dir(), 'imap.json'),
+        folder=getattr(config, 'IMAP_FOLDER', 'INBOX'),
+        expunge=getattr(config, 'IMAP_EXPUNGE', False),
+    )
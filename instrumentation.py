@@ -0,0 +1,148 @@
+import contextlib
+import functools
+import json
+import logging
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+from wblogging import private_open
+
+logger = logging.getLogger('instrumentation')
+
+# upper bounds of the latency histogram buckets, in seconds
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, float('inf'))
+
+
+class Metrics(object):
+    def __init__(self):
+        """ Collects request counts, latency histograms and transferred bytes
+            per (service, endpoint), and the duration of each phase of a run.
+            Thread-safe, as Phabricator updates run on a thread pool. """
+        self._lock = threading.Lock()
+        self._endpoints = {}
+        self._phases = {}
+        self._started = time.time()
+
+    def _endpoint(self, service, endpoint):
+        key = (service, endpoint)
+        if key not in self._endpoints:
+            self._endpoints[key] = {
+                'count': 0,
+                'errors': 0,
+                'seconds': 0.0,
+                'bytes': 0,
+                'buckets': [0] * len(BUCKETS),
+            }
+        return self._endpoints[key]
+
+    def observe(self, service, endpoint, seconds, error=False):
+        """ Records one call to endpoint that took seconds. """
+        with self._lock:
+            stats = self._endpoint(service, endpoint)
+            stats['count'] += 1
+            stats['errors'] += bool(error)
+            stats['seconds'] += seconds
+            for n, bound in enumerate(BUCKETS):
+                if seconds <= bound:
+                    stats['buckets'][n] += 1
+                    break
+
+    def add_bytes(self, service, endpoint, nbytes):
+        with self._lock:
+            self._endpoint(service, endpoint)['bytes'] += nbytes
+
+    @contextlib.contextmanager
+    def timed(self, service, endpoint):
+        """ Context manager that observe()s the duration of its body. """
+        start = time.perf_counter()
+        error = True
+        try:
+            yield
+            error = False
+        finally:
+            self.observe(service, endpoint, time.perf_counter() - start, error)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """ Context manager that records the duration of a phase of the run. """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._phases[name] = self._phases.get(name, 0.0) + time.perf_counter() - start
+
+    def summary(self):
+        with self._lock:
+            return {
+                'started': self._started,
+                'duration': time.time() - self._started,
+                'phases': dict(self._phases),
+                'endpoints': [
+                    dict(stats, service=service, endpoint=endpoint,
+                         buckets=dict(zip(map(str, BUCKETS), stats['buckets'])))
+                    for ((service, endpoint), stats) in sorted(self._endpoints.items())
+                ],
+            }
+
+    def write_json(self, path):
+        with open(path, 'w', encoding='utf-8', opener=private_open) as f:
+            json.dump(self.summary(), f, indent=2)
+
+    def write_prometheus(self, path, prefix='forrestbot'):
+        """ Writes the metrics in the Prometheus text format, e.g. for the
+            node exporter's textfile collector. """
+        summary = self.summary()
+        lines = [
+            '# TYPE {p}_run_duration_seconds gauge'.format(p=prefix),
+            '{p}_run_duration_seconds {v}'.format(p=prefix, v=summary['duration']),
+            '# TYPE {p}_phase_duration_seconds gauge'.format(p=prefix),
+        ]
+        for name, seconds in sorted(summary['phases'].items()):
+            lines.append('{p}_phase_duration_seconds{{phase="{n}"}} {v}'.format(p=prefix, n=name, v=seconds))
+
+        lines.append('# TYPE {p}_request_duration_seconds histogram'.format(p=prefix))
+        for stats in summary['endpoints']:
+            labels = 'service="{service}",endpoint="{endpoint}"'.format(**stats)
+            cumulative = 0
+            for bound, count in stats['buckets'].items():
+                cumulative += count
+                le = '+Inf' if bound == 'inf' else bound
+                lines.append('{p}_request_duration_seconds_bucket{{{labels},le="{le}"}} {v}'.format(
+                    p=prefix, labels=labels, le=le, v=cumulative))
+            lines.append('{p}_request_duration_seconds_sum{{{labels}}} {v}'.format(
+                p=prefix, labels=labels, v=stats['seconds']))
+            lines.append('{p}_request_duration_seconds_count{{{labels}}} {v}'.format(
+                p=prefix, labels=labels, v=stats['count']))
+        for name in ('errors', 'bytes'):
+            lines.append('# TYPE {p}_request_{n}_total counter'.format(p=prefix, n=name))
+            for stats in summary['endpoints']:
+                lines.append('{p}_request_{n}_total{{service="{s}",endpoint="{e}"}} {v}'.format(
+                    p=prefix, n=name, s=stats['service'], e=stats['endpoint'], v=stats[name]))
+
+        # write to a temporary file first, as the collector may read at any time
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            f.write('\n'.join(lines) + '\n')
+        os.replace(path + '.tmp', path)
+
+
+metrics = Metrics()
+
+
+def instrument_phabricator(phab, metrics=metrics):
+    """ Records every phab.request() call, and the size of the responses. """
+    request = phab.request
+
+    @functools.wraps(request)
+    def wrapper(method, params=None):
+        with metrics.timed('phabricator', method):
+            return request(method, params)
+    phab.request = wrapper
+
+    def count_bytes(response, *args, **kwargs):
+        method = urlsplit(response.url).path.rsplit('/api/', 1)[-1]
+        metrics.add_bytes('phabricator', method, len(response.content))
+    phab.req_session.hooks['response'].append(count_bytes)
+    return phab
@@ -0,0 +1,101 @@
+import logging
+import os
+import sqlite3
+import time
+
+from releasetrain import version_key
+
+logger = logging.getLogger('ledger')
+
+# wmf slugs are forgotten once this many newer trains have been recorded;
+# tags for old trains are not added anymore anyway
+DEFAULT_TRAINS = 8
+# other slugs (mw1.35, ...) are forgotten after this many seconds
+DEFAULT_RETENTION = 180 * 24 * 60 * 60
+
+# SQLite limits the number of host parameters in a query
+_CHUNK_SIZE = 500
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS applied (
+    task INTEGER NOT NULL,
+    phid TEXT NOT NULL,
+    slug TEXT NOT NULL,
+    applied REAL NOT NULL,
+    PRIMARY KEY (task, phid)
+);
+CREATE INDEX IF NOT EXISTS applied_slug ON applied (slug);
+"""
+
+
+def train_number(slug):
+    """ Returns the version_key() of a wmf slug, or None for other slugs.
+
+        >>> train_number('mw1.35.0-wmf.16')
+        (1, 35, 16)
+        >>> train_number('mw1.35')
+    """
+    if not slug.startswith('mw') or '-wmf.' not in slug:
+        return None
+    return version_key(slug[len('mw'):])
+
+
+class Ledger(object):
+    def __init__(self, path):
+        """ Record of the (task, project PHID) pairs that are known to be
+            applied, either because forrestbot added the tag, or because the
+            task already had it. Tasks are not requested from or sent to
+            Phabricator again for those pairs, even if the same change is
+            announced again.
+
+            Parameters:
+              * path - the SQLite database file to use
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.executescript(SCHEMA)
+
+    def applied(self, tasks):
+        """ Returns a dict mapping each of tasks that has entries to the set
+            of slugs whose projects are applied to it. """
+        tasks = sorted(set(tasks))
+        result = {}
+        for start in range(0, len(tasks), _CHUNK_SIZE):
+            chunk = tasks[start:start + _CHUNK_SIZE]
+            for task, slug in self._db.execute(
+                "SELECT task, slug FROM applied WHERE task IN (%s)" % ', '.join('?' * len(chunk)), chunk
+            ):
+                result.setdefault(task, set()).add(slug)
+        return result
+
+    def record(self, task, slug_PHIDs):
+        """ Records that the projects in slug_PHIDs, a dict mapping slugs to
+            PHIDs, are applied to task. """
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO applied (task, phid, slug, applied) VALUES (?, ?, ?, ?)",
+                [(task, phid, slug, now) for (slug, phid) in slug_PHIDs.items()]
+            )
+
+    def prune(self, trains=DEFAULT_TRAINS, retention=DEFAULT_RETENTION):
+        """ Forgets the entries for all but the newest trains wmf slugs, and
+            the entries for other slugs that are older than retention
+            seconds. """
+        slugs = [slug for (slug, ) in self._db.execute("SELECT DISTINCT slug FROM applied")]
+        wmf_slugs = sorted((s for s in slugs if train_number(s)), key=train_number)
+        old_trains = wmf_slugs[:max(len(wmf_slugs) - trains, 0)]
+        with self._db:
+            removed = self._db.executemany(
+                "DELETE FROM applied WHERE slug = ?", [(slug, ) for slug in old_trains]
+            ).rowcount
+            removed += self._db.execute(
+                "DELETE FROM applied WHERE slug NOT LIKE 'mw%-wmf.%' AND applied < ?", (time.time() - retention, )
+            ).rowcount
+        if removed:
+            logger.debug("Pruned %i entries from the ledger", removed)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,67 @@
+import logging
+
+from cache import JSONCache
+
+logger = logging.getLogger('phids')
+
+# Release tags are sometimes created a bit after the branch is cut, so a
+# missing slug is only remembered for a short while.
+NEGATIVE_TTL = 15 * 60
+# forrestbot gives up on adding a tag whose project still does not exist this
+# many seconds after the action was spooled
+UNKNOWN_SLUG_MAX_AGE = 7 * 24 * 60 * 60
+
+_MISSING = object()
+
+
+class UnknownSlugException(Exception):
+    pass
+
+
+class SlugPHIDMap(object):
+    def __init__(self, path, negative_ttl=NEGATIVE_TTL):
+        """ Persistent mapping of Phabricator project slugs to PHIDs. The PHID
+            of a project never changes, so resolved slugs are kept forever;
+            slugs without a project are remembered for negative_ttl seconds.
+
+            Parameters:
+              * path - JSON file to keep the mapping in
+              * negative_ttl - number of seconds to remember unknown slugs
+        """
+        self._cache = JSONCache(path)
+        self._negative_ttl = negative_ttl
+
+    def resolve(self, phab, slugs):
+        """ Looks up all slugs that are not known yet with a single
+            project.query request. """
+        missing = sorted(set(
+            slug for slug in slugs
+            if self._cache.get(slug, _MISSING) is _MISSING
+        ))
+        if not missing:
+            return
+
+        logger.debug("Requesting PHIDs for slugs %s", missing)
+        slugmap = phab.request('project.query', {'slugs': missing})['slugMap']
+        if not slugmap:
+            # If slugMap is empty, an empty list rather than an empty dict is
+            # returned by Phabricator.
+            slugmap = {}
+
+        for slug in missing:
+            phid = slugmap.get(slug)
+            if phid:
+                logger.debug("Slug {slug} = PHID {phid}".format(slug=slug, phid=phid))
+                self._cache.set(slug, phid)
+            else:
+                self._cache.set(slug, None, ttl=self._negative_ttl)
+        self._cache.save()
+
+    def get(self, phab, slug):
+        """ Returns the PHID for slug, requesting it if it is not known yet.
+            Raises UnknownSlugException if there is no such project. """
+        self.resolve(phab, [slug])
+        phid = self._cache.get(slug)
+        if phid is None:
+            raise UnknownSlugException("No PHID found for slug #%s!" % slug)
+        return phid
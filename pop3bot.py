@@ -1,8 +1,9 @@
+import binascii
 import poplib
-import email.parser
-import config
 import logging
-import gerrit_rest
+import time
+import clients
+from instrumentation import metrics
 
 # monkey patch max line length for poplib
 # as gmail sometimes sends > 2048 char lines
@@ -12,72 +13,196 @@ logger = logging.getLogger('pop3bot')
 
 
 def mkmailbox(debug=0):
+    config = clients.config
     username = config.username
     password = config.password
 
-    mailbox = poplib.POP3_SSL(config.pophost, '995')
-    mailbox.set_debuglevel(debug)
+    with metrics.timed('pop3', 'connect'):
+        mailbox = poplib.POP3_SSL(config.pophost, '995')
+        mailbox.set_debuglevel(debug)
 
-    mailbox.user(username)
-    mailbox.pass_(password)
+        mailbox.user(username)
+        mailbox.pass_(password)
 
     return mailbox
 
 
-def mail_generator(mailbox):
-    """ RETRieves the contents of mails, yields those
-        and DELEtes them before the next mail is RETRieved """
-    nmails, octets = mailbox.stat()
-    for i in range(1, nmails+1):
-        # use TOP rather than REPR to stop gmail from hiding/deleting emails
-        # without explicit DELE
-        yield "\n".join(
-            [x.decode('utf-8', 'replace') for x in mailbox.top(i, 1000)[1]]
-        )
-        mailbox.dele(i)
-
-
-def message_generator(mailbox):
-    p = email.parser.Parser()
-    for mail in mail_generator(mailbox):
-        mail = p.parsestr(mail)
-        payload = mail.get_payload(decode=True)
-        if not payload:
-            logger.debug("email from %s does not have payload" % mail['From'])
-            continue
-        yield mail, payload.decode('utf-8', 'replace')
+# number of TOP or DELE commands to send before reading the responses, if
+# the server supports pipelining (RFC 2449)
+DEFAULT_PIPELINE = 10
 
 
-def get_gerrit_data_from_contents(contents):
-    for line in contents.split('\n'):
-        if ': ' in line:
-            key, value = line.split(': ', 1)
-            if key.startswith('Gerrit-') or key in ['Bug', 'Task', 'Closes']:
-                yield key, value.rstrip()
+def supports_pipelining(mailbox):
+    if not isinstance(mailbox, poplib.POP3):
+        return False
+    try:
+        return 'PIPELINING' in mailbox.capa()
+    except poplib.error_proto:
+        return False
+
+
+def _pipelined(mailbox, commands, multiline):
+    """ Sends all commands before reading their responses. Returns the list
+        of responses (or error_proto exceptions), in order. """
+    for command in commands:
+        mailbox._putcmd(command)
+    responses = []
+    for command in commands:
+        try:
+            responses.append(mailbox._getlongresp() if multiline else mailbox._getresp())
+        except poplib.error_proto as e:
+            # keep reading, so the connection stays in sync
+            responses.append(e)
+    return responses
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def top_many(mailbox, msgnums, n_lines, pipeline=DEFAULT_PIPELINE):
+    """ Yields (msgnum, lines) for each of msgnums, using TOP. If the server
+        supports it, pipeline TOP commands are sent at once. """
+    msgnums = list(msgnums)
+    if pipeline <= 1 or not supports_pipelining(mailbox):
+        for i in msgnums:
+            with metrics.timed('pop3', 'TOP'):
+                resp, lines, octets = mailbox.top(i, n_lines)
+            metrics.add_bytes('pop3', 'TOP', octets)
+            yield i, lines
+        return
+
+    for chunk in _chunks(msgnums, pipeline):
+        start = time.perf_counter()
+        responses = _pipelined(mailbox, ['TOP %s %s' % (i, n_lines) for i in chunk], multiline=True)
+        # spread the time of the whole pipeline evenly over its commands
+        elapsed = (time.perf_counter() - start) / len(chunk)
+        for i, response in zip(chunk, responses):
+            metrics.observe('pop3', 'TOP', elapsed, error=isinstance(response, Exception))
+            if isinstance(response, Exception):
+                raise response
+            metrics.add_bytes('pop3', 'TOP', response[2])
+            yield i, response[1]
+
+
+def delete_mails(mailbox, msgnums, pipeline=DEFAULT_PIPELINE):
+    """ DELEtes all of msgnums. The deletions only take effect when the
+        session is ended with QUIT. """
+    msgnums = list(msgnums)
+    logger.debug("Deleting %i mails", len(msgnums))
+    if pipeline <= 1 or not supports_pipelining(mailbox):
+        for i in msgnums:
+            with metrics.timed('pop3', 'DELE'):
+                mailbox.dele(i)
+        return
+
+    for chunk in _chunks(msgnums, pipeline):
+        start = time.perf_counter()
+        responses = _pipelined(mailbox, ['DELE %s' % i for i in chunk], multiline=False)
+        elapsed = (time.perf_counter() - start) / len(chunk)
+        for response in responses:
+            metrics.observe('pop3', 'DELE', elapsed, error=isinstance(response, Exception))
+            if isinstance(response, Exception):
+                raise response
+
+
+def raw_mail_generator(mailbox, fetched=None):
+    """ RETRieves the contents of mails and yields those as lists of byte
+        lines. The mails are not DELEted; instead, the number of each mail is
+        appended to fetched as it is yielded, so the caller can
+        delete_mails() them once they have been fully processed. """
+    with metrics.timed('pop3', 'STAT'):
+        nmails, octets = mailbox.stat()
+    # use TOP rather than REPR to stop gmail from hiding/deleting emails
+    # without explicit DELE
+    for i, lines in top_many(mailbox, range(1, nmails+1), 1000):
+        if fetched is not None:
+            fetched.append(i)
+        yield lines
+
+
+_FOOTER_PREFIXES = (b'Gerrit-', b'Bug: ', b'Task: ', b'Closes: ')
+
+
+def _scan_headers(lines):
+    """ Byte-level scan of the header section of a mail. Returns the X-Gerrit
+        and From headers as a dict, the list of Content-Transfer-Encodings and
+        the index of the first body line. """
+    headers = {}
+    encodings = []
+    key = None
+    end = len(lines)
+    for n, line in enumerate(lines):
+        line = line.rstrip(b'\r')
+        if not line:
+            end = n + 1
+            break
+        if line[:1] in (b' ', b'\t'):
+            # folded header
+            if key is not None:
+                headers[key] += b'\n' + line
+            continue
+        name, _, value = line.partition(b':')
+        key = None
+        # header names are case-insensitive
+        lower = name.lower()
+        if lower == b'content-transfer-encoding':
+            encodings.append(value.strip().lower())
+        elif lower.startswith(b'x-gerrit') or lower == b'from':
+            key = b'From' if lower == b'from' else name
+            headers[key] = value.lstrip()
+    headers = {k.decode('ascii', 'replace'): v.decode('utf-8', 'replace') for (k, v) in headers.items()}
+    return headers, encodings, end
+
+
+def extract_gerrit_data(lines, accept=None):
+    """ Extracts the X-Gerrit-* headers and the Gerrit-*, Bug, Task and Closes
+        footers from a mail, given as the list of raw byte lines returned by
+        TOP. Only the matching lines are decoded. Both CRLF and LF line endings
+        are accepted, and base64 and quoted-printable bodies are decoded.
+
+        If accept is given, it is called with the dict of headers, and None is
+        returned without looking at the body if it returns False. None is
+        also returned for mails without a body.
+    """
+    headers, encodings, end = _scan_headers(lines)
+    if accept is not None and not accept(headers):
+        logger.debug("%s: skipping based on headers" % headers.get('X-Gerrit-ChangeURL', headers.get('From')))
+        return None
 
+    body = lines[end:]
+    if b'base64' in encodings:
+        try:
+            body = binascii.a2b_base64(b''.join(body)).splitlines()
+        except binascii.Error:
+            body = []
+    elif b'quoted-printable' in encodings:
+        body = binascii.a2b_qp(b'\n'.join(body)).splitlines()
+
+    if not any(body):
+        logger.debug("email from %s does not have payload" % headers.get('From'))
+        return None
 
-def gerritmail_generator(mailbox):
-    for message, contents in message_generator(mailbox):
-        gerrit_data = dict(
-            (k, v) for (k, v) in message.items()
-            if k.startswith('X-Gerrit')
-        )
+    gerrit_data = headers
+    gerrit_data.pop('From', None)
+    for line in body:
+        if line.startswith(_FOOTER_PREFIXES):
+            key, sep, value = line.partition(b': ')
+            if sep:
+                gerrit_data[key.decode('utf-8', 'replace')] = value.rstrip().decode('utf-8', 'replace')
+    return gerrit_data
 
-        gerrit_data.update(dict(get_gerrit_data_from_contents(contents)))
 
+def gerritmail_generator(mailbox, fetched=None, accept=None):
+    for lines in raw_mail_generator(mailbox, fetched):
+        gerrit_data = extract_gerrit_data(lines, accept)
         if gerrit_data:
             yield gerrit_data
 
 
-g = gerrit_rest.GerritREST('https://gerrit.wikimedia.org/r')
-
-
 def get_changeset(changeid, o=['CURRENT_REVISION', 'CURRENT_FILES']):
-    matchingchanges = g.changes(changeid, n=1, o=o)
-    if matchingchanges:
-        return matchingchanges[0]
-    else:
-        return None
+    return next(clients.gerrit().iter_changes(changeid, o=o, page_size=1), None)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,160 @@
+"""
+Index of the MediaWiki release trains (the wmf/* branches), and of the
+repositories bundled in the release tarballs (the REL* branches).
+
+Branch names are parsed once into a (major, minor, train) version key, which
+sorts like the trains themselves, so finding the newest train or the one
+after a given branch is a bisection instead of parsing and sorting all
+branch names again.
+"""
+import bisect
+import functools
+import logging
+import re
+
+from repositories import RepositoryRegistry
+from utils import get_slug
+
+logger = logging.getLogger('releasetrain')
+
+# wmf/1.35.0-wmf.16, 1.27.0-wmf21 and the older 1.26wmf10
+_train_re = re.compile(r'^(?:wmf/)?(\d+)\.(\d+)(?:\.0-wmf\.?|wmf)(\d+)$')
+
+# trains with a higher number are test branches
+MAX_TRAIN = 900
+
+
+@functools.lru_cache(maxsize=4096)
+def version_key(branch):
+    """ Parses a wmf branch name, with or without the 'wmf/' prefix, into a
+        (major, minor, train) tuple, or returns None for other branches.
+
+        >>> version_key('wmf/1.35.0-wmf.16')
+        (1, 35, 16)
+        >>> version_key('1.27.0-wmf21')
+        (1, 27, 21)
+        >>> version_key('1.26wmf10')
+        (1, 26, 10)
+        >>> version_key('1.26wmf3-back')
+        >>> version_key('1.27.2-wmf1')  # only doing -wmf for .0
+        >>> version_key('1.32.0-wmf.999')  # test branch
+        >>> version_key('wmf_deploy')
+    """
+    match = _train_re.match(branch)
+    if match is None:
+        return None
+    key = tuple(int(part) for part in match.groups())
+    if key[2] > MAX_TRAIN:
+        return None
+    return key
+
+
+def next_branch(branch):
+    """ Returns the name of the train that follows branch, which is expected
+        to be the next one that is cut, or None if branch is not a train.
+
+        >>> next_branch('1.35.0-wmf.16')
+        '1.35.0-wmf.17'
+        >>> next_branch('wmf/1.35.0-wmf.16')
+        'wmf/1.35.0-wmf.17'
+    """
+    key = version_key(branch)
+    if key is None:
+        return None
+    prefix = 'wmf/' if branch.startswith('wmf/') else ''
+    return '%s%i.%i.0-wmf.%i' % (prefix, key[0], key[1], key[2] + 1)
+
+
+@functools.lru_cache(maxsize=4096)
+def slug(branch):
+    """ Memoized utils.get_slug(): the Phabricator project slug of branch, or
+        None if the branch does not get a tag.
+
+        >>> slug('wmf/1.35.0-wmf.16')
+        'mw1.35.0-wmf.16'
+        >>> slug('REL1_35')
+        'mw1.35'
+    """
+    return get_slug(branch)
+
+
+def slugify(branches):
+    """ Returns the slugs of those of branches that get a tag. """
+    return [s for s in map(slug, branches) if s]
+
+
+class ReleaseTrain(object):
+    def __init__(self, branches=()):
+        """ Sorted index of wmf branches. Each branch is parsed once, when it
+            is added; branches that are not trains are ignored.
+
+            Branches are stored as given, i.e. with the 'wmf/' prefix if they
+            had one.
+
+            Parameters:
+              * branches - iterable of branch names
+        """
+        trains = {}
+        for branch in branches:
+            key = version_key(branch)
+            if key is not None:
+                trains.setdefault(key, branch)
+        self._keys = sorted(trains)
+        self._branches = [trains[key] for key in self._keys]
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __iter__(self):
+        return iter(self._branches)
+
+    def __contains__(self, branch):
+        key = version_key(branch)
+        i = bisect.bisect_left(self._keys, key) if key is not None else len(self._keys)
+        return i < len(self._keys) and self._keys[i] == key
+
+    def add(self, branch):
+        """ Adds branch to the index. Returns whether it was added, i.e. it
+            is a train that was not in the index yet. """
+        key = version_key(branch)
+        if key is None:
+            return False
+        i = bisect.bisect_left(self._keys, key)
+        if i < len(self._keys) and self._keys[i] == key:
+            return False
+        self._keys.insert(i, key)
+        self._branches.insert(i, branch)
+        return True
+
+    def newest(self):
+        """ Returns the newest train, or None if the index is empty. """
+        return self._branches[-1] if self._branches else None
+
+    def next(self, branch=None):
+        """ Returns the train after branch, or after the newest train if
+            branch is not given: the next one in the index if there is one,
+            and otherwise the one that is expected to be cut next. Returns
+            None if there is no such train. """
+        if branch is None:
+            branch = self.newest()
+            if branch is None:
+                return None
+        key = version_key(branch)
+        if key is None:
+            return None
+        i = bisect.bisect_right(self._keys, key)
+        if i < len(self._keys):
+            return self._branches[i]
+        return next_branch(branch)
+
+
+class TarballManifest(RepositoryRegistry):
+    """ The set of repositories that are bundled in the MediaWiki release
+        tarballs, whose REL* branches are tagged like those of core. Loaded
+        and cached like the RepositoryRegistry. """
+
+    @classmethod
+    def fetch(cls):
+        import wikimediaci_utils  # imports requests, which is slow
+
+        return cls(wikimediaci_utils.get_bundled_list())
@@ -0,0 +1,66 @@
+import logging
+
+from cache import JSONCache
+
+logger = logging.getLogger('repositories')
+
+# The deployed-extensions list changes a few times per week at most
+DEFAULT_TTL = 24 * 60 * 60
+
+
+class RepositoryRegistry(object):
+    def __init__(self, repos):
+        """ The set of repositories forrestbot watches for merges. Membership
+            checks are done against a frozenset, so classifying a mail does
+            not need any I/O once the registry has been loaded.
+
+            Parameters:
+              * repos - iterable of Gerrit project names
+        """
+        self._repos = frozenset(repos)
+
+    def __contains__(self, repo):
+        return repo in self._repos
+
+    def __iter__(self):
+        return iter(sorted(self._repos))
+
+    def __len__(self):
+        return len(self._repos)
+
+    @classmethod
+    def fetch(cls):
+        """ Retrieves the current list of watched repositories: MediaWiki core
+            and everything that is deployed on Wikimedia wikis. """
+        import wikimediaci_utils  # imports requests, which is slow
+
+        repos = ['mediawiki/core']
+        repos.extend(wikimediaci_utils.get_wikimedia_deployed_list())
+        return cls(repos)
+
+    @classmethod
+    def load(cls, path, ttl=DEFAULT_TTL, refresh=False):
+        """ Loads the registry from the on-disk cache at path, fetching a new
+            list if the cached one is older than ttl seconds or refresh is
+            set. If fetching fails, a stale cached copy is used instead of
+            crashing the run. """
+        cache = JSONCache(path)
+        repos = cache.get('repositories')
+        if repos is not None and not refresh:
+            logger.debug("Using %i cached repositories from %s", len(repos), path)
+            return cls(repos)
+
+        try:
+            registry = cls.fetch()
+        except Exception:
+            repos = cache.get('repositories', stale_ok=True)
+            if repos is None:
+                raise
+            logger.warning("Unable to refresh repository list, using stale copy from %s",
+                           path, exc_info=True)
+            return cls(repos)
+
+        cache.set('repositories', list(registry), ttl=ttl)
+        cache.save()
+        logger.debug("Cached %i repositories in %s", len(registry), path)
+        return registry
@@ -0,0 +1,119 @@
+import logging
+import os
+import sqlite3
+import time
+
+logger = logging.getLogger('spool')
+
+# completed entries are kept this long, so re-announced changes are ignored
+DEFAULT_RETENTION = 30 * 24 * 60 * 60
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS actions (
+    task INTEGER NOT NULL,
+    slug TEXT NOT NULL,
+    url TEXT NOT NULL,
+    branch TEXT NOT NULL,
+    done INTEGER NOT NULL DEFAULT 0,
+    created REAL NOT NULL,
+    completed REAL,
+    PRIMARY KEY (task, slug)
+);
+CREATE INDEX IF NOT EXISTS actions_done ON actions (done, task);
+"""
+
+
+class Spool(object):
+    def __init__(self, path):
+        """ Durable queue of the actions produced by process_mail(), so that
+            reading mails and tagging tasks can run as separate stages.
+            Entries are keyed on (task, slug): adding the same tag to the same
+            task again is a no-op, also after it has been completed.
+
+            Parameters:
+              * path - the SQLite database file to use
+        """
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(path, timeout=60)
+        self._db.executescript(SCHEMA)
+
+    def put(self, actions):
+        """ Adds actions to the spool in one transaction. Returns the number
+            of new (task, slug) pairs. """
+        now = time.time()
+        rows = [
+            (action['task'], slug, action['url'], action['branch'], now)
+            for action in actions
+            for slug in action['slugs']
+        ]
+        with self._db:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO actions (task, slug, url, branch, created) VALUES (?, ?, ?, ?, ?)",
+                rows
+            )
+            added = self._db.total_changes - before
+        logger.debug("Spooled %i new of %i (task, slug) pairs", added, len(rows))
+        return added
+
+    def pending(self):
+        """ Returns the actions that have not been completed yet, one per
+            (task, slug) pair, in the format of process_mail(). """
+        return [
+            {'task': task, 'slugs': [slug], 'url': url, 'branch': branch}
+            for (task, slug, url, branch) in self._db.execute(
+                "SELECT task, slug, url, branch FROM actions WHERE done = 0 ORDER BY task, slug"
+            )
+        ]
+
+    def iter_pending(self, page_size=1000):
+        """ Iterates over the same actions as pending(), reading page_size of
+            them at a time. Actions can be completed while iterating. """
+        last = (-1, '')
+        while True:
+            page = self._db.execute(
+                "SELECT task, slug, url, branch FROM actions WHERE done = 0 AND (task > ? OR (task = ? AND slug > ?))"
+                " ORDER BY task, slug LIMIT ?",
+                (last[0], last[0], last[1], page_size)
+            ).fetchall()
+            for (task, slug, url, branch) in page:
+                yield {'task': task, 'slugs': [slug], 'url': url, 'branch': branch}
+            if len(page) < page_size:
+                return
+            last = page[-1][:2]
+
+    def created(self, pairs):
+        """ Returns a dict mapping each of the (task, slug) pairs that is in
+            the spool to the time it was first added. """
+        result = {}
+        for task, slug in pairs:
+            row = self._db.execute(
+                "SELECT created FROM actions WHERE task = ? AND slug = ?", (task, slug)
+            ).fetchone()
+            if row is not None:
+                result[(task, slug)] = row[0]
+        return result
+
+    def complete(self, actions):
+        """ Marks the (task, slug) pairs of actions as done. """
+        now = time.time()
+        with self._db:
+            self._db.executemany(
+                "UPDATE actions SET done = 1, completed = ? WHERE task = ? AND slug = ?",
+                [(now, action['task'], slug) for action in actions for slug in action['slugs']]
+            )
+
+    def prune(self, retention=DEFAULT_RETENTION):
+        """ Forgets actions that were completed more than retention seconds
+            ago. """
+        with self._db:
+            cursor = self._db.execute(
+                "DELETE FROM actions WHERE done = 1 AND completed < ?", (time.time() - retention, )
+            )
+        if cursor.rowcount:
+            logger.debug("Pruned %i completed actions from the spool", cursor.rowcount)
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,137 @@
+import logging
+import time
+
+logger = logging.getLogger('tasks')
+
+# maniphest.search returns at most 100 results per page
+PAGE_SIZE = 100
+
+
+def get_task_projects(phab, task_ids, page_size=PAGE_SIZE):
+    """ Retrieves the project PHIDs of all given tasks with maniphest.search,
+        requesting page_size tasks at a time.
+
+        Returns a dict mapping task IDs to sets of project PHIDs. Tasks that do
+        not exist or that we cannot see (e.g. security bugs, T101133) are not
+        included.
+    """
+    task_ids = sorted(set(int(t) for t in task_ids))
+    projects = {}
+
+    for start in range(0, len(task_ids), page_size):
+        page = task_ids[start:start + page_size]
+        logger.debug("Requesting projects for %i tasks (T%i..T%i)", len(page), page[0], page[-1])
+
+        after = None
+        while True:
+            params = {
+                'constraints': {'ids': page},
+                'attachments': {'projects': True},
+                'limit': page_size,
+            }
+            if after is not None:
+                params['after'] = after
+            result = phab.request('maniphest.search', params)
+
+            for task in result['data']:
+                projects[task['id']] = set(task['attachments']['projects']['projectPHIDs'])
+
+            after = (result.get('cursor') or {}).get('after')
+            if after is None:
+                break
+
+    return projects
+
+
+# How tasks are updated:
+#  * 'update' - send the full list of projects with maniphest.update
+#  * 'edit' - only add the missing projects with a maniphest.edit transaction
+#  * 'blind' - like 'edit', but without reading the existing projects first
+UPDATE_MODES = ('update', 'edit', 'blind')
+DEFAULT_UPDATE_MODE = 'edit'
+
+
+def update_job(task, add_PHIDs, description, old_projs=None, mode=DEFAULT_UPDATE_MODE):
+    """ Builds the (task, method, params, description) job that adds the
+        projects in add_PHIDs to task, as used by UpdateExecutor.run().
+
+        old_projs are the projects the task currently has; they are not needed
+        in 'blind' mode. Returns None if there is nothing to add.
+    """
+    if mode not in UPDATE_MODES:
+        raise ValueError("Unknown update mode %r" % (mode, ))
+
+    if mode == 'blind':
+        new_PHIDs = set(add_PHIDs)
+    else:
+        new_PHIDs = set(add_PHIDs) - set(old_projs)
+    if not new_PHIDs:
+        return None
+
+    if mode == 'update':
+        return (task, 'maniphest.update', {
+            'id': str(task),
+            'projectPHIDs': list(set(old_projs) | new_PHIDs),
+        }, description)
+
+    return (task, 'maniphest.edit', {
+        'objectIdentifier': 'T%i' % task,
+        'transactions': [
+            {'type': 'projects.add', 'value': sorted(new_PHIDs)},
+        ],
+    }, description)
+
+
+# TaskAggregator flushes after collecting this many tasks, or after this many
+# seconds since the first action of the batch was added
+DEFAULT_BATCH_TASKS = 200
+DEFAULT_BATCH_SECONDS = 30.0
+
+
+class TaskAggregator(object):
+    def __init__(self, flush, max_tasks=DEFAULT_BATCH_TASKS, max_age=DEFAULT_BATCH_SECONDS, clock=time.monotonic):
+        """ Groups actions by task as they come in, so that each task is only
+            updated once per batch, without collecting all actions first.
+
+            Parameters:
+              * flush - called with a dict mapping task IDs to sets of slugs
+                whenever a batch is complete
+              * max_tasks - flush once this many different tasks are
+                collected
+              * max_age - flush once the oldest action in the batch is this
+                many seconds old
+
+            Both are checked when an action for a task that is not in the
+            batch yet comes in, before it is added, so actions for the same
+            task that come in one after the other (as the spool returns
+            them) always end up in the same batch.
+        """
+        self._flush = flush
+        self._max_tasks = max_tasks
+        self._max_age = max_age
+        self._clock = clock
+        self._tasks = {}
+        self._started = None
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def add(self, action):
+        """ Adds the slugs of action, a dict as returned by process_mail(),
+            to the current batch. If action is for a new task and the batch
+            is complete, the batch is flushed first. """
+        task = action['task']
+        if task not in self._tasks and self._tasks and (
+            len(self._tasks) >= self._max_tasks or self._clock() - self._started >= self._max_age
+        ):
+            self.flush()
+        if not self._tasks:
+            self._started = self._clock()
+        self._tasks.setdefault(task, set()).update(action['slugs'])
+
+    def flush(self):
+        """ Passes the current batch, if any, to the flush function. """
+        if not self._tasks:
+            return
+        batch, self._tasks = self._tasks, {}
+        self._flush(batch)
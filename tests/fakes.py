@@ -0,0 +1,388 @@
+""" In-process stand-ins for the external services forrestbot talks to. """
+import http.server
+import json
+import re
+import socketserver
+import threading
+import time
+from pathlib import Path
+
+import phabricator as legophab
+
+from gerrit_rest import AsyncGerritREST, GerritREST
+
+root = Path(__file__).parent.parent  # type: Path
+
+
+class FakeMailbox:
+    """ Stands in for a poplib.POP3 mailbox, serving the given fixtures from
+        tests/data. """
+    def __init__(self, *filenames):
+        self._content = [(root / 'tests' / 'data' / filename).open(encoding='utf-8').read() for filename in filenames]
+        self.deleted = set()
+
+    @classmethod
+    def from_contents(cls, contents):
+        mailbox = cls()
+        mailbox._content = list(contents)
+        return mailbox
+
+    def stat(self):
+        return len(self._content), sum(len(x) for x in self._content)
+
+    def top(self, item, n_lines):
+        return (
+            "+OK",
+            [x.encode('utf-8') for x in self._content[item-1].split("\n")[:n_lines]],
+            len(self._content[item-1])
+        )
+
+    def dele(self, id):
+        self.deleted.add(id)
+
+    def quit(self):
+        pass
+
+
+class FakeGerrit:
+    """ Stands in for gerrit_rest.GerritREST. branches maps (URL-encoded)
+        project names to lists of branch names. """
+    def __init__(self, branches=None, latency=0):
+        self.branches_ = dict(branches or {})
+        self.latency = latency
+        self.requests = []
+
+    def _request(self, name, **kwargs):
+        self.requests.append((name, kwargs))
+        if self.latency:
+            time.sleep(self.latency)
+
+    def branches(self, project, n=None, s=None, m=None, r=None):
+        self._request('projects/{project}/branches'.format(project=project), n=n, s=s, m=m, r=r)
+        branches = [
+            b for b in self.branches_.get(project, [])
+            if (m is None or m in b) and (r is None or re.fullmatch(r, b))
+        ]
+        branches = branches[s or 0:]
+        if n is not None:
+            branches = branches[:n]
+        return [{'ref': 'refs/heads/' + b} for b in branches]
+
+    iter_branches = GerritREST.iter_branches
+
+
+class FakeAsyncGerrit:
+    """ Stands in for gerrit_rest.AsyncGerritREST, serving the data of a
+        FakeGerrit. """
+    def __init__(self, gerrit):
+        self.gerrit = gerrit
+
+    async def branches(self, project, n=None, s=None, m=None, r=None):
+        return self.gerrit.branches(project, n=n, s=s, m=m, r=r)
+
+    iter_branches = AsyncGerritREST.iter_branches
+
+
+class FakePhabricator:
+    def __init__(self, projects=None, tasks=None, readonly=(), latency=0):
+        """ projects maps slugs to PHIDs, tasks maps visible task IDs to sets
+            of project PHIDs. Tasks in readonly cannot be edited. Every
+            request takes latency seconds. """
+        self.projects = dict(projects or {})
+        self.tasks = {k: set(v) for (k, v) in (tasks or {}).items()}
+        self.readonly = set(readonly)
+        self.latency = latency
+        self.requests = []
+
+    def request(self, method, params=None):
+        params = dict(params or {})
+        self.requests.append((method, params))
+        if self.latency:
+            time.sleep(self.latency)
+        return getattr(self, method.replace('.', '_'))(params)
+
+    def error(self, code, info):
+        raise legophab.PhabricatorException({'error_code': code, 'error_info': info})
+
+    def project_query(self, params):
+        slugmap = {
+            slug: self.projects[slug]
+            for slug in params.get('slugs', [])
+            if slug in self.projects
+        }
+        # Phabricator returns an empty list rather than an empty dict
+        return {'slugMap': slugmap or []}
+
+    def maniphest_search(self, params):
+        ids = sorted(i for i in params['constraints']['ids'] if i in self.tasks)
+        limit = params.get('limit', 100)
+        start = params.get('after') or 0
+        data = [
+            {
+                'id': i,
+                'type': 'TASK',
+                'attachments': {'projects': {'projectPHIDs': sorted(self.tasks[i])}},
+            }
+            for i in ids[start:start + limit]
+        ]
+        after = start + limit if start + limit < len(ids) else None
+        return {'data': data, 'cursor': {'limit': limit, 'after': after, 'before': None}}
+
+    def maniphest_update(self, params):
+        task = int(params['id'])
+        if task not in self.tasks:
+            self.error('ERR-CONDUIT-CORE', 'No such Maniphest task exists.')
+        if task in self.readonly:
+            self.error('ERR-CONDUIT-CORE', 'You do not have permission to edit this object.')
+        self.tasks[task] = set(params['projectPHIDs'])
+        return {'id': str(task), 'projectPHIDs': sorted(self.tasks[task])}
+
+    def maniphest_edit(self, params):
+        task = int(str(params['objectIdentifier']).lstrip('T'))
+        if task not in self.tasks:
+            self.error('ERR-CONDUIT-CORE', 'No such Maniphest task exists.')
+        if task in self.readonly:
+            self.error('ERR-CONDUIT-CORE', 'You do not have permission to edit this object.')
+        for transaction in params['transactions']:
+            if transaction['type'] == 'projects.add':
+                self.tasks[task] |= set(transaction['value'])
+            elif transaction['type'] == 'projects.remove':
+                self.tasks[task] -= set(transaction['value'])
+        return {'object': {'id': task, 'phid': 'PHID-TASK-%i' % task}, 'transactions': []}
+
+
+class FakePOP3Server(socketserver.ThreadingTCPServer):
+    """ Minimal POP3 server on localhost, serving the given mails (as bytes).
+        Deleted mails are only removed on QUIT, like on a real server. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mails, pipelining=True):
+        super().__init__(('127.0.0.1', 0), _POP3Handler)
+        self.mails = list(mails)
+        self.pipelining = pipelining
+        self.commands = []
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05, ), daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class _POP3Handler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        mails = list(server.mails)
+        deleted = set()
+        self.send(b'+OK fake POP3 server ready')
+        for line in self.rfile:
+            command, *args = line.decode('ascii').split()
+            command = command.upper()
+            server.commands.append(command)
+            if command in ('USER', 'PASS', 'NOOP'):
+                self.send(b'+OK')
+            elif command == 'CAPA':
+                self.send(b'+OK')
+                for cap in [b'USER', b'TOP'] + ([b'PIPELINING'] if server.pipelining else []):
+                    self.send(cap)
+                self.send(b'.')
+            elif command == 'STAT':
+                self.send(b'+OK %i %i' % (len(mails), sum(len(m) for m in mails)))
+            elif command in ('TOP', 'DELE') and (
+                    not 0 < int(args[0]) <= len(mails) or int(args[0]) in deleted):
+                self.send(b'-ERR no such message')
+            elif command == 'TOP':
+                self.send(b'+OK')
+                body = False
+                n_lines = int(args[1])
+                for mailline in mails[int(args[0]) - 1].splitlines():
+                    if body:
+                        if n_lines == 0:
+                            break
+                        n_lines -= 1
+                    elif not mailline:
+                        body = True
+                    self.send(b'.' + mailline if mailline.startswith(b'.') else mailline)
+                self.send(b'.')
+            elif command == 'DELE':
+                deleted.add(int(args[0]))
+                self.send(b'+OK')
+            elif command == 'QUIT':
+                server.mails = [m for (i, m) in enumerate(mails, 1) if i not in deleted]
+                self.send(b'+OK bye')
+                return
+            else:
+                self.send(b'-ERR unknown command')
+
+
+class FakeIMAPServer(socketserver.ThreadingTCPServer):
+    """ Minimal IMAP4rev1 server on localhost, with a single folder holding the
+        given mails (as bytes), with UIDs starting at first_uid. Only supports
+        what imapbot uses. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, mails, first_uid=1, uidvalidity=1):
+        super().__init__(('127.0.0.1', 0), _IMAPHandler)
+        self.mails = {uid: mail for (uid, mail) in enumerate(mails, first_uid)}
+        self.uidvalidity = uidvalidity
+        self.commands = []
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05, ), daemon=True)
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def _imap_set(spec, highest):
+    uids = set()
+    for part in spec.split(','):
+        start, _, end = part.partition(':')
+        start = highest if start == '*' else int(start)
+        end = start if not end else highest if end == '*' else int(end)
+        uids.update(range(min(start, end), max(start, end) + 1))
+    return uids
+
+
+class _IMAPHandler(socketserver.StreamRequestHandler):
+    def send(self, line):
+        self.wfile.write(line + b'\r\n')
+
+    def handle(self):
+        server = self.server
+        deleted = set()
+        self.send(b'* OK fake IMAP server ready')
+        for line in self.rfile:
+            tag, command, *args = line.decode('ascii').split()
+            command = command.upper()
+            if command == 'UID':
+                command = 'UID ' + args.pop(0).upper()
+            server.commands.append((command, args))
+            ok = tag.encode('ascii') + b' OK done'
+            uids = sorted(server.mails)
+            if command == 'CAPABILITY':
+                self.send(b'* CAPABILITY IMAP4rev1')
+                self.send(ok)
+            elif command == 'LOGIN':
+                self.send(ok)
+            elif command == 'SELECT':
+                self.send(b'* %i EXISTS' % len(uids))
+                self.send(b'* OK [UIDVALIDITY %i] UIDs valid' % server.uidvalidity)
+                self.send(ok)
+            elif command == 'UID SEARCH':
+                matches = set(uids)
+                while args:
+                    key = args.pop(0).upper()
+                    if key == 'HEADER':
+                        name, value = args.pop(0).encode('ascii'), args.pop(0).encode('ascii')
+                        matches = {
+                            uid for uid in matches
+                            if any(line.lower().startswith(name.lower() + b':') and value in line
+                                   for line in server.mails[uid].split(b'\n\n')[0].splitlines())
+                        }
+                    elif key == 'UID':
+                        matches &= _imap_set(args.pop(0), uids[-1] if uids else 0)
+                self.send(b' '.join([b'* SEARCH'] + [b'%i' % uid for uid in sorted(matches)]))
+                self.send(ok)
+            elif command == 'UID FETCH':
+                for uid in sorted(_imap_set(args[0], uids[-1] if uids else 0) & set(uids)):
+                    header, sep, text = server.mails[uid].partition(b'\n\n')
+                    header = header.replace(b'\n', b'\r\n') + b'\r\n\r\n'
+                    text = text.replace(b'\n', b'\r\n')
+                    self.send(b'* %i FETCH (UID %i BODY[HEADER] {%i}' % (uids.index(uid) + 1, uid, len(header)))
+                    self.wfile.write(header)
+                    self.send(b' BODY[TEXT] {%i}' % len(text))
+                    self.wfile.write(text)
+                    self.send(b')')
+                self.send(ok)
+            elif command == 'UID STORE':
+                deleted |= _imap_set(args[0], uids[-1] if uids else 0)
+                self.send(ok)
+            elif command == 'EXPUNGE':
+                for uid in sorted(deleted & set(uids), reverse=True):
+                    self.send(b'* %i EXPUNGE' % (uids.index(uid) + 1))
+                    del server.mails[uid]
+                deleted = set()
+                self.send(ok)
+            elif command == 'LOGOUT':
+                self.send(b'* BYE')
+                self.send(ok)
+                return
+            else:
+                self.send(tag.encode('ascii') + b' BAD unknown command')
+
+
+class FakeHTTPServer(http.server.ThreadingHTTPServer):
+    """ HTTP server on localhost. routes maps paths (without query string) to
+        lists of responses, which are returned in order; the last one is
+        repeated. A response is a (status, body, headers) tuple, or a JSON
+        serializable object to return the way Gerrit does. """
+    daemon_threads = True
+
+    def __init__(self, routes=None):
+        super().__init__(('127.0.0.1', 0), _HTTPHandler)
+        self.routes = dict(routes or {})
+        self.requests = []
+        self._thread = threading.Thread(target=self.serve_forever, args=(0.05, ), daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%i' % self.server_address[1]
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+def gerrit_json(obj, headers=None):
+    return (200, ")]}'\n" + json.dumps(obj), dict(headers or {}, **{'Content-Type': 'application/json'}))
+
+
+class _HTTPHandler(http.server.BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        path, _, query = self.path.partition('?')
+        server.requests.append((path, query, dict(self.headers)))
+        responses = server.routes.get(path)
+        if not responses:
+            response = (404, 'Not found', {})
+        else:
+            response = responses.pop(0) if len(responses) > 1 else responses[0]
+            if callable(response):
+                response = response(self)
+        if not isinstance(response, tuple):
+            response = gerrit_json(response)
+        status, body, headers = response
+        body = body.encode('utf-8')
+        self.send_response(status)
+        for k, v in headers.items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
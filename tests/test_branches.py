@@ -0,0 +1,51 @@
+from branches import BranchCache
+
+
+def test_newest_persists(tmp_path):
+    path = str(tmp_path / 'branches.json')
+    cache = BranchCache(path)
+    assert cache.newest('mediawiki/core') is None
+
+    cache.set('mediawiki/core', '1.35.0-wmf.15')
+    cache.save()
+
+    assert BranchCache(path).newest('mediawiki/core') == '1.35.0-wmf.15'
+
+
+def test_newest_expires(tmp_path):
+    cache = BranchCache(str(tmp_path / 'branches.json'), ttl=-1)
+    cache.set('mediawiki/core', '1.35.0-wmf.15')
+    assert cache.newest('mediawiki/core') is None
+
+
+def test_no_branch(tmp_path):
+    path = str(tmp_path / 'branches.json')
+    cache = BranchCache(path)
+    assert not cache.known('mediawiki/extensions/Foo')
+
+    cache.set('mediawiki/extensions/Foo', None)
+    cache.save()
+
+    cache = BranchCache(path)
+    assert cache.known('mediawiki/extensions/Foo')
+    assert cache.newest('mediawiki/extensions/Foo') is None
+    assert cache.seen('mediawiki/extensions/Foo', 'wmf/1.35.0-wmf.16')
+    assert cache.newest('mediawiki/extensions/Foo') == '1.35.0-wmf.16'
+
+
+def test_seen_newer_branch(tmp_path):
+    cache = BranchCache(str(tmp_path / 'branches.json'))
+    cache.set('mediawiki/core', '1.35.0-wmf.15')
+
+    assert not cache.seen('mediawiki/core', 'wmf/1.35.0-wmf.14')
+    assert not cache.seen('mediawiki/core', 'wmf/1.35.0-wmf.999')
+    assert cache.newest('mediawiki/core') == '1.35.0-wmf.15'
+
+    assert cache.seen('mediawiki/core', 'wmf/1.35.0-wmf.16')
+    assert cache.newest('mediawiki/core') == '1.35.0-wmf.16'
+
+
+def test_seen_unknown_repository(tmp_path):
+    cache = BranchCache(str(tmp_path / 'branches.json'))
+    assert not cache.seen('mediawiki/core', 'wmf/1.35.0-wmf.16')
+    assert cache.newest('mediawiki/core') is None
@@ -0,0 +1,64 @@
+import bz2
+import io
+import os
+
+import pytest
+
+import error_email_k8s
+import wblogging
+
+RUN = b''.join(b'line %i\n' % n for n in range(50))
+SUMMARY = b'---[ ERROR SUMMARY ]---\n    2x Unable to update T1 (e.g. T1, T2)\n' + b'-' * 80 + b'\n'
+
+
+@pytest.mark.parametrize('block_size', [7, 64, 4096])
+def test_tail_finds_last_summary(block_size):
+    f = io.BytesIO(RUN + SUMMARY + RUN + SUMMARY)
+    assert b''.join(error_email_k8s.tail(f, b'ERROR SUMMARY', block_size=block_size)) == SUMMARY
+
+
+def test_tail_reads_only_the_end():
+    class CountingBytesIO(io.BytesIO):
+        read_bytes = 0
+
+        def read(self, size=-1):
+            data = super().read(size)
+            self.read_bytes += len(data)
+            return data
+
+    f = CountingBytesIO(RUN * 1000 + SUMMARY)
+    assert error_email_k8s.tail(f, b'ERROR SUMMARY', block_size=64)[0].startswith(b'---[ ERROR SUMMARY')
+    assert f.read_bytes < 256
+
+
+def test_tail_without_summary():
+    f = io.BytesIO(RUN)
+    assert error_email_k8s.tail(f, b'ERROR SUMMARY', max_lines=3, block_size=8) == [
+        b'line 47\n', b'line 48\n', b'line 49\n'
+    ]
+    # a summary of a previous run is ignored
+    f = io.BytesIO(SUMMARY + RUN[:14])
+    assert error_email_k8s.tail(f, b'ERROR SUMMARY', start=len(SUMMARY), block_size=5) == [b'line 0\n', b'line 1\n']
+
+
+def test_compress():
+    f = io.BytesIO(RUN * 10)
+    assert bz2.decompress(error_email_k8s.compress(f, start=len(RUN), block_size=100)) == RUN * 9
+
+
+def test_run_start(tmp_path):
+    logfile = str(tmp_path / 'forrestbot.log')
+    assert wblogging.read_run_start(logfile) == 0
+
+    with open(logfile, 'wb') as f:
+        f.write(RUN)
+    wblogging.write_run_start(logfile)
+    with open(logfile, 'ab') as f:
+        f.write(SUMMARY)
+    assert wblogging.read_run_start(logfile) == len(RUN)
+
+    # the log was rotated during the run
+    os.rename(logfile, logfile + '.1')
+    with open(logfile, 'wb') as f:
+        f.write(SUMMARY)
+    assert wblogging.read_run_start(logfile) == 0
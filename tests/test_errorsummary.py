@@ -0,0 +1,75 @@
+import logging
+
+import pytest
+
+from errorsummary import OTHER, ErrorAggregator
+
+
+@pytest.fixture
+def log():
+    logger = logging.getLogger('test_errorsummary')
+    logger.propagate = False
+    handlers = []
+
+    def attach(handler):
+        handlers.append(handler)
+        logger.addHandler(handler)
+        return logger
+
+    yield attach
+    for handler in handlers:
+        logger.removeHandler(handler)
+
+
+def test_repeats_are_counted(log):
+    errors = ErrorAggregator(capacity=3)
+    logger = log(errors)
+    for task in range(100, 110):
+        logger.error('Unable to update T%i, maybe it is read-only?', task)
+    logger.error('Unable to get information about T%i, maybe it is private?', 5)
+    logger.warning('Not an error')
+
+    assert errors.total == 11
+    assert errors.counts() == [
+        (10, 'Unable to update T100, maybe it is read-only?', ['T100', 'T101', 'T102', 'T103', 'T104']),
+        (1, 'Unable to get information about T5, maybe it is private?', ['T5']),
+    ]
+    assert [line.split(' - ')[-1] for line in errors.recent()] == [
+        'Unable to update T108, maybe it is read-only?',
+        'Unable to update T109, maybe it is read-only?',
+        'Unable to get information about T5, maybe it is private?',
+    ]
+
+
+def test_exception_type_is_distinct(log):
+    errors = ErrorAggregator()
+    logger = log(errors)
+    for exc in (ValueError, KeyError, ValueError):
+        try:
+            raise exc()
+        except Exception:
+            logger.exception('Failed to handle %i events', 3)
+
+    assert [count for (count, _, _) in errors.counts()] == [2, 1]
+
+
+def test_fingerprints_are_bounded(log):
+    errors = ErrorAggregator(max_fingerprints=2)
+    logger = log(errors)
+    for n in range(5):
+        logger.error('error ' + 'abcde'[n])
+
+    assert errors.counts() == [(3, OTHER, []), (1, 'error a', []), (1, 'error b', [])]
+
+
+def test_summary(log):
+    errors = ErrorAggregator(capacity=1)
+    logger = log(errors)
+    logger.error('Unable to update T%i', 1)
+    logger.error('Unable to update T%i', 2)
+
+    assert errors.summary() == [
+        '    2x Unable to update T1 (e.g. T1, T2)',
+        'Last 1 of 2 errors:',
+        'Unable to update T2',
+    ]
@@ -0,0 +1,108 @@
+import json
+import queue
+import sys
+import threading
+import urllib.request
+
+import pytest
+
+from eventstream import WebhookServer, batches, reconnecting, ssh_command, stream_events
+
+MERGED = {
+    'type': 'change-merged',
+    'change': {
+        'project': 'mediawiki/core',
+        'branch': 'master',
+        'id': 'I72cf9ae62929d115492edb4deaf4f92ffa742d36',
+        'number': 472763,
+        'url': 'https://gerrit.wikimedia.org/r/c/mediawiki/core/+/472763',
+        'commitMessage': 'Fix things\n\nBug: T207255\n',
+    },
+}
+
+
+def test_ssh_command():
+    assert ssh_command('gerrit.example.org', user='bot') == [
+        'ssh', '-p', '29418', '-o', 'BatchMode=yes', '-o', 'ServerAliveInterval=30',
+        'bot@gerrit.example.org', 'gerrit', 'stream-events', '-s', 'change-merged',
+    ]
+
+
+def test_stream_events():
+    script = 'import json; print(json.dumps(%r)); print("garbage"); print(json.dumps(%r))' % (MERGED, {'type': 'x'})
+    assert list(stream_events([sys.executable, '-c', script])) == [MERGED, {'type': 'x'}]
+
+
+def test_stream_events_failure():
+    with pytest.raises(OSError, match='exited with status 3'):
+        list(stream_events([sys.executable, '-c', 'import sys; sys.exit(3)']))
+
+
+def test_reconnecting():
+    stop = threading.Event()
+    attempts = []
+
+    def connect():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise OSError("connection refused")
+        yield len(attempts)
+        if len(attempts) == 3:
+            stop.set()
+
+    assert list(reconnecting(connect, stop, initial=0)) == [2, 3]
+    assert len(attempts) == 3
+
+
+def test_webhook_server():
+    events = queue.Queue()
+    server = WebhookServer(('127.0.0.1', 0), events)
+    server.start()
+    try:
+        url = 'http://127.0.0.1:%i/' % server.server_address[1]
+        response = urllib.request.urlopen(urllib.request.Request(url, data=json.dumps(MERGED).encode('utf-8')))
+        assert response.status == 202
+        assert events.get(timeout=1) == MERGED
+
+        with pytest.raises(urllib.error.HTTPError) as excinfo:
+            urllib.request.urlopen(urllib.request.Request(url, data=b'not json'))
+        assert excinfo.value.code == 400
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_webhook_server_secret():
+    events = queue.Queue()
+    server = WebhookServer(('127.0.0.1', 0), events, secret='s3cret')
+    server.start()
+    try:
+        url = 'http://127.0.0.1:%i/' % server.server_address[1]
+        data = json.dumps(MERGED).encode('utf-8')
+        for headers in ({}, {'Authorization': 'Bearer wrong'}):
+            with pytest.raises(urllib.error.HTTPError) as excinfo:
+                urllib.request.urlopen(urllib.request.Request(url, data=data, headers=headers))
+            assert excinfo.value.code == 403
+        assert events.empty()
+
+        request = urllib.request.Request(url, data=data, headers={'Authorization': 'Bearer s3cret'})
+        assert urllib.request.urlopen(request).status == 202
+        assert events.get(timeout=1) == MERGED
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_batches_by_size():
+    events = queue.Queue()
+    for i in range(5):
+        events.put(i)
+    it = batches(events, max_size=2, max_delay=10)
+    assert [next(it), next(it)] == [[0, 1], [2, 3]]
+
+
+def test_batches_by_delay():
+    events = queue.Queue()
+    for i in range(3):
+        events.put(i)
+    assert next(batches(events, max_size=100, max_delay=0.05)) == [0, 1, 2]
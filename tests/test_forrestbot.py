@@ -0,0 +1,200 @@
+import logging
+import subprocess
+import sys
+import types
+
+import pytest
+
+import wikimediaci_utils
+
+import clients
+import forrestbot
+import pop3bot
+from ledger import Ledger
+from releasetrain import TarballManifest
+from repositories import RepositoryRegistry
+from spool import Spool
+from tests.fakes import FakeAsyncGerrit, FakeGerrit, FakeMailbox, FakePhabricator, root
+
+REPOS = RepositoryRegistry([
+    'mediawiki/core',
+    'mediawiki/extensions/GrowthExperiments',
+    'mediawiki/extensions/LabeledSectionTransclusion',
+])
+
+SLUGS = ['mw1.32', 'mw1.35.0-wmf.15', 'mw1.35.0-wmf.16', 'mw1.35.0-wmf.17']
+
+
+@pytest.fixture
+def fakes(tmp_path, monkeypatch):
+    config = types.ModuleType('config')
+    config.CACHE_DIR = str(tmp_path)
+    monkeypatch.setitem(sys.modules, 'config', config)
+
+    gerrit = FakeGerrit({'mediawiki%2Fcore': ['master', 'wmf/1.35.0-wmf.15', 'wmf/1.35.0-wmf.16']})
+    phab = FakePhabricator(
+        projects={slug: 'PHID-PROJ-%s' % slug for slug in SLUGS},
+        tasks={207255: {'PHID-PROJ-other'}, 231720: {'PHID-PROJ-mw1.35.0-wmf.15'}},
+    )
+    clients.set_client('gerrit', gerrit)
+    clients.set_client('async_gerrit', FakeAsyncGerrit(gerrit))
+    clients.set_client('phabricator', phab)
+    yield types.SimpleNamespace(gerrit=gerrit, phab=phab, tmp_path=tmp_path)
+
+    clients.reset()
+    for cached in (forrestbot.get_branch_cache, forrestbot.get_repos_to_watch, forrestbot.get_slug_PHID_map,
+                   forrestbot.get_tarball_manifest):
+        cached.cache_clear()
+
+
+def mail(filename):
+    return next(pop3bot.gerritmail_generator(FakeMailbox(filename)))
+
+
+def test_import_is_side_effect_free():
+    # in a fresh interpreter, as other tests import the clients
+    code = (
+        "import logging, sys, forrestbot, pop3bot\n"
+        "assert 'config' not in sys.modules\n"
+        "assert 'requests' not in sys.modules\n"
+        "assert logging.getLogger().handlers == []\n"
+    )
+    subprocess.check_call([sys.executable, '-c', code], cwd=str(root))
+
+
+def test_process_mail_master(fakes):
+    action = forrestbot.process_mail(mail('lst_merged_master.mbox'), REPOS)
+    assert action == {
+        'branch': 'master',
+        'slugs': ['mw1.35.0-wmf.17'],
+        'task': 207255,
+        'url': 'https://gerrit.wikimedia.org/r/472763',
+    }
+    assert fakes.gerrit.requests == [
+        ('projects/mediawiki%2Fcore/branches', {'n': 100, 's': None, 'm': None, 'r': 'wmf/.*'})
+    ]
+
+
+def test_process_mail_skips(fakes):
+    with pytest.raises(forrestbot.SkipMailException):
+        forrestbot.process_mail(mail('lst_merged_notask.mbox'), REPOS)
+    with pytest.raises(forrestbot.SkipMailException):
+        forrestbot.process_mail(mail('nontracked_repo.mbox'), REPOS)
+
+
+@pytest.mark.parametrize('bundled, slugs', [
+    (['mediawiki/extensions/LabeledSectionTransclusion'], ['mw1.32']),
+    (['mediawiki/extensions/ParserFunctions'], []),
+    (None, []),
+])
+def test_process_mail_extension_REL(fakes, bundled, slugs):
+    tarball = TarballManifest(bundled) if bundled is not None else None
+    action = forrestbot.process_mail(mail('lst_merged_REL.mbox'), REPOS, tarball)
+    assert action['branch'] == 'REL1_32'
+    assert action['slugs'] == slugs
+
+
+def test_process_mail_does_not_load_manifest(fakes, monkeypatch):
+    def fetch():
+        raise AssertionError("the manifest is loaded by main()")
+
+    monkeypatch.setattr(wikimediaci_utils, 'get_bundled_list', fetch)
+    assert forrestbot.process_mail(mail('lst_merged_REL.mbox'), REPOS)['slugs'] == []
+
+
+def test_get_tarball_manifest_failure(fakes, monkeypatch):
+    def broken():
+        raise IOError("gerrit is down")
+
+    monkeypatch.setattr(wikimediaci_utils, 'get_bundled_list', broken)
+    assert len(forrestbot.get_tarball_manifest()) == 0
+
+
+def test_process_mails_branches_per_repository(fakes):
+    sys.modules['config'].SHARED_BRANCHES = False
+    fakes.gerrit.branches_['mediawiki%2Fextensions%2FLabeledSectionTransclusion'] = ['wmf/1.35.0-wmf.14']
+    # a repository without wmf branches
+    growth = dict(mail('lst_merged_master.mbox'), **{'Gerrit-Project': 'mediawiki/extensions/GrowthExperiments'})
+    mails = [mail('lst_merged_master.mbox'), growth, growth, growth, mail('mw_core_master.mbox')]
+    actions = forrestbot.process_mails(mails, REPOS)
+
+    # all repositories are requested in one batch, before processing the mails
+    assert sorted(name for (name, _) in fakes.gerrit.requests) == [
+        'projects/mediawiki%2Fcore/branches',
+        'projects/mediawiki%2Fextensions%2FGrowthExperiments/branches',
+        'projects/mediawiki%2Fextensions%2FLabeledSectionTransclusion/branches',
+    ]
+    assert [action['slugs'] for action in actions] == [['mw1.35.0-wmf.15'], [], [], [], ['mw1.35.0-wmf.17']]
+
+    # the next run uses the cache, also for the repository without wmf branches
+    forrestbot.get_branch_cache().save()
+    forrestbot.get_branch_cache.cache_clear()
+    forrestbot.process_mails(mails, REPOS)
+    assert len(fakes.gerrit.requests) == 3
+
+
+def test_tag(fakes):
+    spool = Spool(str(fakes.tmp_path / 'spool.sqlite3'))
+    ledger = Ledger(str(fakes.tmp_path / 'ledger.sqlite3'))
+    actions = forrestbot.process_mails([mail('lst_merged_master.mbox'), mail('extension_wmf_branch.mbox')], REPOS)
+    spool.put(actions)
+
+    forrestbot.tag(spool, ledger)
+    assert fakes.phab.tasks[207255] == {'PHID-PROJ-other', 'PHID-PROJ-mw1.35.0-wmf.17'}
+    assert spool.pending() == []
+    assert ledger.applied([207255, 231720]) == {207255: {'mw1.35.0-wmf.17'}, 231720: {'mw1.35.0-wmf.15'}}
+
+    # a re-announced change does not lead to any Phabricator requests
+    nrequests = len(fakes.phab.requests)
+    spool.prune(retention=-1)
+    spool.put(actions)
+    forrestbot.tag(spool, ledger)
+    assert len(fakes.phab.requests) == nrequests
+
+
+def test_tag_unknown_slug(fakes):
+    spool = Spool(str(fakes.tmp_path / 'spool.sqlite3'))
+    ledger = Ledger(str(fakes.tmp_path / 'ledger.sqlite3'))
+    fakes.phab.tasks.update({1: set(), 2: set(), 3: set()})
+    spool.put([
+        {'task': 1, 'slugs': ['mw1.35.0-wmf.16'], 'url': 'u1', 'branch': 'master'},
+        {'task': 2, 'slugs': ['mw1.35.0-wmf.16', 'mw1.35.0-wmf.18'], 'url': 'u2', 'branch': 'master'},
+        {'task': 3, 'slugs': ['mw1.35.0-wmf.17'], 'url': 'u3', 'branch': 'master'},
+    ])
+
+    # the project for wmf.18 has not been created yet
+    forrestbot.tag(spool, ledger)
+    assert fakes.phab.tasks[1] == {'PHID-PROJ-mw1.35.0-wmf.16'}
+    assert fakes.phab.tasks[2] == {'PHID-PROJ-mw1.35.0-wmf.16'}
+    assert fakes.phab.tasks[3] == {'PHID-PROJ-mw1.35.0-wmf.17'}
+    assert [(a['task'], a['slugs']) for a in spool.pending()] == [(2, ['mw1.35.0-wmf.18'])]
+
+    # once it exists, the task is tagged in the next run
+    fakes.phab.projects['mw1.35.0-wmf.18'] = 'PHID-PROJ-mw1.35.0-wmf.18'
+    forrestbot.get_slug_PHID_map.cache_clear()
+    # forget that the slug was unknown
+    (fakes.tmp_path / 'phids.json').unlink()
+    forrestbot.tag(spool, ledger)
+    assert fakes.phab.tasks[2] == {'PHID-PROJ-mw1.35.0-wmf.16', 'PHID-PROJ-mw1.35.0-wmf.18'}
+    assert spool.pending() == []
+
+
+def test_tag_unknown_slug_expires(fakes, caplog):
+    spool = Spool(str(fakes.tmp_path / 'spool.sqlite3'))
+    ledger = Ledger(str(fakes.tmp_path / 'ledger.sqlite3'))
+    fakes.phab.tasks[1] = set()
+    spool.put([{'task': 1, 'slugs': ['mw1.35.0-wmf.18'], 'url': 'u1', 'branch': 'master'}])
+
+    # only a warning while the project may still be created
+    with caplog.at_level(logging.WARNING):
+        forrestbot.tag(spool, ledger)
+    assert [r.levelname for r in caplog.records if 'mw1.35.0-wmf.18' in r.getMessage()] == ['WARNING']
+    assert len(spool.pending()) == 1
+
+    caplog.clear()
+    sys.modules['config'].UNKNOWN_SLUG_MAX_AGE = -1
+    with caplog.at_level(logging.WARNING):
+        forrestbot.tag(spool, ledger)
+    assert [r.levelname for r in caplog.records if 'mw1.35.0-wmf.18' in r.getMessage()] == ['ERROR']
+    assert spool.pending() == []
+    assert fakes.phab.tasks[1] == set()
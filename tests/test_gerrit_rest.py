@@ -0,0 +1,237 @@
+import asyncio
+import itertools
+import time
+import urllib.parse
+
+import pytest
+import requests
+
+from gerrit_rest import AsyncGerritREST, GerritREST, GerritRESTError, ResponseCache
+from tests.fakes import FakeHTTPServer, gerrit_json
+
+BRANCHES = [{'ref': 'refs/heads/master'}, {'ref': 'refs/heads/wmf/1.35.0-wmf.16'}]
+
+
+def test_request():
+    with FakeHTTPServer({'/r/projects/mediawiki%2Fcore/branches/': [BRANCHES]}) as server:
+        gerrit = GerritREST(server.url + '/r/')
+        assert gerrit.branches('mediawiki%2Fcore', r='wmf/.*') == BRANCHES
+        assert server.requests[0][1] == 'r=wmf%2F.%2A'
+
+
+def test_retries_transient_errors():
+    responses = [(502, '<html>Bad gateway</html>', {}), (503, 'Unavailable', {}), BRANCHES]
+    with FakeHTTPServer({'/r/projects/mediawiki%2Fcore/branches/': responses}) as server:
+        gerrit = GerritREST(server.url + '/r', retries=3)
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert len(server.requests) == 3
+
+
+def test_error_after_retries():
+    with FakeHTTPServer({'/r/changes/': [(502, '<html>Bad gateway</html>', {})]}) as server:
+        gerrit = GerritREST(server.url + '/r', retries=1)
+        with pytest.raises(GerritRESTError) as excinfo:
+            gerrit.changes('status:merged')
+        assert excinfo.value.status_code == 502
+        assert len(server.requests) == 2
+
+
+def test_non_json_response():
+    with FakeHTTPServer({'/r/changes/': [(200, '<html>Login</html>', {})]}) as server:
+        with pytest.raises(GerritRESTError, match='non-JSON'):
+            GerritREST(server.url + '/r').changes('status:merged')
+
+
+def test_not_found():
+    with FakeHTTPServer() as server:
+        with pytest.raises(GerritRESTError) as excinfo:
+            GerritREST(server.url + '/r', retries=0).changes('status:merged')
+        assert excinfo.value.status_code == 404
+
+
+def test_timeout():
+    def slow(handler):
+        time.sleep(0.5)
+        return gerrit_json([])
+
+    with FakeHTTPServer({'/r/changes/': [slow]}) as server:
+        gerrit = GerritREST(server.url + '/r', timeout=(1, 0.1), retries=0)
+        with pytest.raises(requests.exceptions.RequestException, match='timed out'):
+            gerrit.changes('status:merged')
+
+
+def etag_response(etag, obj):
+    def respond(handler):
+        if handler.headers.get('If-None-Match') == etag:
+            return (304, '', {'ETag': etag})
+        return gerrit_json(obj, {'ETag': etag})
+    return respond
+
+
+def test_conditional_request():
+    with FakeHTTPServer({'/r/projects/mediawiki%2Fcore/branches/': [etag_response('"v1"', BRANCHES)]}) as server:
+        gerrit = GerritREST(server.url + '/r', cache=ResponseCache())
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert 'If-None-Match' not in server.requests[0][2]
+        assert server.requests[1][2]['If-None-Match'] == '"v1"'
+
+        # different parameters are cached separately
+        assert gerrit.branches('mediawiki%2Fcore', r='wmf/.*') == BRANCHES
+        assert 'If-None-Match' not in server.requests[2][2]
+
+
+def test_changed_response_replaces_cache():
+    responses = [etag_response('"v1"', BRANCHES[:1]), etag_response('"v2"', BRANCHES)]
+    with FakeHTTPServer({'/r/projects/mediawiki%2Fcore/branches/': responses}) as server:
+        gerrit = GerritREST(server.url + '/r', cache=ResponseCache())
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES[:1]
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert server.requests[2][2]['If-None-Match'] == '"v2"'
+
+
+def test_cache_ttl(tmpdir):
+    path = str(tmpdir / 'gerrit.json')
+    ttls = {'projects/{project}/branches': 60}
+    with FakeHTTPServer({'/r/projects/mediawiki%2Fcore/branches/': [BRANCHES]}) as server:
+        gerrit = GerritREST(server.url + '/r', cache=ResponseCache(ttls=ttls, path=path))
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert len(server.requests) == 1
+        gerrit._cache.save()
+
+        # and again from disk
+        gerrit = GerritREST(server.url + '/r', cache=ResponseCache(ttls=ttls, path=path))
+        assert gerrit.branches('mediawiki%2Fcore') == BRANCHES
+        assert len(server.requests) == 1
+
+
+def test_cache_save(tmp_path):
+    path = tmp_path / 'gerrit.json'
+    cache = ResponseCache(path=str(path))
+    cache.save()
+    assert not path.exists()
+
+    cache.put('a', {'etag': 'x'})
+    cache.save()
+    assert path.stat().st_mode & 0o777 == 0o600
+
+    # nothing changed since
+    mtime = path.stat().st_mtime_ns
+    ResponseCache(path=str(path)).save()
+    assert path.stat().st_mtime_ns == mtime
+
+
+def test_cache_lru():
+    cache = ResponseCache(maxsize=2)
+    cache.put('a', {})
+    cache.put('b', {})
+    cache.get('a')
+    cache.put('c', {})
+    assert cache.get('b') is None
+    assert cache.get('a') == {}
+
+
+def changes_page(handler):
+    query = dict(urllib.parse.parse_qsl(handler.path.partition('?')[2]))
+    start, n = int(query.get('S', 0)), int(query['n'])
+    changes = [{'_number': i} for i in range(start, min(start + n, 250))]
+    if start + n < 250:
+        changes[-1]['_more_changes'] = True
+    return gerrit_json(changes)
+
+
+def test_iter_changes():
+    with FakeHTTPServer({'/r/changes/': [changes_page]}) as server:
+        gerrit = GerritREST(server.url + '/r')
+        assert [c['_number'] for c in gerrit.iter_changes('status:merged')] == list(range(250))
+        assert [r[1] for r in server.requests] == [
+            'q=status%3Amerged&n=100', 'q=status%3Amerged&n=100&S=100', 'q=status%3Amerged&n=100&S=200'
+        ]
+
+
+def test_iter_changes_stops_early():
+    with FakeHTTPServer({'/r/changes/': [changes_page]}) as server:
+        changes = GerritREST(server.url + '/r').iter_changes('status:merged', page_size=10)
+        assert [c['_number'] for c in itertools.islice(changes, 15)] == list(range(15))
+        assert len(server.requests) == 2
+
+
+def test_iter_branches():
+    branches = [{'ref': 'refs/heads/wmf/1.35.0-wmf.%i' % i} for i in range(5)]
+    responses = [branches[:2], branches[2:4], branches[4:]]
+    with FakeHTTPServer({'/r/projects/mediawiki%2Fcore/branches/': responses}) as server:
+        gerrit = GerritREST(server.url + '/r')
+        assert list(gerrit.iter_branches('mediawiki%2Fcore', r='wmf/.*', page_size=2)) == branches
+        assert [r[1] for r in server.requests] == [
+            'n=2&r=wmf%2F.%2A', 'n=2&s=2&r=wmf%2F.%2A', 'n=2&s=4&r=wmf%2F.%2A'
+        ]
+
+
+def test_async_request():
+    routes = {
+        '/r/projects/mediawiki%2Fcore/branches/': [BRANCHES],
+        '/r/changes/': [[{'_number': 1}]],
+        '/r/accounts/': [[{'_account_id': 2}]],
+    }
+    with FakeHTTPServer(routes) as server:
+        gerrit = AsyncGerritREST(server.url + '/r')
+
+        async def run():
+            return await asyncio.gather(
+                gerrit.branches('mediawiki%2Fcore', r='wmf/.*'),
+                gerrit.changes('status:merged', n=1),
+                gerrit.accounts(q='self'),
+            )
+        assert asyncio.run(run()) == [BRANCHES, [{'_number': 1}], [{'_account_id': 2}]]
+        assert sorted(r[1] for r in server.requests) == ['q=self', 'q=status%3Amerged&n=1', 'r=wmf%2F.%2A']
+
+
+def test_async_error():
+    with FakeHTTPServer({'/r/changes/': [(200, '<html>Login</html>', {})]}) as server:
+        with pytest.raises(GerritRESTError, match='non-JSON'):
+            asyncio.run(AsyncGerritREST(server.url + '/r').changes('status:merged'))
+
+
+def test_async_concurrency():
+    active = []
+    peak = []
+
+    def slow(handler):
+        active.append(1)
+        peak.append(len(active))
+        time.sleep(0.05)
+        active.pop()
+        return gerrit_json(BRANCHES)
+
+    with FakeHTTPServer({'/r/projects/a/branches/': [slow]}) as server:
+        gerrit = AsyncGerritREST(server.url + '/r', concurrency=2)
+
+        async def run():
+            return await asyncio.gather(*[gerrit.branches('a', s=i) for i in range(6)])
+        assert asyncio.run(run()) == [BRANCHES] * 6
+        assert max(peak) == 2
+
+
+def test_async_iter_changes():
+    with FakeHTTPServer({'/r/changes/': [changes_page]}) as server:
+        gerrit = AsyncGerritREST(server.url + '/r')
+
+        async def run():
+            return [c['_number'] async for c in gerrit.iter_changes('status:merged')]
+        assert asyncio.run(run()) == list(range(250))
+        assert [r[1] for r in server.requests] == [
+            'q=status%3Amerged&n=100', 'q=status%3Amerged&n=100&S=100', 'q=status%3Amerged&n=100&S=200'
+        ]
+
+
+def test_async_iter_branches():
+    branches = [{'ref': 'refs/heads/wmf/1.35.0-wmf.%i' % i} for i in range(3)]
+    with FakeHTTPServer({'/r/projects/a/branches/': [branches[:2], branches[2:]]}) as server:
+        gerrit = AsyncGerritREST(server.url + '/r')
+
+        async def run():
+            return [b async for b in gerrit.iter_branches('a', page_size=2)]
+        assert asyncio.run(run()) == branches
+        assert len(server.requests) == 2
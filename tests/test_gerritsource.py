@@ -0,0 +1,112 @@
+import urllib.parse
+
+import pop3bot
+from gerrit_rest import GerritREST
+from gerritsource import Checkpoint, change_to_mail, event_to_mail, merged_changes, parse_timestamp, verified_mails
+from tests.fakes import FakeHTTPServer, gerrit_json, root
+
+LST_MASTER = {
+    'id': 'mediawiki%2Fextensions%2FLabeledSectionTransclusion~master~I72cf9ae62929d115492edb4deaf4f92ffa742d36',
+    'project': 'mediawiki/extensions/LabeledSectionTransclusion',
+    'branch': 'master',
+    'change_id': 'I72cf9ae62929d115492edb4deaf4f92ffa742d36',
+    'status': 'MERGED',
+    'updated': '2018-11-12 10:00:00.000000000',
+    'submitted': '2018-11-12 10:00:00.000000000',
+    '_number': 472763,
+    'current_revision': '6fa7072747d80076ad5f7e5fd256db8792218d2f',
+    'revisions': {
+        '6fa7072747d80076ad5f7e5fd256db8792218d2f': {
+            'commit': {
+                'message': 'Fix things\n\nLonger description.\n\n'
+                           'Bug: T207255\nChange-Id: I72cf9ae62929d115492edb4deaf4f92ffa742d36\n',
+            },
+        },
+    },
+}
+
+
+def test_change_to_mail():
+    with (root / 'tests' / 'data' / 'lst_merged_master.mbox').open('rb') as f:
+        from_mail = pop3bot.extract_gerrit_data(f.read().split(b'\n'))
+
+    mail = change_to_mail(LST_MASTER)
+    for key in ('Gerrit-Project', 'Gerrit-Branch', 'Bug', 'X-Gerrit-MessageType', 'X-Gerrit-ChangeURL'):
+        assert mail[key] == from_mail[key]
+
+
+def test_change_to_mail_without_footer():
+    change = dict(LST_MASTER, revisions={})
+    assert 'Bug' not in change_to_mail(change)
+
+
+def test_merged_changes():
+    other = dict(LST_MASTER, _number=472764, updated='2018-11-12 11:30:00.000000000',
+                 submitted='2018-11-12 11:00:00.000000000', _more_changes=True)
+
+    def changes(handler):
+        query = dict(urllib.parse.parse_qsl(handler.path.partition('?')[2]))
+        return gerrit_json([LST_MASTER] if query.get('S') else [other])
+
+    with FakeHTTPServer({'/r/changes/': [changes]}) as server:
+        gerrit = GerritREST(server.url + '/r')
+        result = list(merged_changes(gerrit, parse_timestamp('2018-11-12 09:00:00')))
+        assert [(mail['X-Gerrit-Change-Number'], submitted) for (mail, submitted) in result] == [
+            ('472764', parse_timestamp(other['submitted'])),
+            ('472763', parse_timestamp(LST_MASTER['submitted'])),
+        ]
+        query = dict(urllib.parse.parse_qsl(server.requests[0][1]))
+        assert query['q'] == 'status:merged mergedafter:"2018-11-12 09:00:00"'
+        assert urllib.parse.parse_qs(server.requests[0][1])['o'] == ['CURRENT_REVISION', 'CURRENT_COMMIT']
+
+
+def test_merged_changes_skips_old_merges():
+    # merged months ago, but commented on since
+    old = dict(LST_MASTER, _number=400000, updated='2018-11-12 10:30:00.000000000',
+               submitted='2018-06-01 12:00:00.000000000')
+
+    with FakeHTTPServer({'/r/changes/': [gerrit_json([old, LST_MASTER])]}) as server:
+        gerrit = GerritREST(server.url + '/r')
+        result = list(merged_changes(gerrit, parse_timestamp('2018-11-12 09:00:00')))
+        assert [mail['X-Gerrit-Change-Number'] for (mail, _) in result] == ['472763']
+
+
+def test_verified_mails():
+    def event(number, message):
+        return {'type': 'change-merged', 'change': {'number': number, 'commitMessage': message}}
+
+    # the footers of the event are ignored, and the open change 472764 is not returned
+    events = [event(472763, 'Bug: T1'), event(472764, 'Bug: T2'), {'type': 'change-merged'}, {'type': 'other'}]
+    with FakeHTTPServer({'/r/changes/': [gerrit_json([LST_MASTER])]}) as server:
+        mails = verified_mails(GerritREST(server.url + '/r'), events)
+        query = dict(urllib.parse.parse_qsl(server.requests[0][1]))
+
+    assert [(mail['X-Gerrit-Change-Number'], mail['Bug']) for mail in mails] == [('472763', 'T207255')]
+    assert query['q'] == 'status:merged (change:472763 OR change:472764)'
+    assert verified_mails(None, [{'type': 'other'}]) == []
+
+
+def test_checkpoint(tmpdir):
+    path = str(tmpdir / 'checkpoint.json')
+    checkpoint = Checkpoint(path)
+    assert checkpoint.since is None
+    checkpoint.advance(100)
+    checkpoint.advance(50)
+    assert checkpoint.since == 100
+    checkpoint.save()
+    assert Checkpoint(path).since == 100
+
+
+def test_event_to_mail():
+    event = {
+        'type': 'change-merged',
+        'change': {
+            'project': 'mediawiki/extensions/LabeledSectionTransclusion',
+            'branch': 'master',
+            'id': 'I72cf9ae62929d115492edb4deaf4f92ffa742d36',
+            'number': 472763,
+            'url': 'https://gerrit.wikimedia.org/r/472763',
+            'commitMessage': LST_MASTER['revisions'][LST_MASTER['current_revision']]['commit']['message'],
+        },
+    }
+    assert event_to_mail(event) == change_to_mail(LST_MASTER)
@@ -0,0 +1,91 @@
+import imaplib
+from pathlib import Path
+
+import pytest
+
+import imapbot
+import pop3bot
+from tests.fakes import FakeIMAPServer
+
+root = Path(__file__).parent.parent  # type: Path
+
+FIXTURES = ['lst_merged_master.mbox', 'not_merge.mbox', 'mw_core_wmf_branch.mbox', 'extension_wmf_branch.mbox']
+MERGED = [f for f in FIXTURES if f != 'not_merge.mbox']
+
+
+def read_fixture(filename):
+    return (root / 'tests' / 'data' / filename).read_bytes()
+
+
+@pytest.fixture
+def server():
+    with FakeIMAPServer([read_fixture(f) for f in FIXTURES], first_uid=10) as server:
+        yield server
+
+
+def connect(server):
+    imap = imaplib.IMAP4('127.0.0.1', server.port)
+    imap.login('user', 'password')
+    return imap
+
+
+def test_uid_set():
+    assert imapbot.uid_set([7, 3, 1, 2, 8, 5]) == '1:3,5,7:8'
+
+
+def test_search_merged(server):
+    imap = connect(server)
+    imap.select('INBOX')
+    assert imapbot.search_merged(imap) == [10, 12, 13]
+    assert imapbot.search_merged(imap, after=12) == [13]
+    # n:* also matches the last mail if its UID is lower than n
+    assert imapbot.search_merged(imap, after=13) == []
+    imap.logout()
+
+
+def test_fetch_many(server):
+    imap = connect(server)
+    imap.select('INBOX')
+    mails = imapbot.fetch_many(imap, [10, 12, 13])
+    assert sorted(mails) == [10, 12, 13]
+    assert ('UID FETCH', ['10,12:13', '(UID', 'BODY.PEEK[HEADER]', 'BODY.PEEK[TEXT])']) in server.commands
+    for uid, filename in zip([10, 12, 13], MERGED):
+        expected = pop3bot.extract_gerrit_data(read_fixture(filename).split(b'\n'))
+        assert pop3bot.extract_gerrit_data(mails[uid]) == expected
+    imap.logout()
+
+
+def test_gerritmail_generator(server, tmp_path):
+    state = str(tmp_path / 'imap.json')
+    mailbox = imapbot.IMAPMailbox(connect(server), state, fetch_size=2)
+    fetched = []
+    mails = list(pop3bot.gerritmail_generator(mailbox, fetched))
+    assert [m['Gerrit-Change-Number'] for m in mails] == ['472763', '566586', '566382']
+    assert len([c for c in server.commands if c[0] == 'UID FETCH']) == 2
+
+    # only the first two are processed; the next session starts after those
+    pop3bot.delete_mails(mailbox, fetched[:2])
+    mailbox.quit()
+    mailbox = imapbot.IMAPMailbox(connect(server), state)
+    assert [m['Gerrit-Change-Number'] for m in pop3bot.gerritmail_generator(mailbox)] == ['566382']
+    mailbox.quit()
+    assert len(server.mails) == 4
+
+
+def test_uidvalidity_change(server, tmp_path):
+    state = str(tmp_path / 'imap.json')
+    mailbox = imapbot.IMAPMailbox(connect(server), state)
+    pop3bot.delete_mails(mailbox, [1, 2, 3])
+    mailbox.quit()
+
+    server.uidvalidity = 2
+    mailbox = imapbot.IMAPMailbox(connect(server), state)
+    assert mailbox.stat() == (3, 0)
+    mailbox.quit()
+
+
+def test_expunge(server, tmp_path):
+    mailbox = imapbot.IMAPMailbox(connect(server), str(tmp_path / 'imap.json'), expunge=True)
+    pop3bot.delete_mails(mailbox, [1, 3])
+    mailbox.quit()
+    assert sorted(server.mails) == [11, 12]
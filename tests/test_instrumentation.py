@@ -0,0 +1,70 @@
+import json
+
+import pytest
+
+from instrumentation import Metrics, instrument_phabricator
+from tests.fakes import FakePhabricator
+
+
+def test_observe():
+    metrics = Metrics()
+    metrics.observe('gerrit', 'changes', 0.07)
+    metrics.observe('gerrit', 'changes', 3, error=True)
+    metrics.add_bytes('gerrit', 'changes', 1234)
+
+    [stats] = metrics.summary()['endpoints']
+    assert stats['service'] == 'gerrit'
+    assert stats['endpoint'] == 'changes'
+    assert stats['count'] == 2
+    assert stats['errors'] == 1
+    assert stats['bytes'] == 1234
+    assert stats['buckets']['0.1'] == 1
+    assert stats['buckets']['5'] == 1
+
+
+def test_timed_error():
+    metrics = Metrics()
+    with pytest.raises(ValueError):
+        with metrics.timed('pop3', 'TOP'):
+            raise ValueError()
+    assert metrics.summary()['endpoints'][0]['errors'] == 1
+
+
+def test_phase():
+    metrics = Metrics()
+    with metrics.phase('ingest'):
+        pass
+    assert list(metrics.summary()['phases']) == ['ingest']
+
+
+def test_instrument_phabricator():
+    class Session:
+        hooks = {'response': []}
+
+    phab = FakePhabricator(projects={'mw1.34': 'PHID-PROJ-a'})
+    phab.req_session = Session()
+    metrics = Metrics()
+    instrument_phabricator(phab, metrics)
+
+    phab.request('project.query', {'slugs': ['mw1.34']})
+    assert [(s['service'], s['endpoint'], s['count']) for s in metrics.summary()['endpoints']] == [
+        ('phabricator', 'project.query', 1)
+    ]
+    assert len(phab.req_session.hooks['response']) == 1
+
+
+def test_write(tmp_path):
+    metrics = Metrics()
+    metrics.observe('phabricator', 'maniphest.edit', 0.2)
+    with metrics.phase('tag'):
+        pass
+
+    metrics.write_json(str(tmp_path / 'run.json'))
+    assert json.loads((tmp_path / 'run.json').read_text())['endpoints'][0]['count'] == 1
+
+    metrics.write_prometheus(str(tmp_path / 'forrestbot.prom'))
+    prom = (tmp_path / 'forrestbot.prom').read_text()
+    assert 'forrestbot_phase_duration_seconds{phase="tag"}' in prom
+    assert ('forrestbot_request_duration_seconds_bucket'
+            '{service="phabricator",endpoint="maniphest.edit",le="+Inf"} 1') in prom
+    assert 'forrestbot_request_duration_seconds_count{service="phabricator",endpoint="maniphest.edit"} 1' in prom
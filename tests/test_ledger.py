@@ -0,0 +1,41 @@
+import time
+
+from ledger import Ledger
+
+
+def test_record_applied(tmp_path):
+    path = str(tmp_path / 'ledger.sqlite3')
+    ledger = Ledger(path)
+    assert ledger.applied([1, 2]) == {}
+
+    ledger.record(1, {'mw1.35.0-wmf.16': 'PHID-PROJ-16', 'mw1.34': 'PHID-PROJ-134'})
+    ledger.record(2, {'mw1.35.0-wmf.16': 'PHID-PROJ-16'})
+    ledger.record(2, {'mw1.35.0-wmf.16': 'PHID-PROJ-16'})
+    ledger.close()
+
+    assert Ledger(path).applied([1, 2, 3]) == {1: {'mw1.35.0-wmf.16', 'mw1.34'}, 2: {'mw1.35.0-wmf.16'}}
+
+
+def test_applied_many_tasks(tmp_path):
+    ledger = Ledger(str(tmp_path / 'ledger.sqlite3'))
+    for task in range(1200):
+        ledger.record(task, {'mw1.34': 'PHID-PROJ-134'})
+    assert len(ledger.applied(range(0, 2400, 2))) == 600
+
+
+def test_prune_trains(tmp_path):
+    ledger = Ledger(str(tmp_path / 'ledger.sqlite3'))
+    for n, slug in enumerate(['mw1.35.0-wmf.40', 'mw1.36.0-wmf.1', 'mw1.36.0-wmf.2', 'mw1.34']):
+        ledger.record(n, {slug: 'PHID-PROJ-%s' % slug})
+
+    ledger.prune(trains=2)
+    assert ledger.applied(range(4)) == {1: {'mw1.36.0-wmf.1'}, 2: {'mw1.36.0-wmf.2'}, 3: {'mw1.34'}}
+
+
+def test_prune_retention(tmp_path, monkeypatch):
+    ledger = Ledger(str(tmp_path / 'ledger.sqlite3'))
+    ledger.record(1, {'mw1.34': 'PHID-PROJ-134', 'mw1.36.0-wmf.1': 'PHID-PROJ-wmf1'})
+
+    monkeypatch.setattr(time, 'time', lambda: 1e10)
+    ledger.prune(retention=60)
+    assert ledger.applied([1]) == {1: {'mw1.36.0-wmf.1'}}
@@ -7,6 +7,7 @@ root = Path(__file__).parent.parent  # type: Path
 if not (root / "config.py").exists():
     pytest.skip("No config.py present; skipping live tests", allow_module_level=True)
 
+import clients  # noqa
 import forrestbot  # noqa -- import after verifying import can succeed
 
 
@@ -34,6 +35,6 @@ def test_nonexistent_slug():
 
 
 def test_taskinfo():
-    task_info = forrestbot.phab.request('maniphest.info', {'task_id': "243540"})
+    task_info = clients.phabricator().request('maniphest.info', {'task_id': "243540"})
 
     assert 'PHID-PROJ-tzg2rzj42nn6vfeq3nou' in task_info['projectPHIDs']
@@ -0,0 +1,48 @@
+import pytest
+
+from phids import SlugPHIDMap, UnknownSlugException
+from tests.fakes import FakePhabricator
+
+
+@pytest.fixture
+def phab():
+    return FakePhabricator({
+        'mw1.35.0-wmf.15': 'PHID-PROJ-d5gpv3yru5mbqtsqnu52',
+        'REL1_32': 'PHID-PROJ-gmoiawb4gkjjuwz2qk2h',
+    })
+
+
+def test_resolve_batches(phab, tmp_path):
+    phids = SlugPHIDMap(str(tmp_path / 'phids.json'))
+    phids.resolve(phab, ['REL1_32', 'mw1.35.0-wmf.15', 'REL1_32', 'doesnotexist'])
+
+    assert phab.requests == [
+        ('project.query', {'slugs': ['REL1_32', 'doesnotexist', 'mw1.35.0-wmf.15']})
+    ]
+    assert phids.get(phab, 'REL1_32') == 'PHID-PROJ-gmoiawb4gkjjuwz2qk2h'
+    assert len(phab.requests) == 1
+
+
+def test_persisted(phab, tmp_path):
+    path = str(tmp_path / 'phids.json')
+    SlugPHIDMap(path).resolve(phab, ['REL1_32'])
+
+    assert SlugPHIDMap(path).get(phab, 'REL1_32') == 'PHID-PROJ-gmoiawb4gkjjuwz2qk2h'
+    assert len(phab.requests) == 1
+
+
+def test_unknown_slug_is_cached(phab, tmp_path):
+    phids = SlugPHIDMap(str(tmp_path / 'phids.json'))
+    for i in range(2):
+        with pytest.raises(UnknownSlugException, match="No PHID found for slug #doesnotexist!"):
+            phids.get(phab, 'doesnotexist')
+    assert len(phab.requests) == 1
+
+
+def test_unknown_slug_expires(phab, tmp_path):
+    phids = SlugPHIDMap(str(tmp_path / 'phids.json'), negative_ttl=-1)
+    phids.resolve(phab, ['doesnotexist'])
+    phab.projects['doesnotexist'] = 'PHID-PROJ-new'
+
+    assert phids.get(phab, 'doesnotexist') == 'PHID-PROJ-new'
+    assert len(phab.requests) == 2
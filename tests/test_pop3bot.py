@@ -0,0 +1,133 @@
+import poplib
+from pathlib import Path
+
+import pytest
+
+import pop3bot
+from benchmarks.footer import old_path
+from tests.fakes import FakePOP3Server
+
+root = Path(__file__).parent.parent  # type: Path
+
+FIXTURES = ['lst_merged_master.mbox', 'not_merge.mbox', 'mw_core_wmf_branch.mbox']
+
+
+def read_fixture(filename):
+    return (root / 'tests' / 'data' / filename).read_bytes()
+
+
+@pytest.fixture(params=[True, False], ids=['pipelining', 'no-pipelining'])
+def server(request):
+    with FakePOP3Server([read_fixture(f) for f in FIXTURES], pipelining=request.param) as server:
+        yield server
+
+
+def connect(server):
+    mailbox = poplib.POP3('127.0.0.1', server.port)
+    mailbox.user('user')
+    mailbox.pass_('password')
+    return mailbox
+
+
+def test_top_many(server):
+    mailbox = connect(server)
+    tops = list(pop3bot.top_many(mailbox, [1, 2, 3], 1000, pipeline=2))
+
+    assert [i for (i, lines) in tops] == [1, 2, 3]
+    for (i, lines), sequential in zip(tops, [mailbox.top(i, 1000)[1] for i in [1, 2, 3]]):
+        assert lines == sequential
+    mailbox.quit()
+
+
+def test_deletes_after_processing(server):
+    mailbox = connect(server)
+    fetched = []
+    mails = list(pop3bot.gerritmail_generator(mailbox, fetched))
+    assert [m['Gerrit-Project'] for m in mails] == [
+        'mediawiki/extensions/LabeledSectionTransclusion', 'mediawiki/core', 'mediawiki/core'
+    ]
+    assert fetched == [1, 2, 3]
+    assert 'DELE' not in server.commands
+
+    pop3bot.delete_mails(mailbox, fetched)
+    mailbox.quit()
+    assert server.mails == []
+
+
+def test_crash_loses_nothing(server):
+    mailbox = connect(server)
+    fetched = []
+    for mail in pop3bot.gerritmail_generator(mailbox, fetched):
+        break
+    assert fetched == [1]
+    # no QUIT, e.g. because the run crashed
+    mailbox.close()
+
+    assert len(server.mails) == 3
+
+
+def test_accept_skips_body(server):
+    mailbox = connect(server)
+    fetched = []
+    mails = list(pop3bot.gerritmail_generator(
+        mailbox, fetched, accept=lambda headers: headers['X-Gerrit-MessageType'] == 'merged'
+    ))
+
+    assert [m['X-Gerrit-ChangeURL'] for m in mails] == [
+        '<https://gerrit.wikimedia.org/r/472763>', '<https://gerrit.wikimedia.org/r/566586>'
+    ]
+    # rejected mails are deleted as well
+    assert fetched == [1, 2, 3]
+    mailbox.quit()
+
+
+@pytest.mark.parametrize('filename', sorted(p.name for p in (root / 'tests' / 'data').glob('*.mbox')))
+def test_extract_gerrit_data(filename):
+    raw = read_fixture(filename)
+    # poplib strips CRLF, a plain split keeps the CR of CRLF files
+    for lines in (raw.splitlines(), raw.split(b'\n')):
+        assert pop3bot.extract_gerrit_data(lines) == old_path(lines)
+
+
+def test_extract_gerrit_data_mixed_newlines():
+    data = pop3bot.extract_gerrit_data(read_fixture('mixed_crlf_lf_newline.mbox').splitlines())
+    assert data['Gerrit-Project'] == 'mediawiki/tools/release'
+    assert data['Gerrit-Branch'] == 'master'
+    assert data['Bug'] == 'T284487'
+
+
+def test_extract_gerrit_data_mixed_case_headers():
+    # as extension_wmf_branch.mbox, with a 'Content-transfer-encoding: base64' header
+    data = pop3bot.extract_gerrit_data(read_fixture('mixed_case_headers.mbox').splitlines())
+    assert data['Gerrit-Branch'] == 'wmf/1.35.0-wmf.15'
+    assert data['Bug'] == 'T231720'
+
+
+def test_extract_gerrit_data_quoted_printable():
+    lines = [
+        b'X-Gerrit-MessageType: merged',
+        b'Content-Transfer-Encoding: quoted-printable',
+        b'',
+        b'Bug: T1234',
+        b'Gerrit-Project: mediawiki/extensions/Very=',
+        b'LongName',
+        b'Gerrit-Owner: A =3D B <a@b.c>',
+    ]
+    assert pop3bot.extract_gerrit_data(lines) == {
+        'X-Gerrit-MessageType': 'merged',
+        'Bug': 'T1234',
+        'Gerrit-Project': 'mediawiki/extensions/VeryLongName',
+        'Gerrit-Owner': 'A = B <a@b.c>',
+    }
+
+
+def test_extract_gerrit_data_accept():
+    lines = read_fixture('not_merge.mbox').splitlines()
+    seen = []
+
+    def accept(headers):
+        seen.append(headers['X-Gerrit-MessageType'])
+        return False
+
+    assert pop3bot.extract_gerrit_data(lines, accept) is None
+    assert seen == ['newchange']
@@ -10,24 +10,7 @@ if not (root / "config.py").exists():
 
 import forrestbot  # noqa -- import after verifying import can succeed
 import pop3bot     # noqa -- import after verifying import can succeed
-
-
-class FakeMailbox:
-    def __init__(self, filename):
-        self._content = [(root / 'tests' / 'data' / filename).open(encoding='utf-8').read()]
-
-    def stat(self):
-        return len(self._content), sum(len(x) for x in self._content)
-
-    def top(self, item, n_lines):
-        return (
-            "+OK",
-            [x.encode('utf-8') for x in self._content[item-1].split("\n")[:n_lines]],
-            len(self._content[item-1])
-        )
-
-    def dele(self, id):
-        pass
+from tests.fakes import FakeMailbox  # noqa
 
 
 def test_lst_merged_notask():
@@ -41,7 +24,7 @@ def test_lst_merged_notask():
 
 
 def test_lst_merged_REL():
-    """Release branches for extensions do not get tagged as it is unclear whether they are included in the tarball"""
+    """Release branches of extensions that are not included in the tarball do not get tagged"""
     mail = list(pop3bot.gerritmail_generator(FakeMailbox('lst_merged_REL.mbox')))[0]
     result = forrestbot.process_mail(mail)
 
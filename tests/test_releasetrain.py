@@ -0,0 +1,49 @@
+import wikimediaci_utils
+
+import releasetrain
+from releasetrain import ReleaseTrain, TarballManifest
+
+BRANCHES = ['1.35.0-wmf.9', '1.35.0-wmf.10', '1.34.0-wmf.25', 'master', '1.35.0-wmf.999', '1.26wmf3-back']
+
+
+def test_newest():
+    trains = ReleaseTrain(BRANCHES)
+    # sorted numerically, not as strings
+    assert list(trains) == ['1.34.0-wmf.25', '1.35.0-wmf.9', '1.35.0-wmf.10']
+    assert trains.newest() == '1.35.0-wmf.10'
+    assert ReleaseTrain(['master']).newest() is None
+
+
+def test_next():
+    trains = ReleaseTrain(BRANCHES)
+    assert trains.next('1.34.0-wmf.25') == '1.35.0-wmf.9'
+    # a train that is not in the index
+    assert trains.next('1.35.0-wmf.1') == '1.35.0-wmf.9'
+    # the train after the newest one has not been cut yet
+    assert trains.next() == '1.35.0-wmf.11'
+    assert trains.next('master') is None
+    assert ReleaseTrain().next() is None
+
+
+def test_add():
+    trains = ReleaseTrain(BRANCHES)
+    assert trains.add('1.35.0-wmf.11')
+    assert not trains.add('1.35.0-wmf.11')
+    assert not trains.add('wmf_deploy')
+    assert '1.35.0-wmf.11' in trains
+    assert 'wmf_deploy' not in trains
+    assert trains.newest() == '1.35.0-wmf.11'
+    assert len(trains) == 4
+
+
+def test_slugify():
+    assert releasetrain.slugify(['REL1_35', 'wmf/1.35.0-wmf.16', 'master', 'wmf_deploy']) == [
+        'mw1.35', 'mw1.35.0-wmf.16'
+    ]
+
+
+def test_tarball_manifest(monkeypatch, tmp_path):
+    monkeypatch.setattr(wikimediaci_utils, 'get_bundled_list', lambda: ['mediawiki/extensions/ParserFunctions'])
+    manifest = TarballManifest.load(str(tmp_path / 'tarball.json'))
+    assert 'mediawiki/extensions/ParserFunctions' in manifest
+    assert 'mediawiki/extensions/GrowthExperiments' not in manifest
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+import wikimediaci_utils
+
+from repositories import RepositoryRegistry
+
+
+@pytest.fixture
+def deployed(monkeypatch):
+    calls = []
+
+    def get_wikimedia_deployed_list():
+        calls.append(None)
+        return ['mediawiki/extensions/Foo', 'mediawiki/skins/Bar']
+
+    monkeypatch.setattr(wikimediaci_utils, 'get_wikimedia_deployed_list', get_wikimedia_deployed_list)
+    return calls
+
+
+def test_membership(deployed):
+    registry = RepositoryRegistry.fetch()
+    assert 'mediawiki/core' in registry
+    assert 'mediawiki/extensions/Foo' in registry
+    assert 'operations/mediawiki-config' not in registry
+    assert len(registry) == 3
+
+
+def test_load_uses_cache(deployed, tmp_path):
+    path = str(tmp_path / 'repositories.json')
+    RepositoryRegistry.load(path)
+    registry = RepositoryRegistry.load(path)
+
+    assert 'mediawiki/skins/Bar' in registry
+    assert len(deployed) == 1
+
+
+def test_load_refresh(deployed, tmp_path):
+    path = str(tmp_path / 'repositories.json')
+    RepositoryRegistry.load(path)
+    RepositoryRegistry.load(path, refresh=True, ttl=-1)
+    # the entry written above has already expired
+    RepositoryRegistry.load(path)
+
+    assert len(deployed) == 3
+
+
+def test_load_stale_on_failure(monkeypatch, tmp_path):
+    path = tmp_path / 'repositories.json'
+    path.write_text(json.dumps({'repositories': {'value': ['mediawiki/core'], 'expires': 0}}))
+
+    def broken():
+        raise IOError("gerrit is down")
+
+    monkeypatch.setattr(wikimediaci_utils, 'get_wikimedia_deployed_list', broken)
+    registry = RepositoryRegistry.load(str(path))
+    assert list(registry) == ['mediawiki/core']
@@ -0,0 +1,73 @@
+import time
+
+from spool import Spool
+
+
+def action(task, *slugs, branch='master'):
+    return {'task': task, 'slugs': list(slugs), 'url': 'https://gerrit.wikimedia.org/r/1', 'branch': branch}
+
+
+def test_put_pending(tmp_path):
+    spool = Spool(str(tmp_path / 'spool.sqlite3'))
+    assert spool.put([action(2, 'mw1.35.0-wmf.16'), action(1, 'mw1.35.0-wmf.15', 'mw1.34'), action(3)]) == 3
+
+    assert spool.pending() == [
+        action(1, 'mw1.34'),
+        action(1, 'mw1.35.0-wmf.15'),
+        action(2, 'mw1.35.0-wmf.16'),
+    ]
+
+
+def test_idempotent(tmp_path):
+    spool = Spool(str(tmp_path / 'spool.sqlite3'))
+    spool.put([action(1, 'mw1.34')])
+    assert spool.put([action(1, 'mw1.34')]) == 0
+    assert len(spool.pending()) == 1
+
+    spool.complete(spool.pending())
+    assert spool.put([action(1, 'mw1.34')]) == 0
+    assert spool.pending() == []
+
+
+def test_resumable(tmp_path):
+    path = str(tmp_path / 'spool.sqlite3')
+    spool = Spool(path)
+    spool.put([action(1, 'mw1.34'), action(2, 'mw1.34')])
+    spool.complete([action(1, 'mw1.34')])
+    spool.close()
+
+    assert Spool(path).pending() == [action(2, 'mw1.34')]
+
+
+def test_prune(tmp_path):
+    spool = Spool(str(tmp_path / 'spool.sqlite3'))
+    spool.put([action(1, 'mw1.34'), action(2, 'mw1.34')])
+    spool.complete([action(1, 'mw1.34')])
+    spool.prune(retention=-1)
+
+    # the completed action is forgotten, the pending one is kept
+    assert spool.put([action(1, 'mw1.34'), action(2, 'mw1.34')]) == 1
+
+
+def test_iter_pending(tmp_path):
+    spool = Spool(str(tmp_path / 'spool.sqlite3'))
+    spool.put([action(task, 'mw1.34', 'mw1.35.0-wmf.16') for task in range(5)])
+
+    seen = []
+    for a in spool.iter_pending(page_size=3):
+        seen.append(a)
+        spool.complete([a])
+    assert seen == spool.pending() + [
+        action(task, slug) for task in range(5) for slug in ('mw1.34', 'mw1.35.0-wmf.16')
+    ]
+    assert spool.pending() == []
+
+
+def test_created(tmp_path):
+    spool = Spool(str(tmp_path / 'spool.sqlite3'))
+    before = time.time()
+    spool.put([action(1, 'mw1.34')])
+
+    created = spool.created([(1, 'mw1.34'), (1, 'mw1.35')])
+    assert list(created) == [(1, 'mw1.34')]
+    assert before <= created[(1, 'mw1.34')] <= time.time()
@@ -0,0 +1,103 @@
+from tasks import TaskAggregator, get_task_projects, update_job
+from tests.fakes import FakePhabricator
+from updater import UpdateExecutor
+
+
+def test_get_task_projects():
+    phab = FakePhabricator(tasks={
+        1: {'PHID-PROJ-a'},
+        2: {'PHID-PROJ-a', 'PHID-PROJ-b'},
+        3: set(),
+    })
+
+    # T4 is private
+    assert get_task_projects(phab, [1, 2, 2, 3, 4]) == {
+        1: {'PHID-PROJ-a'},
+        2: {'PHID-PROJ-a', 'PHID-PROJ-b'},
+        3: set(),
+    }
+    assert [method for (method, params) in phab.requests] == ['maniphest.search']
+
+
+def test_get_task_projects_paged():
+    phab = FakePhabricator(tasks={i: {'PHID-PROJ-a'} for i in range(1, 251)})
+
+    assert len(get_task_projects(phab, range(1, 301), page_size=100)) == 250
+    assert len(phab.requests) == 3
+    assert all(len(params['constraints']['ids']) <= 100 for (method, params) in phab.requests)
+
+
+def test_get_task_projects_nothing_to_do():
+    phab = FakePhabricator()
+    assert get_task_projects(phab, []) == {}
+    assert phab.requests == []
+
+
+def test_update_job_edit():
+    assert update_job(1, {'PHID-PROJ-a', 'PHID-PROJ-b'}, "T1", {'PHID-PROJ-a', 'PHID-PROJ-c'}) == (
+        1, 'maniphest.edit', {
+            'objectIdentifier': 'T1',
+            'transactions': [{'type': 'projects.add', 'value': ['PHID-PROJ-b']}],
+        }, "T1")
+    assert update_job(1, {'PHID-PROJ-a'}, "T1", {'PHID-PROJ-a'}) is None
+
+
+def test_update_job_blind():
+    task, method, params, description = update_job(1, {'PHID-PROJ-a'}, "T1", mode='blind')
+    assert method == 'maniphest.edit'
+    assert params['transactions'] == [{'type': 'projects.add', 'value': ['PHID-PROJ-a']}]
+
+
+def test_update_job_update():
+    task, method, params, description = update_job(1, {'PHID-PROJ-b'}, "T1", {'PHID-PROJ-a'}, mode='update')
+    assert method == 'maniphest.update'
+    assert sorted(params['projectPHIDs']) == ['PHID-PROJ-a', 'PHID-PROJ-b']
+
+
+def test_update_job_keeps_concurrent_changes():
+    phab = FakePhabricator(tasks={1: {'PHID-PROJ-a'}})
+    job = update_job(1, {'PHID-PROJ-b'}, "T1", get_task_projects(phab, [1])[1])
+    # someone adds a tag between our read and our write
+    phab.tasks[1].add('PHID-PROJ-c')
+    UpdateExecutor(phab).run([job])
+
+    assert phab.tasks[1] == {'PHID-PROJ-a', 'PHID-PROJ-b', 'PHID-PROJ-c'}
+
+
+def test_aggregator_by_task_count():
+    batches = []
+    aggregator = TaskAggregator(batches.append, max_tasks=2, max_age=60)
+    aggregator.add({'task': 1, 'slugs': ['mw1.34']})
+    aggregator.add({'task': 1, 'slugs': ['mw1.35.0-wmf.16']})
+    assert batches == []
+    aggregator.add({'task': 2, 'slugs': ['mw1.34']})
+    aggregator.add({'task': 3, 'slugs': ['mw1.34']})
+    aggregator.flush()
+    aggregator.flush()
+    assert batches == [{1: {'mw1.34', 'mw1.35.0-wmf.16'}, 2: {'mw1.34'}}, {3: {'mw1.34'}}]
+
+
+def test_aggregator_by_age():
+    now = [0]
+    batches = []
+    aggregator = TaskAggregator(batches.append, max_tasks=100, max_age=10, clock=lambda: now[0])
+    aggregator.add({'task': 1, 'slugs': ['mw1.34']})
+    now[0] = 5
+    aggregator.add({'task': 2, 'slugs': ['mw1.34']})
+    assert len(aggregator) == 2
+    now[0] = 10
+    # a further action for a task in the batch still joins it
+    aggregator.add({'task': 2, 'slugs': ['mw1.35']})
+    assert batches == []
+    aggregator.add({'task': 3, 'slugs': ['mw1.34']})
+    assert batches == [{1: {'mw1.34'}, 2: {'mw1.34', 'mw1.35'}}]
+    assert len(aggregator) == 1
+
+
+def test_aggregator_keeps_task_together():
+    batches = []
+    aggregator = TaskAggregator(batches.append, max_tasks=2, max_age=60)
+    for task, slug in [(1, 'x'), (2, 'x'), (2, 'y'), (3, 'x')]:
+        aggregator.add({'task': task, 'slugs': [slug]})
+    aggregator.flush()
+    assert batches == [{1: {'x'}, 2: {'x', 'y'}}, {3: {'x'}}]
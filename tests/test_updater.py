@@ -0,0 +1,86 @@
+import logging
+import threading
+import time
+
+import requests
+
+from tests.fakes import FakePhabricator
+from updater import TokenBucket, UpdateExecutor
+
+
+def job(task, projects):
+    return (task, 'maniphest.update', {'id': str(task), 'projectPHIDs': projects}, "T%i" % task)
+
+
+def test_token_bucket():
+    now = [0.0]
+    sleeps = []
+
+    def sleep(t):
+        sleeps.append(t)
+        now[0] += t
+
+    bucket = TokenBucket(rate=2, capacity=2, clock=lambda: now[0], sleep=sleep)
+    for i in range(4):
+        bucket.acquire()
+
+    # the first two tokens are free, then one token per 0.5s
+    assert sleeps == [0.5, 0.5]
+
+
+def test_run_updates():
+    phab = FakePhabricator(tasks={1: set(), 2: {'PHID-PROJ-a'}})
+    executor = UpdateExecutor(phab, max_workers=2, rate=1000)
+
+    assert executor.run([job(1, ['PHID-PROJ-b']), job(2, ['PHID-PROJ-a', 'PHID-PROJ-b'])]) == {1, 2}
+    assert phab.tasks == {1: {'PHID-PROJ-b'}, 2: {'PHID-PROJ-a', 'PHID-PROJ-b'}}
+
+
+def test_run_isolates_errors(caplog):
+    phab = FakePhabricator(tasks={1: set(), 2: set(), 3: set()}, readonly={2})
+    executor = UpdateExecutor(phab, max_workers=3, rate=1000)
+
+    with caplog.at_level(logging.ERROR):
+        updated = executor.run([job(t, ['PHID-PROJ-b']) for t in (1, 2, 3)])
+
+    assert updated == {1, 3}
+    assert phab.tasks[2] == set()
+    assert 'Unable to update T2, maybe it is read-only?' in caplog.messages
+
+
+def test_run_isolates_request_errors(caplog):
+    class FlakyPhabricator(FakePhabricator):
+        def maniphest_update(self, params):
+            if params['id'] == '2':
+                raise requests.exceptions.ReadTimeout("timed out")
+            return super().maniphest_update(params)
+
+    phab = FlakyPhabricator(tasks={1: set(), 2: set(), 3: set()})
+    executor = UpdateExecutor(phab, max_workers=3, rate=1000)
+
+    with caplog.at_level(logging.ERROR):
+        updated = executor.run([job(t, ['PHID-PROJ-b']) for t in (1, 2, 3)])
+
+    assert updated == {1, 3}
+    assert 'Unable to update T2, request failed' in caplog.messages
+
+
+def test_run_concurrently():
+    concurrent = []
+    active = [0]
+    lock = threading.Lock()
+
+    class SlowPhabricator(FakePhabricator):
+        def maniphest_update(self, params):
+            with lock:
+                active[0] += 1
+                concurrent.append(active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+            return super().maniphest_update(params)
+
+    phab = SlowPhabricator(tasks={t: set() for t in range(8)})
+    UpdateExecutor(phab, max_workers=4, rate=1000).run([job(t, []) for t in range(8)])
+
+    assert max(concurrent) == 4
@@ -0,0 +1,93 @@
+import concurrent.futures
+import logging
+import threading
+import time
+
+import phabricator as legophab
+import requests
+
+logger = logging.getLogger('updater')
+
+DEFAULT_WORKERS = 4
+# requests per second, averaged; bursts of up to DEFAULT_WORKERS are allowed
+DEFAULT_RATE = 5.0
+
+
+class TokenBucket(object):
+    def __init__(self, rate, capacity=1, clock=time.monotonic, sleep=time.sleep):
+        """ Thread-safe token bucket rate limiter.
+
+            Parameters:
+              * rate - number of tokens added per second
+              * capacity - maximum number of tokens, i.e. the burst size
+        """
+        self._rate = rate
+        self._capacity = capacity
+        self._tokens = capacity
+        self._clock = clock
+        self._sleep = sleep
+        self._last = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """ Takes a token from the bucket, waiting for one if needed. """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._capacity, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self._rate if self._tokens < 0 else 0
+        if wait:
+            self._sleep(wait)
+
+
+class UpdateExecutor(object):
+    def __init__(self, phab, max_workers=DEFAULT_WORKERS, rate=DEFAULT_RATE):
+        """ Runs Phabricator task updates concurrently, with at most
+            max_workers requests in flight and at most rate requests per
+            second on average.
+
+            Parameters:
+              * phab - the legophab.Phabricator connection to use
+              * max_workers - number of concurrent requests
+              * rate - maximum number of requests per second
+        """
+        self._phab = phab
+        self._max_workers = max_workers
+        self._bucket = TokenBucket(rate, capacity=max_workers)
+
+    def request(self, method, params):
+        self._bucket.acquire()
+        return self._phab.request(method, params)
+
+    def _run_job(self, job):
+        task, method, params, description = job
+        try:
+            self.request(method, params)
+        except legophab.PhabricatorException as e:
+            logger.error(description)
+            logger.error('Unable to update T%i, maybe it is read-only?', task, exc_info=e)
+            return False
+        except requests.RequestException as e:
+            # a timeout or connection error only fails this task
+            logger.error(description)
+            logger.error('Unable to update T%i, request failed', task, exc_info=e)
+            return False
+        logger.debug("Updated T%i", task)
+        return True
+
+    def run(self, jobs):
+        """ Executes jobs, an iterable of (task, method, params, description)
+            tuples. A failing update, either because Phabricator refuses it
+            or because the request fails, is logged as an error and does not
+            affect the other jobs.
+
+            Returns the set of tasks that were updated successfully.
+        """
+        jobs = list(jobs)
+        if not jobs:
+            return set()
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self._max_workers) as pool:
+            results = pool.map(self._run_job, jobs)
+            return set(job[0] for (job, ok) in zip(jobs, results) if ok)
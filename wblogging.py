@@ -1,5 +1,6 @@
 import os
 import sys
+import json
 import logging
 import logging.handlers
 import argparse
@@ -9,6 +10,37 @@ def private_open(file, flags, dir_fd=None):
     return os.open(file, flags, mode=0o600, dir_fd=dir_fd)
 
 
+def run_start_path(logfile):
+    """ Returns the path of the run-start marker of logfile. """
+    return os.path.join(os.path.dirname(os.path.abspath(logfile)), 'forrestbot-run-start.json')
+
+
+def write_run_start(logfile):
+    """ Records where the log of the current run starts: the current size of
+        logfile, and its inode, to detect a rotation during the run. """
+    try:
+        st = os.stat(logfile)
+    except FileNotFoundError:
+        return
+    with open(run_start_path(logfile), 'w', opener=private_open) as f:
+        json.dump({'inode': st.st_ino, 'offset': st.st_size}, f)
+
+
+def read_run_start(logfile):
+    """ Returns the offset in logfile at which the log of the last run
+        starts. That is 0 if the run started before the log was rotated, or
+        if the run-start marker is missing. """
+    try:
+        with open(run_start_path(logfile)) as f:
+            marker = json.load(f)
+        st = os.stat(logfile)
+    except (OSError, ValueError):
+        return 0
+    if marker.get('inode') != st.st_ino or marker.get('offset', 0) > st.st_size:
+        return 0
+    return marker['offset']
+
+
 class PrivateTimedRotatingFileHandler(
         logging.handlers.TimedRotatingFileHandler):
     def _open(self):